@@ -158,7 +158,8 @@ type AmplitudeAnayticsConfig struct {
 }
 
 type WebhookAnalyticsConfig struct {
-	URL string `yaml:"url"`
+	URL   string `yaml:"url"`
+	Batch bool   `yaml:"batch,omitempty"`
 }
 
 type WorkshopAnalyticsConfig struct {
@@ -1,10 +1,29 @@
+import asyncio
 import logging
 
-import requests
-
 from datetime import datetime, timezone
 
-from .operator_config import ANALYTICS_WEBHOOK_URL
+import kopf
+import aiohttp
+
+from .operator_config import ANALYTICS_WEBHOOK_URL, ANALYTICS_WEBHOOK_BATCH
+
+# Limits on the queue of analytics events waiting to be delivered. When the
+# queue is full the oldest event is dropped to make room for the new one, so
+# reporting an event never blocks the handler which generated it. When
+# batching is enabled, the emitter waits up to the flush interval for further
+# events before posting a batch.
+
+ANALYTICS_QUEUE_SIZE = 1000
+ANALYTICS_BATCH_SIZE = 50
+ANALYTICS_FLUSH_INTERVAL = 1.0
+
+# Failed requests to the webhook are retried with exponential backoff. Once
+# the attempts are exhausted the events are dropped.
+
+ANALYTICS_REQUEST_TIMEOUT = 2.5
+ANALYTICS_DELIVERY_ATTEMPTS = 4
+ANALYTICS_RETRY_BACKOFF = 0.5
 
 
 def current_time():
@@ -13,11 +32,189 @@ def current_time():
     return tz_dt.isoformat()
 
 
-def send_event_to_webhook(url, message):
-    try:
-        requests.post(url, json=message, timeout=2.5)
-    except Exception:
-        logging.exception("Unable to report event to %s: %s", url, message)
+class AnalyticsEmitter:
+    """Delivers analytics events to the webhook from a task running on the
+    operator event loop. Events can be emitted from any thread, including the
+    threads kopf runs synchronous handlers in, and are handed off to the event
+    loop without waiting on the webhook.
+
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._queue = None
+        self._task = None
+        self.dropped = 0
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(ANALYTICS_QUEUE_SIZE)
+        self._start_task()
+
+    def _start_task(self):
+        self._task = self._loop.create_task(self._run())
+        self._task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        # The task should only ever finish when cancelled on stopping. If it
+        # failed, log the error and restart it so events are still delivered.
+
+        if task.cancelled() or task is not self._task:
+            return
+
+        logging.error(
+            "Analytics emitter failed, restarting.", exc_info=task.exception()
+        )
+
+        self._loop.call_later(ANALYTICS_RETRY_BACKOFF, self._restart_task, task)
+
+    def _restart_task(self, task):
+        # Only restart if the emitter wasn't stopped in the meantime.
+
+        if task is self._task:
+            self._start_task()
+
+    async def stop(self):
+        if self._task:
+            task, self._task = self._task, None
+
+            task.cancel()
+
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        if self._queue and not self._queue.empty():
+            self._drop(self._queue.qsize(), "operator is stopping")
+
+        self._loop = None
+
+    def emit(self, message):
+        """Queues an analytics event for delivery. Can be called from any
+        thread and never blocks.
+
+        """
+
+        loop = self._loop
+
+        if loop is None or loop.is_closed():
+            self._drop(1, "operator event loop is not running")
+            return
+
+        loop.call_soon_threadsafe(self._enqueue, message)
+
+    def _enqueue(self, message):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+
+        self._queue.put_nowait(message)
+
+    def _drop(self, count, reason):
+        self.dropped += count
+
+        logging.warning(
+            "Dropped %d analytics events as %s, %d dropped in total.",
+            count,
+            reason,
+            self.dropped,
+        )
+
+    async def _run(self):
+        timeout = aiohttp.ClientTimeout(total=ANALYTICS_REQUEST_TIMEOUT)
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                batch = [await self._queue.get()]
+
+                # Only wait for further events when batching, otherwise just
+                # take what has already been queued.
+
+                deadline = self._loop.time() + ANALYTICS_FLUSH_INTERVAL
+
+                while len(batch) < ANALYTICS_BATCH_SIZE:
+                    try:
+                        if ANALYTICS_WEBHOOK_BATCH:
+                            batch.append(
+                                await asyncio.wait_for(
+                                    self._queue.get(), deadline - self._loop.time()
+                                )
+                            )
+
+                        else:
+                            batch.append(self._queue.get_nowait())
+
+                    except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                        break
+
+                try:
+                    await self._deliver(session, batch)
+
+                except Exception:  # pylint: disable=broad-except
+                    self._drop(len(batch), "delivery failed unexpectedly")
+
+                    logging.exception("Unexpected error delivering analytics events.")
+
+    async def _deliver(self, session, messages):
+        if ANALYTICS_WEBHOOK_BATCH:
+            posts = [(messages, {"events": messages})]
+        else:
+            posts = [([message], message) for message in messages]
+
+        for index, (_, payload) in enumerate(posts):
+            if not await self._post(session, payload):
+                self._drop(
+                    sum(len(pending) for pending, _ in posts[index:]),
+                    "analytics webhook could not be reached",
+                )
+
+                return
+
+    async def _post(self, session, payload):
+        delay = ANALYTICS_RETRY_BACKOFF
+
+        for attempt in range(ANALYTICS_DELIVERY_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+            try:
+                async with session.post(
+                    ANALYTICS_WEBHOOK_URL, json=payload
+                ) as response:
+                    if response.status == 429 or response.status >= 500:
+                        continue
+
+                    # Don't retry requests the webhook rejected, as the same
+                    # events would only be rejected again.
+
+                    if response.status >= 400:
+                        logging.error(
+                            "Analytics webhook rejected events with status %d.",
+                            response.status,
+                        )
+
+                    return True
+
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+
+        return False
+
+
+analytics_emitter = AnalyticsEmitter()
+
+
+@kopf.on.startup()
+async def start_analytics_emitter(**_):
+    if ANALYTICS_WEBHOOK_URL:
+        await analytics_emitter.start()
+
+
+@kopf.on.cleanup()
+async def stop_analytics_emitter(**_):
+    await analytics_emitter.stop()
 
 
 def report_analytics_event(event, data={}):
@@ -35,4 +232,4 @@ def report_analytics_event(event, data={}):
     }
 
     if message:
-        send_event_to_webhook(ANALYTICS_WEBHOOK_URL, message)
+        analytics_emitter.emit(message)
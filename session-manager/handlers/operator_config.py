@@ -98,6 +98,7 @@ CLARITY_TRACKING_ID = xget(config_values, "workshopAnalytics.clarity.trackingId"
 AMPLITUDE_TRACKING_ID = xget(config_values, "workshopAnalytics.amplitude.trackingId", "")
 
 ANALYTICS_WEBHOOK_URL = xget(config_values, "workshopAnalytics.webhook.url", "")
+ANALYTICS_WEBHOOK_BATCH = xget(config_values, "workshopAnalytics.webhook.batch", False)
 
 
 def generate_password(length):
@@ -27,6 +27,8 @@ from .operator_config import (
     CLARITY_TRACKING_ID,
     AMPLITUDE_TRACKING_ID,
     ANALYTICS_WEBHOOK_URL,
+    ANALYTICS_WEBHOOK_BATCH,
+    generate_password,
     PORTAL_ADMIN_USERNAME,
     PORTAL_ADMIN_PASSWORD,
     PORTAL_ROBOT_USERNAME,
@@ -130,11 +132,43 @@ def training_portal_create(name, uid, body, spec, status, patch, runtime, retry,
 
     catalog_visibility = xget(spec, "portal.catalog.visibility", "private")
 
+    # Calculate settings for the database used by the portal. By default a
+    # SQLite database held on the persistent volume of the portal is used.
+
+    database_engine = xget(spec, "portal.database.engine", "sqlite")
+    database_host = xget(spec, "portal.database.host", "")
+    database_port = str(xget(spec, "portal.database.port", 5432))
+    database_name = xget(spec, "portal.database.name", portal_name)
+    database_user = xget(spec, "portal.database.user", "")
+    database_password = xget(spec, "portal.database.password", "")
+    database_tuned = str(xget(spec, "portal.database.tuned", False)).lower()
+
+    # Multiple replicas of the portal can only be run where they share an
+    # external PostgreSQL database. Only one of the replicas, elected as
+    # leader, manages workshop environments and workshop sessions.
+
+    portal_replicas = xget(spec, "portal.replicas", 1)
+
+    if portal_replicas > 1 and database_engine != "postgresql":
+        logger.warning(
+            f"Training portal {portal_name} requires a PostgreSQL database to run multiple replicas."
+        )
+
+        portal_replicas = 1
+
+    # Replicas need to share the secret key used for signing, otherwise it is
+    # generated by the portal and saved to its persistent volume.
+
+    secret_key = generate_password(50) if portal_replicas > 1 else ""
+
     google_tracking_id = xget(spec, "analytics.google.trackingId", GOOGLE_TRACKING_ID)
     clarity_tracking_id = xget(spec, "analytics.clarity.trackingId", CLARITY_TRACKING_ID)
     amplitude_tracking_id = xget(spec, "analytics.amplitude.trackingId", AMPLITUDE_TRACKING_ID)
 
     analytics_webhook_url = xget(spec, "analytics.webhook.url", ANALYTICS_WEBHOOK_URL)
+    analytics_webhook_batch = str(
+        xget(spec, "analytics.webhook.batch", ANALYTICS_WEBHOOK_BATCH)
+    ).lower()
 
     # Create the namespace for holding the training portal. Before we attempt to
     # create the namespace, we first see whether it may already exist. This
@@ -561,9 +595,9 @@ def training_portal_create(name, uid, body, spec, status, patch, runtime, retry,
             },
         },
         "spec": {
-            "replicas": 1,
+            "replicas": portal_replicas,
             "selector": {"matchLabels": {"deployment": "training-portal"}},
-            "strategy": {"type": "Recreate"},
+            "strategy": {"type": "Recreate" if portal_replicas == 1 else "RollingUpdate"},
             "template": {
                 "metadata": {
                     "labels": {
@@ -599,6 +633,7 @@ def training_portal_create(name, uid, body, spec, status, patch, runtime, retry,
                             "ports": [
                                 {"containerPort": 8080, "protocol": "TCP"},
                                 {"containerPort": 8081, "protocol": "TCP"},
+                                {"containerPort": 8082, "protocol": "TCP"},
                             ],
                             "readinessProbe": {
                                 "httpGet": {"path": "/healthz", "port": 8081},
@@ -711,6 +746,58 @@ def training_portal_create(name, uid, body, spec, status, patch, runtime, retry,
                                     "name": "ANALYTICS_WEBHOOK_URL",
                                     "value": analytics_webhook_url,
                                 },
+                                {
+                                    "name": "ANALYTICS_WEBHOOK_BATCH",
+                                    "value": analytics_webhook_batch,
+                                },
+                                {
+                                    "name": "PORTAL_DATABASE_ENGINE",
+                                    "value": database_engine,
+                                },
+                                {
+                                    "name": "PORTAL_DATABASE_HOST",
+                                    "value": database_host,
+                                },
+                                {
+                                    "name": "PORTAL_DATABASE_PORT",
+                                    "value": database_port,
+                                },
+                                {
+                                    "name": "PORTAL_DATABASE_NAME",
+                                    "value": database_name,
+                                },
+                                {
+                                    "name": "PORTAL_DATABASE_USER",
+                                    "value": database_user,
+                                },
+                                {
+                                    "name": "PORTAL_DATABASE_PASSWORD",
+                                    "value": database_password,
+                                },
+                                {
+                                    "name": "PORTAL_DATABASE_TUNED",
+                                    "value": database_tuned,
+                                },
+                                {
+                                    "name": "PORTAL_REPLICAS",
+                                    "value": str(portal_replicas),
+                                },
+                                {
+                                    "name": "PORTAL_SECRET_KEY",
+                                    "value": secret_key,
+                                },
+                                {
+                                    "name": "PORTAL_NAMESPACE",
+                                    "valueFrom": {
+                                        "fieldRef": {"fieldPath": "metadata.namespace"}
+                                    },
+                                },
+                                {
+                                    "name": "PORTAL_REPLICA",
+                                    "valueFrom": {
+                                        "fieldRef": {"fieldPath": "metadata.name"}
+                                    },
+                                },
                             ],
                             "volumeMounts": [
                                 {"name": "data", "mountPath": "/opt/app-root/data"},
@@ -750,6 +837,17 @@ def training_portal_create(name, uid, body, spec, status, patch, runtime, retry,
         },
     }
 
+    # The persistent volume can only be mounted by one replica, so where there
+    # are multiple replicas, each uses a volume of its own for data which is
+    # local to the replica. All state which needs to be shared is held in the
+    # database.
+
+    if portal_replicas > 1:
+        deployment_body["spec"]["template"]["spec"]["volumes"][0] = {
+            "name": "data",
+            "emptyDir": {},
+        }
+
     if CLUSTER_STORAGE_USER:
         # This hack is to cope with Kubernetes clusters which don't properly set
         # up persistent volume ownership. IBM Kubernetes is one example. The
@@ -791,7 +889,10 @@ def training_portal_create(name, uid, body, spec, status, patch, runtime, retry,
         },
         "spec": {
             "type": "ClusterIP",
-            "ports": [{"port": 80, "protocol": "TCP", "targetPort": 8080}],
+            "ports": [
+                {"name": "http", "port": 80, "protocol": "TCP", "targetPort": 8080},
+                {"name": "events", "port": 8082, "protocol": "TCP", "targetPort": 8082},
+            ],
             "selector": {"deployment": "training-portal"},
         },
     }
@@ -0,0 +1,218 @@
+"""Benchmark of the hot queries against workshop sessions, checking that the
+query plans use the indexes defined for them.
+
+A scratch SQLite database is created and seeded with a large number of
+historical workshop sessions, along with a smaller number of reserved and
+allocated workshop sessions. Each hot query is then timed and its query plan
+checked for the expected index. Timings are for fetching at most a limited
+number of rows, so they reflect the lookup rather than loading results.
+
+Exits with a non zero status if any query plan doesn't use the expected
+index, so it can be used to catch regressions.
+
+Run from the training portal directory:
+
+    python scripts/benchmark_indexes.py --sessions 100000
+
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+os.environ.setdefault("TRAINING_PORTAL", "benchmark")
+
+
+def setup(path):
+    # Point the database at the scratch database before Django is setup.
+
+    from django.conf import settings  # pylint: disable=import-outside-toplevel
+
+    settings.DATABASES["default"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": path,
+    }
+
+    import django  # pylint: disable=import-outside-toplevel
+
+    django.setup()
+
+    from django.core.management import (  # pylint: disable=import-outside-toplevel
+        call_command,
+    )
+
+    call_command("migrate", verbosity=0)
+
+
+def seed(count, environments, users):
+    # pylint: disable=import-outside-toplevel
+
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+
+    from project.apps.workshops.models import (
+        TrainingPortal,
+        Environment,
+        EnvironmentState,
+        Session,
+        SessionState,
+    )
+
+    User = get_user_model()  # pylint: disable=invalid-name
+
+    portal = TrainingPortal.objects.create(name="benchmark")
+
+    environments = [
+        Environment.objects.create(
+            portal=portal,
+            name=f"benchmark-w{index:02d}",
+            workshop_name=f"workshop-{index}",
+            state=EnvironmentState.RUNNING,
+            position=index,
+        )
+        for index in range(environments)
+    ]
+
+    User.objects.bulk_create(User(username=f"user-{index}") for index in range(users))
+
+    users = list(User.objects.all())
+
+    now = timezone.now()
+
+    def sessions():
+        for index in range(count):
+            # Most workshop sessions are historical, with a small proportion
+            # reserved or currently allocated to a user.
+
+            choice = random.random()
+
+            if choice < 0.02:
+                state, owner = SessionState.WAITING, None
+            elif choice < 0.05:
+                state, owner = SessionState.RUNNING, random.choice(users)
+            else:
+                state, owner = SessionState.STOPPED, random.choice(users)
+
+            started = now - timedelta(minutes=random.randint(0, 60 * 24 * 30))
+
+            yield Session(
+                name=f"benchmark-s{index:06d}",
+                id=f"{index:06d}",
+                environment=random.choice(environments),
+                state=state,
+                owner=owner,
+                created=started,
+                started=started,
+                expires=started + timedelta(minutes=30),
+            )
+
+    Session.objects.bulk_create(sessions(), batch_size=5000)
+
+    for environment in environments:
+        environment.recalculate_session_counters()
+
+    return portal, environments, users
+
+
+def queries(portal, environment, user):
+    # pylint: disable=import-outside-toplevel
+
+    from django.utils import timezone
+
+    from project.apps.workshops.models import Session, SessionState
+
+    cutoff = timezone.now() - timedelta(hours=36)
+
+    return [
+        (
+            "available sessions",
+            environment.available_sessions(),
+            "session_environment_owner",
+        ),
+        (
+            "active sessions",
+            environment.active_sessions(),
+            "session_environment_owner",
+        ),
+        (
+            "allocated sessions for user",
+            portal.allocated_sessions_for_user(user),
+            "session_owner_state",
+        ),
+        (
+            "expired stopped sessions",
+            Session.objects.filter(state=SessionState.STOPPED, expires__lte=cutoff),
+            "session_state_expires",
+        ),
+        (
+            "running environments",
+            portal.running_environments(),
+            "environment_portal_state",
+        ),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--environments", type=int, default=20)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=1000)
+
+    options = parser.parse_args()
+
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(os.path.join(directory, "db.sqlite3"))
+
+        start = time.perf_counter()
+
+        portal, environments, users = seed(
+            options.sessions, options.environments, options.users
+        )
+
+        print(f"seeded {options.sessions} sessions in {time.perf_counter()-start:.1f}s")
+
+        for name, queryset, index in queries(
+            portal, random.choice(environments), random.choice(users)
+        ):
+            plan = queryset.explain()
+
+            timings = []
+
+            for _ in range(options.iterations):
+                start = time.perf_counter()
+                list(queryset[: options.limit])
+                timings.append(time.perf_counter() - start)
+
+            timings.sort()
+
+            p50 = timings[len(timings) // 2] * 1000.0
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000.0
+
+            status = "ok" if index in plan else "MISSING INDEX"
+
+            if index not in plan:
+                failures += 1
+
+            print(f"{name:30} p50={p50:8.2f}ms p99={p99:8.2f}ms {status}")
+
+            if index not in plan:
+                print(f"  expected {index}, plan was:")
+                print("  " + plan.replace("\n", "\n  "))
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Benchmark of session allocation against SQLite, comparing the default
+connection settings with those used when PORTAL_DATABASE_TUNED is enabled.
+
+A set of threads replays a mixed workload against a scratch database. Reads
+are of the form made by the catalog and session schedule endpoints, and
+writes allocate a reserved session and create a replacement as is done when
+a session is requested. Reports p50/p99 latencies in milliseconds for each
+type of operation, along with any operations which failed as the database
+was locked.
+
+Each configuration is run with writers running concurrently, as happens
+where operations against different workshop environments run in parallel,
+and with writes serialized by a lock within the process, as the training
+portal does when using SQLite. With concurrent writers, a transaction which
+reads and then writes fails immediately with "database is locked" if another
+transaction wrote in between, regardless of the busy timeout.
+
+Run from the training portal directory:
+
+    python scripts/benchmark_sqlite.py --threads 8 --operations 500
+
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from project.apps.workshops.database import (  # pylint: disable=wrong-import-position
+    SQLITE_TUNING_PRAGMAS,
+)
+
+STARTING, WAITING, RUNNING, STOPPING, STOPPED = 1, 2, 3, 4, 5
+
+SCHEMA = """
+CREATE TABLE session (
+    name TEXT PRIMARY KEY,
+    environment_id INTEGER NOT NULL,
+    owner_id INTEGER NULL,
+    state INTEGER NOT NULL,
+    started TEXT NULL,
+    expires TEXT NULL
+);
+CREATE INDEX session_environment_id ON session (environment_id);
+CREATE INDEX session_owner_id ON session (owner_id);
+"""
+
+
+def connect(path, tuned):
+    # Django leaves the Python default timeout of 5 seconds when waiting on
+    # the write lock. When tuned the busy timeout pragma overrides it.
+
+    connection = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+
+    if tuned:
+        for pragma in SQLITE_TUNING_PRAGMAS:
+            connection.execute(pragma)
+
+    return connection
+
+
+def seed(path, environments, sessions):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+
+    rows = []
+
+    for environment in range(environments):
+        for index in range(sessions):
+            state = random.choice((WAITING, RUNNING, STOPPED))
+            owner = None if state == WAITING else random.randint(1, 10000)
+            rows.append((f"s-{environment}-{index}", environment, owner, state))
+
+    connection.executemany(
+        "INSERT INTO session (name, environment_id, owner_id, state) "
+        "VALUES (?, ?, ?, ?)",
+        rows,
+    )
+
+    connection.commit()
+    connection.close()
+
+
+def read(connection, environments, user):
+    environment = random.randrange(environments)
+
+    connection.execute(
+        "SELECT COUNT(*) FROM session WHERE environment_id = ? "
+        "AND owner_id IS NULL AND state = ?",
+        (environment, WAITING),
+    ).fetchone()
+
+    connection.execute(
+        "SELECT * FROM session WHERE owner_id = ? AND state != ?",
+        (user, STOPPED),
+    ).fetchall()
+
+
+def write(connection, environments, user, counter):
+    environment = random.randrange(environments)
+
+    connection.execute("BEGIN")
+
+    try:
+        row = connection.execute(
+            "SELECT name FROM session WHERE environment_id = ? "
+            "AND owner_id IS NULL AND state = ? LIMIT 1",
+            (environment, WAITING),
+        ).fetchone()
+
+        if row:
+            connection.execute(
+                "UPDATE session SET owner_id = ?, state = ?, started = "
+                "datetime('now') WHERE name = ?",
+                (user, RUNNING, row[0]),
+            )
+
+        connection.execute(
+            "INSERT INTO session (name, environment_id, state) VALUES (?, ?, ?)",
+            (f"r-{threading.get_ident()}-{next(counter)}", environment, WAITING),
+        )
+
+        connection.execute("COMMIT")
+
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def worker(path, tuned, write_lock, options, results):
+    connection = connect(path, tuned)
+    counter = iter(range(sys.maxsize))
+
+    for _ in range(options.operations):
+        user = random.randint(1, 10000)
+        operation = "write" if random.random() < options.writes else "read"
+
+        start = time.perf_counter()
+
+        try:
+            if operation == "write":
+                with write_lock or contextlib.nullcontext():
+                    write(connection, options.environments, user, counter)
+            else:
+                read(connection, options.environments, user)
+
+        except sqlite3.OperationalError:
+            results.setdefault(f"{operation} locked", []).append(1)
+            continue
+
+        results.setdefault(operation, []).append(time.perf_counter() - start)
+
+    connection.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000.0
+
+
+def run(tuned, serialized, options):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "db.sqlite3")
+
+        seed(path, options.environments, options.sessions)
+
+        results = {}
+
+        write_lock = threading.Lock() if serialized else None
+
+        threads = [
+            threading.Thread(
+                target=worker, args=(path, tuned, write_lock, options, results)
+            )
+            for _ in range(options.threads)
+        ]
+
+        start = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{'tuned' if tuned else 'default'}, "
+        f"{'serialized' if serialized else 'concurrent'} writers ({elapsed:.2f}s)"
+    )
+
+    for operation in ("read", "write"):
+        values = results.get(operation, [])
+
+        if values:
+            print(
+                f"  {operation:5} count={len(values):6} "
+                f"p50={percentile(values, 0.5):8.2f}ms "
+                f"p99={percentile(values, 0.99):8.2f}ms"
+            )
+
+    for operation in ("read", "write"):
+        print(f"  {operation:5} locked={len(results.get(f'{operation} locked', [])):6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=500)
+    parser.add_argument("--writes", type=float, default=0.2)
+    parser.add_argument("--environments", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=1000)
+
+    options = parser.parse_args()
+
+    for tuned in (False, True):
+        for serialized in (False, True):
+            run(tuned, serialized, options)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 from datetime import timedelta
 
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
 from django.utils import timezone
+from django.utils.functional import cached_property
 
 from .models import (
     TrainingPortal,
@@ -13,6 +16,38 @@ from .models import (
 )
 
 
+class EstimatedCountPaginator(Paginator):
+    """Paginator which, for a large table in a PostgreSQL database, uses the
+    estimate of the number of rows maintained by the database in place of
+    counting them, where the list isn't filtered.
+
+    """
+
+    # Estimated number of rows below which the rows are counted anyway.
+
+    EXACT_COUNT_THRESHOLD = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+
+        connection = connections[queryset.db]
+
+        if connection.vendor == "postgresql" and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table],
+                )
+
+                row = cursor.fetchone()
+
+            if row and row[0] >= self.EXACT_COUNT_THRESHOLD:
+                return int(row[0])
+
+        return super().count
+
+
 class TrainingPortalAdmin(admin.ModelAdmin):
     list_display = [
         "name",
@@ -73,6 +108,9 @@ class WorkshopAdmin(admin.ModelAdmin):
 
 
 class EnvironmentAdmin(admin.ModelAdmin):
+    # The counts of workshop sessions shown are maintained as counters on the
+    # workshop environment, so listing them doesn't query workshop sessions.
+
     list_display = [
         "name",
         "uid",
@@ -85,6 +123,8 @@ class EnvironmentAdmin(admin.ModelAdmin):
         "tally",
     ]
 
+    show_full_result_count = False
+
     fields = [
         "workshop_link",
         "name",
@@ -139,6 +179,48 @@ class EnvironmentAdmin(admin.ModelAdmin):
     refresh_environments.short_description = "Refresh Environments"
 
 
+class EnvironmentNameFilter(admin.SimpleListFilter):
+    """Filters workshop sessions by the name of the workshop environment,
+    with the choices coming from the workshop environments rather than from
+    the distinct values across all workshop sessions.
+
+    """
+
+    title = "environment name"
+    parameter_name = "environment__name"
+
+    def lookups(self, request, model_admin):
+        names = Environment.objects.order_by("name").values_list("name", flat=True)
+        return [(name, name) for name in names.distinct()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(environment__name=self.value())
+        return queryset
+
+
+class WorkshopNameFilter(admin.SimpleListFilter):
+    """Filters workshop sessions by the name of the workshop, with the
+    choices coming from the workshop environments rather than from the
+    distinct values across all workshop sessions.
+
+    """
+
+    title = "workshop name"
+    parameter_name = "environment__workshop_name"
+
+    def lookups(self, request, model_admin):
+        names = Environment.objects.order_by("workshop_name").values_list(
+            "workshop_name", flat=True
+        )
+        return [(name, name) for name in names.distinct()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(environment__workshop_name=self.value())
+        return queryset
+
+
 class SessionAdmin(admin.ModelAdmin):
     list_display = [
         "name",
@@ -151,7 +233,13 @@ class SessionAdmin(admin.ModelAdmin):
         "remaining_time_as_string",
     ]
 
-    list_filter = ["environment__name", "environment__workshop_name"]
+    list_filter = [EnvironmentNameFilter, WorkshopNameFilter]
+
+    list_select_related = ["environment__workshop", "owner"]
+
+    paginator = EstimatedCountPaginator
+
+    show_full_result_count = False
 
     fields = [
         "name",
@@ -192,22 +280,28 @@ class SessionAdmin(admin.ModelAdmin):
         return actions
 
     def expire_sessions(self, request, queryset):
+        now = timezone.now()
+
+        sessions = []
+
         for session in queryset:
             if session.is_allocated():
                 if session.state != SessionState.STOPPING:
                     session.state = SessionState.STOPPING
-                    session.expires = session.deadline = timezone.now() + timedelta(
-                        minutes=1
-                    )
-                    session.save()
+                    session.expires = now + timedelta(minutes=1)
+                    sessions.append(session)
             elif session.is_available():
                 session.state = SessionState.STOPPING
-                session.expires = session.deadline = timezone.now()
-                session.save()
+                session.expires = now
+                sessions.append(session)
+
+        Session.bulk_update_sessions(sessions, ["state", "expires"])
 
     expire_sessions.short_description = "Expire Sessions"
 
     def extend_sessions(self, request, queryset, minutes):
+        sessions = []
+
         for session in queryset:
             if session.is_allocated() and session.expires:
                 if session.state == SessionState.STOPPING:
@@ -215,7 +309,9 @@ class SessionAdmin(admin.ModelAdmin):
                 session.expires += timedelta(minutes=minutes)
                 if session.expires > session.started + session.environment.deadline:
                     session.expires = session.started + session.environment.deadline
-                session.save()
+                sessions.append(session)
+
+        Session.bulk_update_sessions(sessions, ["state", "expires"])
 
     def extend_sessions_10m(self, request, queryset):
         self.extend_sessions(request, queryset, 10)
@@ -233,9 +329,11 @@ class SessionAdmin(admin.ModelAdmin):
     extend_sessions_60m.short_description = "Extend Sessions (60m)"
 
     def purge_sessions(self, request, queryset):
-        for session in queryset:
-            if session.is_stopped():
-                session.delete()
+        names = queryset.filter(state=SessionState.STOPPED).values_list(
+            "name", flat=True
+        )
+
+        Session.bulk_delete_sessions(names)
 
     purge_sessions.short_description = "Purge Sessions"
 
@@ -10,3 +10,20 @@ class WorkshopsConfig(AppConfig):
 
     name = "project.apps.workshops"
     default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel,unused-import
+
+        # Register handlers for tracking changes to the catalog.
+
+        from . import caching
+
+        # Register handlers for invalidating cached access tokens.
+
+        from . import authorization
+
+        # Register handlers for tuning database connections.
+
+        from .database import register_database_tuning
+
+        register_database_tuning()
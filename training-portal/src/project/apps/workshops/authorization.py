@@ -0,0 +1,210 @@
+"""Defines a cache of the access tokens used to authenticate requests to the
+REST API, along with whether the user the access token belongs to is a robot
+account. The robot client polls the REST API frequently, so this avoids
+querying the database for the access token, the user and their groups on
+every request.
+
+Cached access tokens are discarded after a short time, and when the access
+token is revoked or the user or their groups are changed. Where there are
+multiple replicas of the training portal, changes made by another replica
+wouldn't be seen, so access tokens aren't cached.
+
+"""
+
+import copy
+import time
+import threading
+import collections
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from oauth2_provider.decorators import (
+    protected_resource as oauth2_protected_resource,
+)
+from oauth2_provider.models import AccessToken
+from oauth2_provider.oauth2_validators import OAuth2Validator
+
+
+CachedAccessToken = collections.namedtuple(
+    "CachedAccessToken", "access_token robot expires"
+)
+
+
+class AccessTokenCache:
+    """Bounded cache of access tokens, including the application and user
+    they belong to. Copies of the cached access token are returned so that
+    changes made to them while handling a request aren't seen by others.
+
+    """
+
+    def __init__(self, maximum=256, lifetime=30.0):
+        self._lock = threading.Lock()
+        self._maximum = maximum
+        self._lifetime = lifetime
+        self._entries = collections.OrderedDict()
+
+    def get(self, token):
+        """Returns a copy of the cached access token, or None if not cached."""
+
+        if settings.PORTAL_REPLICAS > 1:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(token)
+
+            if entry is None:
+                return None
+
+            if entry.expires <= time.monotonic():
+                del self._entries[token]
+                return None
+
+            self._entries.move_to_end(token)
+
+        access_token = copy.deepcopy(entry.access_token)
+
+        if access_token.user is not None:
+            access_token.user.robot_account = entry.robot
+
+        return access_token
+
+    def put(self, access_token):
+        """Caches the access token, which must have been loaded along with
+        the application and user it belongs to.
+
+        """
+
+        if settings.PORTAL_REPLICAS > 1:
+            return
+
+        # Access tokens issued using client credentials have no user, so
+        # can't be for a robot account.
+
+        robot = access_token.user is not None and is_robot_account(access_token.user)
+
+        entry = CachedAccessToken(
+            copy.deepcopy(access_token), robot, time.monotonic() + self._lifetime
+        )
+
+        with self._lock:
+            self._entries[access_token.token] = entry
+            self._entries.move_to_end(access_token.token)
+
+            while len(self._entries) > self._maximum:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token=None, user_id=None):
+        """Discards the cached access token, or those belonging to the user.
+        If neither is supplied all cached access tokens are discarded.
+
+        """
+
+        with self._lock:
+            if token is not None:
+                self._entries.pop(token, None)
+
+            elif user_id is not None:
+                for key, entry in list(self._entries.items()):
+                    if entry.access_token.user_id == user_id:
+                        del self._entries[key]
+
+            else:
+                self._entries.clear()
+
+
+access_tokens = AccessTokenCache()
+
+
+def is_robot_account(user):
+    """Returns whether the user is a robot account, being a member of the
+    robots group. The result is remembered against the user, so for a user
+    authenticated using a cached access token no query is required.
+
+    """
+
+    robot = getattr(user, "robot_account", None)
+
+    if robot is None:
+        robot = user.groups.filter(name="robots").exists()
+        user.robot_account = robot
+
+    return robot
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+    """Validator for OAuth requests which looks up access tokens in the cache
+    before querying the database.
+
+    """
+
+    def _load_access_token(self, token):
+        access_token = access_tokens.get(token)
+
+        if access_token is None:
+            access_token = super()._load_access_token(token)
+
+            if access_token is not None:
+                access_tokens.put(access_token)
+
+        return access_token
+
+
+def protected_resource(scopes=None):
+    """Decorator for protecting views with OAuth, the same as that provided
+    by the OAuth provider, but which looks up access tokens in the cache.
+
+    """
+
+    return oauth2_protected_resource(scopes, validator_cls=CachedOAuth2Validator)
+
+
+def _invalidate(**kwargs):
+    # Discard the cached access tokens immediately, and again once the
+    # transaction is committed, so that any loaded in between can't be left
+    # cached.
+
+    access_tokens.invalidate(**kwargs)
+
+    transaction.on_commit(lambda: access_tokens.invalidate(**kwargs))
+
+
+def _access_token_changed(instance, **_):
+    _invalidate(token=instance.token)
+
+
+def _user_changed(instance, **_):
+    _invalidate(user_id=instance.pk)
+
+
+def _group_deleted(**_):
+    _invalidate()
+
+
+def _user_groups_changed(instance, action, reverse, pk_set, **_):
+    if not action.startswith("post_"):
+        return
+
+    if not reverse:
+        _invalidate(user_id=instance.pk)
+
+    elif pk_set:
+        for user_id in pk_set:
+            _invalidate(user_id=user_id)
+
+    else:
+        _invalidate()
+
+
+post_save.connect(_access_token_changed, sender=AccessToken)
+post_delete.connect(_access_token_changed, sender=AccessToken)
+
+post_save.connect(_user_changed, sender=get_user_model())
+post_delete.connect(_user_changed, sender=get_user_model())
+
+post_delete.connect(_group_deleted, sender=Group)
+
+m2m_changed.connect(_user_groups_changed, sender=get_user_model().groups.through)
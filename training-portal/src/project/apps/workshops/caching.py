@@ -0,0 +1,253 @@
+"""Defines caches for responses which are expensive to generate but which
+only change when the configuration of the training portal, or the workshop
+environments and workshop sessions, change.
+
+Cached responses are keyed on a catalog version which is incremented after
+any transaction which changed a workshop, workshop environment or the
+training portal configuration, or changed the counts of workshop sessions,
+is committed. The catalog version is held in memory, relying on all requests
+being handled, and all changes being made, by the one process. Where there
+are multiple replicas of the training portal this doesn't hold, so responses
+aren't cached, with the ETag instead being derived from the content.
+
+The configuration of the training portal itself is cached, being reloaded
+only after it is next saved.
+
+Files from the theme for the training portal are also cached, being reloaded
+only when the file has changed.
+
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import threading
+import collections
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+
+class CatalogVersion:
+    """Monotonically increasing version number for the catalog. The ETag
+    generated from it includes a value unique to the process so that clients
+    holding an ETag from before a restart will not see a match.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch = uuid.uuid4().hex[:12]
+        self._version = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def increment(self):
+        with self._lock:
+            self._version += 1
+
+    def etag(self, version):
+        return f'"{self._epoch}-{version}"'
+
+
+catalog_version = CatalogVersion()
+
+
+def catalog_changed():
+    """Flags that the catalog has changed. The catalog version is only
+    incremented once the current transaction has been committed, so requests
+    can't cache a response generated before the change is visible.
+
+    """
+
+    transaction.on_commit(catalog_version.increment)
+
+
+def _catalog_model_changed(**_):
+    catalog_changed()
+
+
+for _sender in (
+    "workshops.TrainingPortal",
+    "workshops.Workshop",
+    "workshops.Environment",
+):
+    post_save.connect(_catalog_model_changed, sender=_sender)
+    post_delete.connect(_catalog_model_changed, sender=_sender)
+
+
+CachedResponse = collections.namedtuple("CachedResponse", "version etag content")
+
+
+class ResponseCache:
+    """Bounded cache of serialized responses tagged with the catalog version
+    they were generated for. Entries generated for an older catalog version
+    are treated as missing.
+
+    """
+
+    def __init__(self, maximum=64):
+        self._lock = threading.Lock()
+        self._maximum = maximum
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Returns the cached response for the current catalog version."""
+
+        if settings.PORTAL_REPLICAS > 1:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            if entry.version != catalog_version.version:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+
+            return entry
+
+    def put(self, key, version, content):
+        """Caches the response generated for the specified catalog version.
+        The catalog version must have been read before generating it.
+
+        """
+
+        if settings.PORTAL_REPLICAS > 1:
+            etag = hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+            return CachedResponse(version, f'"{etag}"', content)
+
+        entry = CachedResponse(version, catalog_version.etag(version), content)
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._maximum:
+                self._entries.popitem(last=False)
+
+        return entry
+
+
+catalog_responses = ResponseCache()
+
+
+catalog_fragments = ResponseCache()
+
+
+class CachedTrainingPortal:
+    """Copy of the training portal configuration shared by views and manager
+    functions, which must treat it as read only. The cached copy is discarded
+    when the training portal is saved, and again once the transaction which
+    saved it is committed, so that a copy loaded in between can't be left
+    cached. Where there are multiple replicas of the training portal, saves
+    made by another replica wouldn't be seen, so it isn't cached.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._portal = None
+        self._invalidations = 0
+
+    def get(self):
+        """Returns the training portal, raising DoesNotExist if it hasn't yet
+        been created.
+
+        """
+
+        from .models import (  # pylint: disable=import-outside-toplevel
+            TrainingPortal,
+        )
+
+        if settings.PORTAL_REPLICAS > 1:
+            return TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+
+        with self._lock:
+            portal = self._portal
+            invalidations = self._invalidations
+
+        if portal is None:
+            portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+
+            # Don't cache what was loaded if the cached copy was discarded
+            # while it was being loaded, as it may predate the change.
+
+            with self._lock:
+                if self._invalidations == invalidations:
+                    self._portal = portal
+
+        return portal
+
+    def invalidate(self):
+        with self._lock:
+            self._portal = None
+            self._invalidations += 1
+
+
+training_portal = CachedTrainingPortal()
+
+
+def _training_portal_changed(**_):
+    training_portal.invalidate()
+
+    transaction.on_commit(training_portal.invalidate)
+
+
+post_save.connect(_training_portal_changed, sender="workshops.TrainingPortal")
+post_delete.connect(_training_portal_changed, sender="workshops.TrainingPortal")
+
+
+class ThemeFile:
+    """Content of a file from the theme for the training portal. The file is
+    read when first required and is then only read again if it changes. To
+    avoid checking the file on every request, checks for changes are made at
+    most once per interval. If the file doesn't exist the content is empty.
+
+    """
+
+    def __init__(self, path, interval=5.0):
+        self._lock = threading.Lock()
+        self._path = path
+        self._interval = interval
+        self._checked = None
+        self._stamp = None
+        self._content = ""
+
+    def content(self):
+        now = time.monotonic()
+
+        with self._lock:
+            if self._checked is not None and now - self._checked < self._interval:
+                return self._content
+
+            self._checked = now
+
+            try:
+                details = os.stat(self._path)
+                stamp = (details.st_mtime_ns, details.st_size, details.st_ino)
+
+                if stamp != self._stamp:
+                    with open(self._path, encoding="utf-8") as fp:
+                        self._content = fp.read()
+
+                    self._stamp = stamp
+
+            except OSError:
+                self._stamp = None
+                self._content = ""
+
+            return self._content
+
+
+THEME_DIRECTORY = "/opt/app-root/static/theme"
+
+portal_head_html = ThemeFile(os.path.join(THEME_DIRECTORY, "training-portal.html"))
@@ -0,0 +1,39 @@
+"""Defines tuning of database connections for the training portal.
+
+"""
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+# Settings applied to each SQLite database connection when tuning is enabled.
+# Write ahead logging means readers no longer block behind a writer and vice
+# versa. With write ahead logging it is safe to only sync at checkpoints. The
+# busy timeout is how long in milliseconds a connection waits on the write
+# lock before failing, and memory mapped I/O avoids copying pages read from
+# the database file.
+
+SQLITE_TUNING_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=20000",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def tune_sqlite_connection(sender, connection, **_):
+    """Applies the tuning settings to a new SQLite database connection."""
+
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        for pragma in SQLITE_TUNING_PRAGMAS:
+            cursor.execute(pragma)
+
+
+def register_database_tuning():
+    """Registers tuning of database connections if enabled."""
+
+    if settings.DATABASE_TUNED:
+        connection_created.connect(tune_sqlite_connection)
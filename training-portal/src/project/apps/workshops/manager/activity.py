@@ -0,0 +1,159 @@
+"""Defines a prober for querying the idle time of workshop sessions. Queries
+are made asynchronously from the asyncio loop used by kopf, with the results
+cached so that checks for orphaned workshop sessions never need to wait on
+network requests to the workshop session instances.
+
+"""
+
+import time
+import asyncio
+import logging
+import threading
+
+import kopf
+import aiohttp
+
+from .operator import schedule_coroutine
+
+
+# Maximum number of requests against workshop session instances which can be
+# in progress at the one time, and the timeouts applied to each request.
+
+PROBE_CONCURRENCY = 10
+
+PROBE_CONNECT_TIMEOUT = 2.5
+PROBE_TOTAL_TIMEOUT = 5.0
+
+# Maximum age of a cached idle time before it is no longer used when checking
+# whether a workshop session has been orphaned.
+
+PROBE_RESULT_MAX_AGE = 60.0
+
+
+class ActivityProber:
+    """Queries the idle time of workshop sessions and caches the results.
+    Refreshing the idle times is requested from any thread, but the requests
+    are always made from the asyncio loop used by kopf using a pooled HTTP
+    client. Any refresh for a workshop session still in progress when a
+    further refresh is requested is not duplicated.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}
+        self._pending = set()
+        self._client = None
+        self._semaphore = None
+
+    def idle_time(self, name, max_age=PROBE_RESULT_MAX_AGE):
+        """Returns the cached idle time in seconds for the workshop session,
+        or None if there is no recent successful result.
+
+        """
+
+        with self._lock:
+            result = self._results.get(name)
+
+        if result is None:
+            return None
+
+        idle_time, fetched = result
+
+        if time.monotonic() - fetched > max_age:
+            return None
+
+        return idle_time
+
+    def refresh(self, targets):
+        """Requests that the idle times of the workshop sessions be refreshed.
+        The targets are a dictionary mapping the name of the workshop session
+        to the URL for querying its activity. Cached results for any workshop
+        session not in the targets are discarded. Returns immediately without
+        waiting for the requests to be made.
+
+        """
+
+        with self._lock:
+            for name in list(self._results):
+                if name not in targets:
+                    del self._results[name]
+
+            targets = {
+                name: url for name, url in targets.items() if name not in self._pending
+            }
+
+            self._pending.update(targets)
+
+        if targets:
+            schedule_coroutine(self._refresh(targets))
+
+    def _get_client(self):
+        # The HTTP client and semaphore must be created from within the
+        # asyncio loop which will be using them.
+
+        if self._client is None or self._client.closed:
+            self._semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+            self._client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=PROBE_CONCURRENCY),
+                timeout=aiohttp.ClientTimeout(
+                    total=PROBE_TOTAL_TIMEOUT, connect=PROBE_CONNECT_TIMEOUT
+                ),
+            )
+
+        return self._client
+
+    async def close(self):
+        """Closes the HTTP client if one has been created."""
+
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def _refresh(self, targets):
+        client = self._get_client()
+
+        await asyncio.gather(
+            *(self._probe(client, name, url) for name, url in targets.items())
+        )
+
+    async def _probe(self, client, name, url):
+        try:
+            async with self._semaphore:
+                async with client.get(url) as response:
+                    if response.status != 200:
+                        # XXX If we don't get a valid response then not
+                        # currently doing anything. Need a better method to
+                        # determine if was running but has since failed in
+                        # some way and become uncontactable.
+
+                        return
+
+                    data = await response.json(content_type=None)
+
+            with self._lock:
+                self._results[name] = (float(data["idle-time"]), time.monotonic())
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # XXX This can just be because it is slow to start up. Need a
+            # better method to determine if was running but has since failed
+            # in some way and become uncontactable.
+
+            logging.warning("Cannot connect to workshop session %s.", name)
+
+        except Exception:  # pylint: disable=broad-except
+            logging.exception(
+                "Failed to query idle time for workshop session %s.", name
+            )
+
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+
+activity_prober = ActivityProber()
+
+
+@kopf.on.cleanup()
+async def close_activity_prober(**_):
+    await activity_prober.close()
@@ -1,19 +1,305 @@
+"""Defines functions for reporting analytics events to a webhook.
+
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
 import logging
+import threading
 
 import requests
 
 from django.conf import settings
 from django.utils import timezone
 
-from .operator import background_task
+from .metrics import (
+    analytics_events_queued,
+    analytics_events_delivered,
+    analytics_events_spooled,
+    analytics_events_dropped,
+)
+
+# Limits on the queue of analytics events waiting to be delivered. When
+# batching is enabled, the worker waits up to the flush interval for further
+# events before posting a batch.
+
+ANALYTICS_QUEUE_SIZE = 1000
+ANALYTICS_BATCH_SIZE = 50
+ANALYTICS_FLUSH_INTERVAL = 1.0
+
+# Failed requests to the webhook are retried with exponential backoff. Once
+# the attempts are exhausted events are appended to the spool file, up to a
+# maximum size, and replayed after the next successful delivery. An unexpected
+# error delivering events also results in them being spooled.
+
+ANALYTICS_REQUEST_TIMEOUT = 2.5
+ANALYTICS_DELIVERY_ATTEMPTS = 4
+ANALYTICS_RETRY_BACKOFF = 0.5
+
+ANALYTICS_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+
+class AnalyticsDelivery:
+    """Delivers analytics events to the webhook from a single worker thread,
+    fed by a bounded queue. The worker reuses a pooled HTTP session for all
+    requests. Events which can't be queued or delivered are spooled to a
+    file, and dropped only if they can't be spooled either.
+
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(ANALYTICS_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        self._thread = None
+        self._session = None
+
+        # Whether there may be events in the spool file waiting to be
+        # replayed. This starts out set as the spool file may have been left
+        # by a previous process.
+
+        self._spooled = True
+
+    def depth(self):
+        """Returns the number of analytics events waiting to be delivered."""
+
+        return self._queue.qsize()
+
+    def submit(self, message):
+        """Queues an analytics event for delivery to the webhook."""
+
+        self._start()
+
+        try:
+            self._queue.put_nowait(message)
+
+        except queue.Full:
+            self._spool([message])
+
+    def flush(self):
+        """Spools any analytics events still waiting to be delivered, so they
+        are not lost when the process exits.
+
+        """
+
+        messages = []
+
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if messages:
+            self._spool(messages)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                atexit.register(self.flush)
+
+            # The worker thread should never exit, but if it has died it is
+            # restarted so events don't sit in the queue undelivered.
+
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    logging.error("Restarting analytics delivery worker.")
+
+                self._thread = threading.Thread(
+                    target=self._run, name="analytics-delivery", daemon=True
+                )
+
+                self._thread.start()
+
+    def _run(self):
+        self._session = requests.Session()
+
+        while True:
+            batch = [self._queue.get()]
+
+            # Only wait for further events when batching, otherwise just
+            # take what has already been queued.
+
+            deadline = time.monotonic() + ANALYTICS_FLUSH_INTERVAL
+
+            while len(batch) < ANALYTICS_BATCH_SIZE:
+                try:
+                    if settings.ANALYTICS_WEBHOOK_BATCH:
+                        timeout = deadline - time.monotonic()
+
+                        if timeout <= 0:
+                            break
+
+                        batch.append(self._queue.get(timeout=timeout))
+
+                    else:
+                        batch.append(self._queue.get_nowait())
+
+                except queue.Empty:
+                    break
+
+            try:
+                delivered = self._deliver(batch)
+
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Unexpected error delivering analytics events.")
+
+                self._spool(batch)
+
+                continue
+
+            if delivered and self._spooled:
+                try:
+                    self._replay()
+
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Unexpected error replaying analytics events.")
+
+    def _deliver(self, messages):
+        """Delivers the analytics events, spooling any which couldn't be
+        delivered. Returns whether the webhook accepted the requests.
+
+        """
+
+        if settings.ANALYTICS_WEBHOOK_BATCH:
+            posts = [(messages, {"events": messages})]
+        else:
+            posts = [([message], message) for message in messages]
+
+        for index, (included, payload) in enumerate(posts):
+            if not self._post(payload, len(included)):
+                self._spool(
+                    [message for pending, _ in posts[index:] for message in pending]
+                )
+
+                return False
+
+        return True
+
+    def _post(self, payload, count):
+        """Posts the payload to the webhook, retrying on failure. Returns
+        false if the request should be tried again later.
+
+        """
+
+        delay = ANALYTICS_RETRY_BACKOFF
+
+        for attempt in range(ANALYTICS_DELIVERY_ATTEMPTS):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+
+            try:
+                response = self._session.post(
+                    settings.ANALYTICS_WEBHOOK_URL,
+                    json=payload,
+                    timeout=ANALYTICS_REQUEST_TIMEOUT,
+                )
+
+            except requests.RequestException:
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                continue
+
+            # Don't retry requests the webhook rejected, as the same events
+            # would only be rejected again.
+
+            if response.status_code >= 400:
+                logging.error(
+                    "Analytics webhook rejected %d events with status %d.",
+                    count,
+                    response.status_code,
+                )
+
+                analytics_events_dropped.inc(count)
+
+            else:
+                analytics_events_delivered.inc(count)
+
+            return True
+
+        logging.error("Unable to report %d events to analytics webhook.", count)
+
+        return False
+
+    def _spool(self, messages):
+        path = settings.ANALYTICS_SPOOL_FILE
+
+        with self._spool_lock:
+            try:
+                if os.path.exists(path):
+                    if os.path.getsize(path) >= ANALYTICS_SPOOL_MAX_SIZE:
+                        raise OSError(f"Spool file {path} is full")
+
+                with open(path, "a", encoding="utf-8") as fp:
+                    for message in messages:
+                        fp.write(json.dumps(message) + "\n")
+
+            except (OSError, TypeError, ValueError):
+                logging.exception("Dropping %d analytics events.", len(messages))
+
+                analytics_events_dropped.inc(len(messages))
+
+                return
+
+            self._spooled = True
+
+        analytics_events_spooled.inc(len(messages))
+
+    def _replay(self):
+        """Delivers any analytics events held in the spool file."""
+
+        path = settings.ANALYTICS_SPOOL_FILE
+        replay_path = f"{path}.replay"
+
+        # The spool file is first moved aside, so events spooled while these
+        # are being delivered go into a new spool file. A file left from
+        # when a prior replay was interrupted is delivered first.
+
+        with self._spool_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(path):
+                    self._spooled = False
+                    return
+
+                os.replace(path, replay_path)
+
+        messages = []
+
+        with open(replay_path, encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:
+                    pass
+
+        # The replay file is only removed once the events in it have been
+        # delivered or returned to the spool file, so that they aren't lost
+        # if delivery fails unexpectedly or the process exits part way.
+
+        start = 0
+
+        try:
+            for start in range(0, len(messages), ANALYTICS_BATCH_SIZE):
+                if not self._deliver(messages[start : start + ANALYTICS_BATCH_SIZE]):
+                    self._spool(messages[start + ANALYTICS_BATCH_SIZE :])
+                    break
+
+        except Exception:
+            self._spool(messages[start:])
+            os.unlink(replay_path)
+            raise
+
+        os.unlink(replay_path)
+
 
+analytics_delivery = AnalyticsDelivery()
 
-@background_task
-def send_event_to_webhook(url, message):
-    try:
-        requests.post(url, json=message, timeout=2.5)
-    except Exception:
-        logging.exception("Unable to report event to %s: %s", url, message)
+analytics_events_queued.set_function(analytics_delivery.depth)
 
 
 def report_analytics_event(entity, event, data={}):
@@ -84,4 +370,4 @@ def report_analytics_event(entity, event, data={}):
         }
 
     if message:
-        send_event_to_webhook(settings.ANALYTICS_WEBHOOK_URL, message).schedule()
+        analytics_delivery.submit(message)
@@ -9,19 +9,27 @@ import logging
 from datetime import timedelta
 
 import pykube
-import requests
 
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
-from ..models import SessionState, Session
+from ..models import SessionState, Session, Environment
 
 from .sessions import replace_reserved_session
-from .locking import resources_lock
+from .locking import resources_lock, environment_lock, session_lock
 from .operator import background_task
 from .analytics import report_analytics_event
+from .informers import workshop_session_index
+from .activity import activity_prober
+from .metrics import (
+    cleanup_sessions_deleted,
+    cleanup_users_deleted,
+    cleanup_last_completed,
+    kubernetes_request_duration,
+)
 
 
 api = pykube.HTTPClient(pykube.KubeConfig.from_env())
@@ -31,125 +39,126 @@ api = pykube.HTTPClient(pykube.KubeConfig.from_env())
 @resources_lock
 @transaction.atomic
 def purge_expired_workshop_sessions():
-    """Look for workshop sessions which have expired and delete them."""
+    """Look for workshop sessions which were deleted manually or which have
+    been orphaned and delete them.
 
-    now = timezone.now()
-
-    # Loop over all records of workshop sessions in the database and check
-    # whether any should be deleted and/or marked as stopped.
-
-    K8SWorkshopSession = pykube.object_factory(
-        api, f"training.{settings.OPERATOR_API_GROUP}/v1beta1", "WorkshopSession"
-    )
-
-    for session in Session.objects.all():
-        if not session.is_starting() and not session.is_stopped():
-            # If the workshop session isn't still starting, and hasn't stopped
-            # yet, check to see whether there is a deployed workshop session.
-            # If there isn't, it means it was deleted manually. In this case
-            # trigger a task to clean up the workshop session. In this case
-            # there will be no deployment to delete, but still have to mark
-            # the workshop session as deleted in the database.
+    """
 
-            try:
-                K8SWorkshopSession.objects(api).get(name=session.name)
+    # Determine the set of deployed workshop sessions from the index kept up
+    # to date by watching the resources. If the index hasn't yet been
+    # confirmed against a full listing of the resources, we skip checking for
+    # workshop sessions which were deleted manually until the next time.
 
-            except pykube.exceptions.ObjectDoesNotExist:
-                logging.info("Session %s missing. Cleanup session.", session.name)
+    deployed = None
 
-                report_analytics_event(session, "Session/Vanished")
+    if workshop_session_index.is_synced():
+        deployed = workshop_session_index.names()
 
-                delete_workshop_session(session).schedule()
+    # Collect the workshop sessions for which the idle time is required when
+    # checking whether they have been orphaned.
 
-                continue
+    probe_targets = {}
 
-            except pykube.exceptions.PyKubeError:
-                pass
+    # Loop over all records of workshop sessions in the database which
+    # haven't yet stopped and check whether any should be deleted.
 
-        if session.is_allocated() or session.is_stopping():
-            # If the workshop session is in use, including where it has been
-            # explicitly marked for expiration, if expiration time has been
-            # reached we need to delete it. If expiration time hasn't been
-            # reached and there is an inactivity timeout, check that it hasn't
-            # been orhpaned.
+    sessions = Session.objects.exclude(state=SessionState.STOPPED)
 
-            if session.expires and session.expires <= now:
-                logging.info("Session %s expired. Deleting session.", session.name)
+    for session in sessions.select_related("environment"):
+        if (
+            deployed is not None
+            and not session.is_starting()
+            and not session.is_stopped()
+            and session.name not in deployed
+        ):
+            # If the workshop session isn't still starting, and hasn't stopped
+            # yet, and there is no deployed workshop session, it means it was
+            # deleted manually. In this case trigger a task to clean up the
+            # workshop session. In this case there will be no deployment to
+            # delete, but still have to mark the workshop session as deleted
+            # in the database.
 
-                report_analytics_event(session, "Session/Expired")
+            logging.info("Session %s missing. Cleanup session.", session.name)
 
-                delete_workshop_session(session).schedule()
+            report_analytics_event(session, "Session/Vanished")
 
-            elif session.environment.orphaned:
-                try:
-                    # Query the idle time from the workshop session instance.
-                    # Use the internal Kubernetes service for accessing the
-                    # workshop instance as will fail if use public ingress and
-                    # using a self signed CA as not currently injected such a
-                    # CA into the training portal pod.
+            delete_workshop_session(session).schedule()
 
-                    # host = f"{session.name}.{settings.INGRESS_DOMAIN}"
-                    # url = f"{settings.INGRESS_PROTOCOL}://{host}/session/activity"
+            continue
 
-                    url = f"http://{session.name}.{session.environment.name}/session/activity"
+        if session.is_allocated() or session.is_stopping():
+            # If the workshop session is in use and there is an inactivity
+            # timeout, check that it hasn't been orphaned. Workshop sessions
+            # which have expired are deleted by the reconciler when the time
+            # they expire is reached, so aren't dealt with here.
 
-                    response = requests.get(url)
+            if session.environment.orphaned:
+                # Check the idle time last reported by the workshop session
+                # instance. Use the internal Kubernetes service for accessing
+                # the workshop instance as will fail if use public ingress and
+                # using a self signed CA as not currently injected such a CA
+                # into the training portal pod. The idle time is queried in
+                # the background so we aren't waiting on the workshop session
+                # instance while holding the lock.
 
-                    if response.status_code == 200:
-                        # If got a response and we have exceeded the
-                        # inactivity timeout then trigger deletion of the
-                        # workshop session.
+                # host = f"{session.name}.{settings.INGRESS_DOMAIN}"
+                # url = f"{settings.INGRESS_PROTOCOL}://{host}/session/activity"
 
-                        idle_time = timedelta(seconds=response.json()["idle-time"])
+                url = (
+                    f"http://{session.name}.{session.environment.name}/session/activity"
+                )
 
-                        if idle_time >= session.environment.orphaned:
-                            logging.info(
-                                "Session %s orphaned. Deleting session.", session.name
-                            )
+                probe_targets[session.name] = url
 
-                            report_analytics_event(session, "Session/Orphaned")
+                idle_time = activity_prober.idle_time(session.name)
 
-                            delete_workshop_session(session).schedule()
+                if idle_time is None:
+                    # XXX If we don't have a recent idle time then not
+                    # currently doing anything. Need a better method to
+                    # determine if was running but has since failed in some
+                    # way and become uncontactable. In that case right now
+                    # will only be deleted when workshop timeout expires if
+                    # there is one.
 
-                    else:
-                        # XXX If we don't get a valid response then not
-                        # currently doing anything. Need a better method to
-                        # determine if was running but has since failed in
-                        # some way and become uncontactable. In that case
-                        # right now will only be deleted when workshop timeout
-                        # expires if there is one.
+                    continue
 
-                        pass
+                # If we have exceeded the inactivity timeout then trigger
+                # deletion of the workshop session.
 
-                except requests.exceptions.ConnectionError:
-                    # XXX This can just be because it is slow to start up.
-                    # Need a better method to determine if was running but has
-                    # since failed in some way and become uncontactable. In
-                    # that case right now will only be deleted when workshop
-                    # timeout expires if there is one.
+                if timedelta(seconds=idle_time) >= session.environment.orphaned:
+                    logging.info("Session %s orphaned. Deleting session.", session.name)
 
-                    logging.warning(
-                        "Cannot connect to workshop session %s.", session.name
-                    )
+                    report_analytics_event(session, "Session/Orphaned")
 
-                except Exception:  # pylint: disable=broad-except
-                    # Not aware of circumstances where would get an unexpected
-                    # exception, but need to log and ignore it as we don't
-                    # want to stop looping over all sessions.
+                    delete_workshop_session(session).schedule()
 
-                    logging.error(
-                        "Failed to query idle time for workshop session %s.",
-                        session.name,
-                    )
+    # Request refresh of the idle times for workshop sessions which need to
+    # be checked as to whether they have been orphaned, ready for next time.
 
-                    traceback.print_exc()
+    activity_prober.refresh(probe_targets)
 
 
 @background_task
-@resources_lock
+@environment_lock(lambda session: session.environment.name)
+@session_lock(lambda session: session.name)
 def delete_workshop_session(session):
     """Deletes a workshop session."""
 
+    # Deletion of the same workshop session can be requested more than once,
+    # such as when it expires at the same time as the user ends it. The lock
+    # for the workshop session is held so this is excluded from running at
+    # the same time as other operations on it, and the workshop session is
+    # then reloaded so it is only deleted if not already stopped.
+
+    try:
+        session = Session.objects.select_related("environment").get(name=session.name)
+
+    except Session.DoesNotExist:
+        return
+
+    if session.is_stopped():
+        return
+
     # First attempt to delete the deployment of the workshop session. It
     # doesn't matter if it doesn't exist. That situation can arise where
     # the workshop session was deleted manually for some reason.
@@ -159,8 +168,9 @@ def delete_workshop_session(session):
     )
 
     try:
-        resource = K8SWorkshopSession.objects(api).get(name=session.name)
-        resource.delete()
+        with kubernetes_request_duration.labels("delete_workshop_session").time():
+            resource = K8SWorkshopSession.objects(api).get(name=session.name)
+            resource.delete()
 
     except pykube.exceptions.ObjectDoesNotExist:
         pass
@@ -182,8 +192,69 @@ def delete_workshop_session(session):
         replace_reserved_session(session.environment)
 
 
-@background_task
+# Records of workshop sessions and anonymous users are purged in chunks. Each
+# chunk is deleted in its own transaction while holding the portal wide lock,
+# with the lock being released between chunks so other operations aren't held
+# up for the whole of the purge. As each chunk is committed as it goes, if the
+# purge is interrupted it resumes where it left off the next time it is run.
+
+CLEANUP_CHUNK_SIZE = 500
+
+CLEANUP_RETENTION = timedelta(hours=36)
+
+
+@resources_lock
+@transaction.atomic
+def purge_old_sessions(cutoff):
+    """Delete the next chunk of records for workshop sessions which stopped
+    before the cutoff time. Returns the number of workshop sessions found.
+
+    """
+
+    names = list(
+        Session.objects.filter(state=SessionState.STOPPED, expires__lte=cutoff)
+        .order_by()
+        .values_list("name", flat=True)[:CLEANUP_CHUNK_SIZE]
+    )
+
+    if names:
+        logging.info("Deleting %d old sessions.", len(names))
+
+        cleanup_sessions_deleted.inc(Session.bulk_delete_sessions(names))
+
+    return len(names)
+
+
 @resources_lock
+@transaction.atomic
+def purge_anonymous_users(cutoff):
+    """Delete the next chunk of anonymous users which joined before the cutoff
+    time and which no longer have any workshop sessions associated with them.
+    Returns the number of anonymous users found.
+
+    """
+
+    User = get_user_model()  # pylint: disable=invalid-name
+
+    users = list(
+        User.objects.filter(groups__name="anonymous", date_joined__lte=cutoff)
+        .filter(~Exists(Session.objects.filter(owner=OuterRef("pk"))))
+        .order_by()[:CLEANUP_CHUNK_SIZE]
+    )
+
+    for user in users:
+        logging.info("Deleting anonymous user %s.", user.get_username())
+        report_analytics_event(user, "User/Delete", {"group": "anonymous"})
+
+    if users:
+        User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+        cleanup_users_deleted.inc(len(users))
+
+    return len(users)
+
+
+@background_task
 def cleanup_old_sessions_and_users():
     """Delete records for any sessions older than a certain time, and then
     remove any anonymous user accounts that have no active sessions and which
@@ -191,30 +262,35 @@ def cleanup_old_sessions_and_users():
 
     """
 
-    with transaction.atomic():
-        # Delete record of workshop sessions more than 36 hours old.
-
-        cutoff = timezone.now() - timedelta(hours=36)
+    cutoff = timezone.now() - CLEANUP_RETENTION
 
-        sessions = Session.objects.filter(
-            state=SessionState.STOPPED, expires__lte=cutoff
-        )
+    while purge_old_sessions(cutoff):
+        pass
 
-        for session in sessions:
-            logging.info("Deleting old session %s.", session.name)
-            session.delete()
+    while purge_anonymous_users(cutoff):
+        pass
 
-        # Delete any anonymous users older than 36 hours old, which
-        # now don't have any workshop sessions associated with them.
+    cleanup_last_completed.set_to_current_time()
 
-        User = get_user_model()  # pylint: disable=invalid-name
 
-        users = User.objects.filter(groups__name="anonymous", date_joined__lte=cutoff)
+@background_task
+@resources_lock
+@transaction.atomic
+def reconcile_session_counters():
+    """Check that the counters of workshop sessions held against each
+    workshop environment match the actual workshop session records, and
+    correct them if they have drifted.
 
-        for user in users:
-            sessions = Session.objects.filter(owner=user)
+    """
 
-            if not sessions:
-                logging.info("Deleting anonymous user %s.", user.get_username())
-                report_analytics_event(user, "User/Delete", {"group": "anonymous"})
-                user.delete()
+    for environment in Environment.objects.all():
+        drift = environment.recalculate_session_counters()
+
+        for field, (current, expected) in drift.items():
+            logging.warning(
+                "Counter %s for environment %s was %s, corrected to %s.",
+                field,
+                environment.name,
+                current,
+                expected,
+            )
@@ -0,0 +1,249 @@
+"""Defines election of a leader amongst replicas of the training portal.
+
+Where multiple replicas of the training portal share the one database, all
+of them serve HTTP requests, but only the replica elected as leader runs the
+kopf event handlers and the periodic tasks for reconciling workshop
+environments and workshop sessions. The leader is elected using a Kubernetes
+lease, with the leader renewing the lease periodically. If the leader dies
+and the lease isn't renewed, another replica takes over once the lease has
+expired.
+
+As with the Kubernetes client libraries, whether a lease held by another
+replica has expired is judged by when this replica observed it last change,
+rather than by the time recorded in the lease, so that the clocks of
+replicas don't need to be in sync.
+
+"""
+
+import time
+import asyncio
+import logging
+
+from datetime import datetime, timezone
+
+import pykube
+
+
+# Time in seconds for which a lease is valid after being renewed, the time
+# within which the leader must succeed in renewing the lease before it gives
+# up leadership, and the interval between attempts to acquire or renew it.
+
+LEASE_DURATION = 15
+
+LEASE_RENEW_DEADLINE = 10
+
+LEASE_RETRY_PERIOD = 2.0
+
+
+class Lease(pykube.objects.NamespacedAPIObject):
+    version = "coordination.k8s.io/v1"
+    endpoint = "leases"
+    kind = "Lease"
+
+
+def _micro_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class LeaderElection:
+    """Acquires and holds the lease used to elect the leader. Calls to the
+    Kubernetes REST API are blocking, so are run in a separate thread.
+
+    """
+
+    def __init__(self, name, namespace, identity):
+        self.name = name
+        self.namespace = namespace
+        self.identity = identity
+
+        self._api = None
+        self._observed_record = None
+        self._observed_time = None
+        self._renewed_time = None
+
+    @property
+    def api(self):
+        if self._api is None:
+            self._api = pykube.HTTPClient(pykube.KubeConfig.from_env())
+
+        return self._api
+
+    def try_acquire_or_renew(self):
+        """Attempts to acquire the lease, or renew it if already held.
+        Returns whether the lease is held by this replica.
+
+        """
+
+        now = datetime.now(timezone.utc)
+
+        try:
+            lease = Lease.objects(self.api, namespace=self.namespace).get(
+                name=self.name
+            )
+
+        except pykube.exceptions.ObjectDoesNotExist:
+            lease = Lease(
+                self.api,
+                {
+                    "apiVersion": "coordination.k8s.io/v1",
+                    "kind": "Lease",
+                    "metadata": {"name": self.name, "namespace": self.namespace},
+                    "spec": {
+                        "holderIdentity": self.identity,
+                        "leaseDurationSeconds": LEASE_DURATION,
+                        "acquireTime": _micro_time(now),
+                        "renewTime": _micro_time(now),
+                        "leaseTransitions": 0,
+                    },
+                },
+            )
+
+            try:
+                lease.create()
+
+            except pykube.exceptions.HTTPError as exc:
+                if exc.code == 409:
+                    return False
+
+                raise
+
+            self._renewed_time = time.monotonic()
+
+            return True
+
+        spec = lease.obj.get("spec", {})
+
+        holder = spec.get("holderIdentity")
+
+        record = (holder, spec.get("renewTime"))
+
+        if record != self._observed_record:
+            self._observed_record = record
+            self._observed_time = time.monotonic()
+
+        duration = spec.get("leaseDurationSeconds") or LEASE_DURATION
+
+        if (
+            holder
+            and holder != self.identity
+            and self._observed_time + duration > time.monotonic()
+        ):
+            return False
+
+        changes = {
+            "holderIdentity": self.identity,
+            "leaseDurationSeconds": LEASE_DURATION,
+            "renewTime": _micro_time(now),
+        }
+
+        if holder != self.identity:
+            changes["acquireTime"] = _micro_time(now)
+            changes["leaseTransitions"] = spec.get("leaseTransitions", 0) + 1
+
+        # Including the resource version of the lease which was read means
+        # the update fails if another replica updated the lease in between.
+
+        try:
+            lease.patch(
+                {
+                    "metadata": {"resourceVersion": lease.metadata["resourceVersion"]},
+                    "spec": changes,
+                }
+            )
+
+        except pykube.exceptions.HTTPError as exc:
+            if exc.code == 409:
+                return False
+
+            raise
+
+        if holder != self.identity:
+            logging.info(
+                "Acquired leadership of training portal %s as %s.",
+                self.name,
+                self.identity,
+            )
+
+        self._renewed_time = time.monotonic()
+
+        return True
+
+    def release(self):
+        """Releases the lease if held by this replica, so another replica
+        can take over without waiting for the lease to expire.
+
+        """
+
+        try:
+            lease = Lease.objects(self.api, namespace=self.namespace).get(
+                name=self.name
+            )
+
+            if lease.obj.get("spec", {}).get("holderIdentity") != self.identity:
+                return
+
+            lease.patch(
+                {
+                    "metadata": {"resourceVersion": lease.metadata["resourceVersion"]},
+                    "spec": {"holderIdentity": None, "leaseDurationSeconds": 1},
+                }
+            )
+
+        except pykube.exceptions.KubernetesError:
+            logging.exception("Failed to release lease for training portal.")
+
+    async def _attempt(self):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.try_acquire_or_renew
+            )
+
+        except pykube.exceptions.KubernetesError:
+            logging.exception("Failed to acquire or renew lease for training portal.")
+
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Unexpected error accessing lease for training portal.")
+
+        return False
+
+    async def acquire(self, stop_flag):
+        """Waits until the lease is acquired, returning True, or until the
+        stop flag is set, returning False.
+
+        """
+
+        logging.info(
+            "Waiting to acquire leadership of training portal %s as %s.",
+            self.name,
+            self.identity,
+        )
+
+        while not stop_flag.is_set():
+            if await self._attempt():
+                return True
+
+            await asyncio.sleep(LEASE_RETRY_PERIOD)
+
+        return False
+
+    async def renew(self, stop_flag):
+        """Renews the lease until the stop flag is set. Returns if the lease
+        couldn't be renewed within the deadline for doing so, in which case
+        leadership has been lost.
+
+        """
+
+        while not stop_flag.is_set():
+            await asyncio.sleep(LEASE_RETRY_PERIOD)
+
+            if await self._attempt():
+                continue
+
+            if time.monotonic() - self._renewed_time >= LEASE_RENEW_DEADLINE:
+                logging.error(
+                    "Lost leadership of training portal %s as %s.",
+                    self.name,
+                    self.identity,
+                )
+
+                return
@@ -19,11 +19,11 @@ from django.utils import timezone
 
 from .resources import ResourceBody
 from .operator import background_task
-from .locking import resources_lock
+from .locking import resources_lock, environment_lock, environment_or_resources_lock
 from .sessions import (
     update_session_status,
-    setup_workshop_session,
-    create_workshop_session,
+    setup_workshop_sessions,
+    create_workshop_sessions,
 )
 from .analytics import report_analytics_event
 
@@ -98,7 +98,7 @@ def update_environment_status(name, phase):
 
 
 @background_task
-@resources_lock
+@environment_lock(lambda resource: resource.name)
 @transaction.atomic
 def activate_workshop_environment(resource):
     """Updates workshop details of a workshop environment and marks the
@@ -196,8 +196,6 @@ def activate_workshop_environment(resource):
     # sure we don't go over any capacity cap for the training portal as a
     # whole.
 
-    sessions = []
-
     maximum = portal.sessions_maximum
 
     if maximum == 0:
@@ -207,12 +205,10 @@ def activate_workshop_environment(resource):
 
     required = min(environment.initial, maximum)
 
-    for _ in range(required):
-        sessions.append(setup_workshop_session(environment))
+    sessions = setup_workshop_sessions(environment, required)
 
     def _schedule_session_creation():
-        for session, secret in sessions:
-            create_workshop_session(session, secret)
+        create_workshop_sessions(sessions)
 
     transaction.on_commit(_schedule_session_creation)
 
@@ -293,7 +289,7 @@ def shutdown_workshop_environments(training_portal, workshops):
 
 
 @background_task
-@resources_lock
+@environment_lock(lambda environment: environment.name)
 def delete_workshop_environment(environment):
     """Deletes a workshop environment. If this is called when there are still
     workshop sessions, they will be forcibly deleted.
@@ -318,16 +314,24 @@ def delete_workshop_environment(environment):
 
 
 @background_task
-@resources_lock
+@environment_or_resources_lock(
+    lambda training_portal, environment_name=None: environment_name
+)
 @transaction.atomic
-def refresh_workshop_environments(training_portal):
+def refresh_workshop_environments(training_portal, environment_name=None):
     """Looks for workshop environments which have a refresh interval and if that
     interval has been exceeded shutdown the old workshop environment and create
-    a new in it's place using the same workshop definition.
+    a new in it's place using the same workshop definition. If the name of a
+    workshop environment is supplied only that one is checked.
 
     """
 
-    for environment in training_portal.running_environments():
+    environments = training_portal.running_environments()
+
+    if environment_name is not None:
+        environments = environments.filter(name=environment_name)
+
+    for environment in environments:
         if environment.refresh.total_seconds() != 0: 
             duration = timezone.now() - environment.created_at
 
@@ -336,16 +340,24 @@ def refresh_workshop_environments(training_portal):
 
 
 @background_task
-@resources_lock
+@environment_or_resources_lock(
+    lambda training_portal, environment_name=None: environment_name
+)
 @transaction.atomic
-def delete_workshop_environments(training_portal):
+def delete_workshop_environments(training_portal, environment_name=None):
     """Looks for workshop environments which are marked as stopping and if
     the number of active workshop sessions has reached zero, the workshop
-    environment can safely be deleted without interrupting any users.
+    environment can safely be deleted without interrupting any users. If the
+    name of a workshop environment is supplied only that one is checked.
 
     """
 
-    for environment in training_portal.stopping_environments():
+    environments = training_portal.stopping_environments()
+
+    if environment_name is not None:
+        environments = environments.filter(name=environment_name)
+
+    for environment in environments:
         if environment.active_sessions_count() == 0:
             logging.info("Delete workshop environment %s.", environment.name)
 
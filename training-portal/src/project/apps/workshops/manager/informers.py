@@ -0,0 +1,197 @@
+"""Defines an in-memory index of the WorkshopSession resources belonging to
+the training portal. The index is maintained from the events delivered by
+kopf when watching the resources, so that checks against the set of deployed
+workshop sessions don't need to query the Kubernetes REST API each time.
+
+"""
+
+import time
+import logging
+import threading
+
+import kopf
+import pykube
+
+from django.conf import settings
+
+from .operator import background_task
+from .metrics import workshop_session_index_staleness
+
+api = pykube.HTTPClient(pykube.KubeConfig.from_env())
+
+
+# Interval after which a full listing of the resources is done to confirm
+# the index is complete. Between these the index is kept up to date by the
+# events from watching the resources.
+
+INDEX_RESYNC_INTERVAL = 5 * 60
+
+
+class WorkshopSessionIndex:
+    """Index of the names and status phases of deployed workshop sessions.
+    Each entry records when it was last updated so that a full listing of
+    the resources can be merged with events received while the listing was
+    being done. Deleted resources are retained as tombstones until the next
+    full listing for the same reason.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._synced = None
+        self._updated = None
+
+    def _update(self, name, phase, deleted=False):
+        now = time.monotonic()
+
+        with self._lock:
+            self._entries[name] = (phase, deleted, now)
+            self._updated = now
+
+    def observe(self, name, phase=None):
+        """Records that the workshop session resource exists."""
+
+        self._update(name, phase)
+
+    def forget(self, name):
+        """Records that the workshop session resource has been deleted."""
+
+        self._update(name, None, deleted=True)
+
+    def replace(self, items, started):
+        """Merges a full listing of the resources into the index. The listing
+        is only authoritative for entries which were not updated by events
+        after the listing was started.
+
+        """
+
+        with self._lock:
+            for name, (_, _, updated) in list(self._entries.items()):
+                if updated < started and name not in items:
+                    del self._entries[name]
+
+            for name, phase in items.items():
+                entry = self._entries.get(name)
+
+                if entry is None or entry[2] < started:
+                    self._entries[name] = (phase, False, started)
+
+            self._synced = started
+            self._updated = max(started, self._updated or started)
+
+    def is_synced(self):
+        """Returns whether the index has been confirmed against a full
+        listing of the resources.
+
+        """
+
+        return self._synced is not None
+
+    def requires_resync(self):
+        """Returns whether a full listing of the resources is due."""
+
+        if self._synced is None:
+            return True
+
+        return time.monotonic() - self._synced >= INDEX_RESYNC_INTERVAL
+
+    def staleness(self):
+        """Returns the number of seconds since the index was last confirmed
+        against a full listing of the resources, or updated from an event,
+        whichever is the more recent.
+
+        """
+
+        if self._updated is None:
+            return float("inf")
+
+        return time.monotonic() - self._updated
+
+    def names(self):
+        """Returns the set of names of workshop sessions which exist."""
+
+        with self._lock:
+            return set(
+                name for name, (_, deleted, _) in self._entries.items() if not deleted
+            )
+
+    def phase(self, name):
+        """Returns the status phase of the workshop session if known."""
+
+        with self._lock:
+            entry = self._entries.get(name)
+
+        if entry and not entry[1]:
+            return entry[0]
+
+
+workshop_session_index = WorkshopSessionIndex()
+
+workshop_session_index_staleness.set_function(workshop_session_index.staleness)
+
+
+def workshop_session_phase(body):
+    """Returns the status phase from a workshop session resource."""
+
+    return body.get("status", {}).get(settings.OPERATOR_STATUS_KEY, {}).get("phase")
+
+
+@kopf.on.event(
+    f"training.{settings.OPERATOR_API_GROUP}",
+    "v1beta1",
+    "workshopsessions",
+    when=lambda labels, **_: labels.get(
+        f"training.{settings.OPERATOR_API_GROUP}/portal.name", ""
+    )
+    == settings.PORTAL_NAME,
+)
+def workshop_session_event(event, name, body, **_):
+    """Keeps the index of workshop sessions up to date from the events
+    received when watching the WorkshopSession resources.
+
+    """
+
+    if event["type"] == "DELETED":
+        workshop_session_index.forget(name)
+    else:
+        workshop_session_index.observe(name, workshop_session_phase(body))
+
+
+@background_task
+def resync_workshop_session_index():
+    """Performs a full listing of the WorkshopSession resources for the
+    training portal and merges it into the index.
+
+    """
+
+    started = time.monotonic()
+
+    K8SWorkshopSession = pykube.object_factory(
+        api, f"training.{settings.OPERATOR_API_GROUP}/v1beta1", "WorkshopSession"
+    )
+
+    try:
+        resources = K8SWorkshopSession.objects(api).filter(
+            selector={
+                f"training.{settings.OPERATOR_API_GROUP}/portal.name": settings.PORTAL_NAME
+            }
+        )
+
+        items = {
+            resource.name: workshop_session_phase(resource.obj)
+            for resource in resources
+        }
+
+    except pykube.exceptions.PyKubeError:
+        logging.exception("Failed to list workshop sessions.")
+
+        return
+
+    workshop_session_index.replace(items, started)
+
+
+@kopf.on.probe(id="workshopsessions.staleness")
+def workshop_session_index_probe(**_):
+    if workshop_session_index.is_synced():
+        return round(workshop_session_index.staleness(), 1)
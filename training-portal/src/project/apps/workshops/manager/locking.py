@@ -1,29 +1,517 @@
-"""Implementation of a global lock for database operations affecting workshop
-sessions.
+"""Implementation of locks for database operations affecting workshop
+environments and workshop sessions.
+
+Locks are organised into three scopes. The portal scope covers the training
+portal as a whole, the environment scope covers a single workshop environment,
+and the session scope covers a single workshop session. Operations which only
+touch one workshop environment or workshop session hold the portal scope in
+shared mode plus an exclusive lock keyed on the name of the workshop
+environment or workshop session. Operations which need to see a consistent
+view across the whole training portal hold the portal scope in exclusive mode,
+which excludes all other operations.
+
+Locks must always be acquired in the order portal, environment, session. A
+level may be skipped, but a thread holding a lock for a narrower scope must
+never try to acquire one for a wider scope. Where the portal lock is already
+held exclusively by the current thread, requests for environment or session
+locks are satisfied by it and are not acquired separately.
+
+Where the training portal defines a maximum number of workshop sessions,
+either overall or for each user, allocating a workshop session for one
+workshop environment can affect whether a workshop session can be allocated
+for any other. In that case environment scoped operations are escalated to
+use the portal lock exclusively.
+
+Where the database is SQLite, concurrent transactions which both write to the
+database fail rather than waiting on each other, so all operations are
+escalated to use the portal lock exclusively.
+
+These locks only exclude threads of the one process. Where there are multiple
+replicas of the training portal sharing the database, decisions to allocate
+or create workshop sessions are also serialized across replicas by locking
+rows in the database. The row for the training portal is locked where there
+is a maximum number of workshop sessions, and otherwise the rows for the
+affected workshop environments. As with the locks above, the row for the
+training portal is always locked before those for workshop environments.
+
+Every acquisition of a lock is profiled, recording the function holding the
+lock, how long it waited to acquire it and how long it was held. Where a lock
+is held for longer than a threshold the stack is logged.
 
 """
 
+import sys
+import time
+import logging
 import threading
+import traceback
+import contextlib
 
 import wrapt
 
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from ..models import TrainingPortal, Environment
+
+from .metrics import lock_wait_duration, lock_hold_duration
+
+
+class SharedExclusiveLock:
+    """Lock which can be held either by many threads in shared mode, or by a
+    single thread in exclusive mode. Threads waiting to acquire the lock in
+    exclusive mode take precedence over new requests for shared mode so
+    portal wide operations cannot be starved.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    def acquire_shared(self):
+        with self._condition:
+            while self._exclusive or self._waiting:
+                self._condition.wait()
+            self._shared += 1
+
+    def release_shared(self):
+        with self._condition:
+            self._shared -= 1
+            if not self._shared:
+                self._condition.notify_all()
+
+    def acquire_exclusive(self):
+        with self._condition:
+            self._waiting += 1
+            try:
+                while self._exclusive or self._shared:
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+            self._exclusive = True
+
+    def release_exclusive(self):
+        with self._condition:
+            self._exclusive = False
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        self.acquire_exclusive()
+        try:
+            yield
+        finally:
+            self.release_exclusive()
+
+
+class KeyedLocks:
+    """Set of exclusive locks indexed by name. A lock only exists while a
+    thread holds or is waiting on it, so the set doesn't grow with the number
+    of workshop environments or workshop sessions ever created.
+
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+PORTAL, ENVIRONMENT, SESSION = 1, 2, 3
+
+SCOPE_NAMES = {PORTAL: "portal", ENVIRONMENT: "environment", SESSION: "session"}
+
+
+class LockStatistics:
+    """Aggregated times for acquisitions of a lock by the one holder."""
+
+    def __init__(self):
+        self.count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def add(self, wait, hold):
+        self.count += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.hold_total += hold
+        self.hold_max = max(self.hold_max, hold)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "wait": {
+                "total": self.wait_total,
+                "mean": self.wait_total / self.count,
+                "max": self.wait_max,
+            },
+            "hold": {
+                "total": self.hold_total,
+                "mean": self.hold_total / self.count,
+                "max": self.hold_max,
+            },
+        }
+
+
+class LockProfiler:
+    """Records the time spent waiting for and holding locks, by the scope of
+    the lock and the function holding it. Times are recorded in histograms
+    for the metrics of the training portal, as well as being aggregated both
+    since the process started and since the last summary was taken.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._interval = {}
+
+    def record(self, scope, holder, wait, hold):
+        lock_wait_duration.labels(scope, holder).observe(wait)
+        lock_hold_duration.labels(scope, holder).observe(hold)
+
+        with self._lock:
+            for statistics in (self._totals, self._interval):
+                entry = statistics.get((scope, holder))
+
+                if entry is None:
+                    entry = statistics[(scope, holder)] = LockStatistics()
+
+                entry.add(wait, hold)
+
+        threshold = settings.LOCK_HOLD_WARNING_THRESHOLD
+
+        if threshold and hold * 1000 >= threshold:
+            logging.warning(
+                "Lock for %s scope held by %s for %dms.\n%s",
+                scope,
+                holder,
+                hold * 1000,
+                "".join(traceback.format_stack()[:-1]),
+            )
+
+    @staticmethod
+    def _report(statistics):
+        entries = []
+
+        for (scope, holder), entry in statistics.items():
+            entries.append(dict(scope=scope, holder=holder, **entry.as_dict()))
+
+        entries.sort(key=lambda entry: entry["hold"]["total"], reverse=True)
+
+        return entries
+
+    def statistics(self):
+        """Returns the times aggregated since the process started, ordered
+        by the total time the lock was held.
+
+        """
+
+        with self._lock:
+            return self._report(self._totals)
+
+    def summary(self):
+        """Returns the times aggregated since the last summary was taken,
+        ordered by the total time the lock was held.
+
+        """
+
+        with self._lock:
+            interval, self._interval = self._interval, {}
+
+        return self._report(interval)
+
+
+lock_profiler = LockProfiler()
+
+
+def lock_holder(depth=1):
+    """Returns the qualified name of the function which is acquiring a lock,
+    skipping over frames for this module and the context manager decorator.
+
+    """
+
+    frame = sys._getframe(depth)  # pylint: disable=protected-access
+
+    while frame is not None and frame.f_code.co_filename in (
+        __file__,
+        contextlib.__file__,
+    ):
+        frame = frame.f_back
+
+    if frame is None:
+        return "unknown"
+
+    return getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+
+
+class LockManager:
+    """Manages the locks for each scope and enforces the lock order."""
+
+    def __init__(self):
+        self._portal = SharedExclusiveLock()
+        self._environments = KeyedLocks()
+        self._sessions = KeyedLocks()
+        self._local = threading.local()
 
-_global_lock = threading.Lock()
+        # Until the training portal configuration has been processed we
+        # don't know whether there is a maximum number of workshop sessions,
+        # so start out with environment scoped operations being escalated.
+
+        self._escalate_environments = True
+
+    def escalate_environments(self, escalate):
+        """Sets whether environment scoped operations should instead use the
+        portal lock exclusively. This is required where allocation of a
+        workshop session for one workshop environment can affect others.
+
+        """
+
+        self._escalate_environments = bool(escalate)
+
+    def _serialized(self):
+        # A transaction on SQLite which reads and then writes to the database
+        # fails straight away if another transaction has written to it in
+        # the meantime, without waiting for the busy timeout, so operations
+        # can only be run one at a time.
+
+        return connections[DEFAULT_DB_ALIAS].vendor == "sqlite"
+
+    def _held(self):
+        held = getattr(self._local, "held", None)
+        if held is None:
+            held = self._local.held = []
+        return held
+
+    @contextlib.contextmanager
+    def _enter(self, scope, hold, holder):
+        held = self._held()
+
+        holder = holder or lock_holder()
+
+        if held and held[-1] >= scope:
+            raise RuntimeError(
+                "Lock for %s scope requested while holding lock for %s scope."
+                % (SCOPE_NAMES[scope], SCOPE_NAMES[held[-1]])
+            )
+
+        held.append(scope)
+
+        try:
+            with contextlib.ExitStack() as stack:
+                started = time.monotonic()
+
+                stack.enter_context(hold())
+
+                acquired = time.monotonic()
+
+                try:
+                    yield
+
+                finally:
+                    lock_profiler.record(
+                        SCOPE_NAMES[scope],
+                        holder,
+                        acquired - started,
+                        time.monotonic() - acquired,
+                    )
+
+        finally:
+            held.pop()
+
+    def _owns_portal(self):
+        return PORTAL in self._held()
+
+    @contextlib.contextmanager
+    def portal(self, holder=None):
+        """Acquires the portal lock exclusively. The holder is the name of
+        the function acquiring the lock, and if not supplied is taken to be
+        the caller.
+
+        """
+
+        with self._enter(PORTAL, self._portal.exclusive, holder):
+            yield
+
+    @contextlib.contextmanager
+    def environment(self, name, holder=None):
+        """Acquires the lock for the named workshop environment."""
+
+        if self._owns_portal():
+            yield
+            return
+
+        if self._escalate_environments or self._serialized():
+            with self.portal(holder or lock_holder()):
+                yield
+            return
+
+        @contextlib.contextmanager
+        def hold():
+            with self._portal.shared(), self._environments.hold(name):
+                yield
+
+        with self._enter(ENVIRONMENT, hold, holder):
+            yield
+
+    @contextlib.contextmanager
+    def session(self, name, holder=None):
+        """Acquires the lock for the named workshop session."""
+
+        if self._owns_portal():
+            yield
+            return
+
+        if self._serialized():
+            with self.portal(holder or lock_holder()):
+                yield
+            return
+
+        held = self._held()
+
+        @contextlib.contextmanager
+        def hold():
+            if ENVIRONMENT in held:
+                with self._sessions.hold(name):
+                    yield
+            else:
+                with self._portal.shared(), self._sessions.hold(name):
+                    yield
+
+        with self._enter(SESSION, hold, holder):
+            yield
+
+
+lock_manager = LockManager()
 
 
 def resources_lock(wrapped=None):
-    """Returns a lock when used for context manager, or decorator when
-    applied to a function. This is used to ensure only one things is working
-    with Kubernetes REST API or database at any one time to avoid issues.
+    """Returns the portal wide lock when used for context manager, or
+    decorator when applied to a function. This should be used for operations
+    which need to see a consistent view of all workshop environments and
+    workshop sessions, and excludes any other operation from running.
 
     """
 
     if wrapped is None:
-        return _global_lock
+        return lock_manager.portal()
 
     @wrapt.decorator
     def wrapper(wrapped, instance, args, kwargs):  # pylint: disable=unused-argument
-        with _global_lock:
+        with lock_manager.portal(wrapped.__qualname__):
             return wrapped(*args, **kwargs)
 
     return wrapper(wrapped)  # pylint: disable=no-value-for-parameter
+
+
+def environment_lock(key):
+    """Returns a decorator which holds the lock for a single workshop
+    environment while the function is called. The name of the workshop
+    environment is determined by calling the supplied key function with the
+    same arguments as the decorated function.
+
+    """
+
+    @wrapt.decorator
+    def wrapper(wrapped, instance, args, kwargs):  # pylint: disable=unused-argument
+        with lock_manager.environment(key(*args, **kwargs), wrapped.__qualname__):
+            return wrapped(*args, **kwargs)
+
+    return wrapper
+
+
+def environment_or_resources_lock(key):
+    """Returns a decorator which holds the lock for a single workshop
+    environment while the function is called, or the portal wide lock where
+    no workshop environment is given. The name of the workshop environment is
+    determined by calling the supplied key function with the same arguments
+    as the decorated function, with None meaning all workshop environments.
+
+    """
+
+    @wrapt.decorator
+    def wrapper(wrapped, instance, args, kwargs):  # pylint: disable=unused-argument
+        name = key(*args, **kwargs)
+
+        if name is None:
+            lock = lock_manager.portal(wrapped.__qualname__)
+        else:
+            lock = lock_manager.environment(name, wrapped.__qualname__)
+
+        with lock:
+            return wrapped(*args, **kwargs)
+
+    return wrapper
+
+
+def session_lock(key):
+    """Returns a decorator which holds the lock for a single workshop session
+    while the function is called. The name of the workshop session is
+    determined by calling the supplied key function with the same arguments as
+    the decorated function.
+
+    """
+
+    @wrapt.decorator
+    def wrapper(wrapped, instance, args, kwargs):  # pylint: disable=unused-argument
+        with lock_manager.session(key(*args, **kwargs), wrapped.__qualname__):
+            return wrapped(*args, **kwargs)
+
+    return wrapper
+
+
+def allocation_lock(portal, environment_ids=()):
+    """Locks the rows in the database which serialize decisions to allocate
+    or create workshop sessions across replicas of the training portal, until
+    the end of the current transaction. Where a maximum number of workshop
+    sessions is set for the training portal, or for each user, this is the
+    row for the training portal, otherwise the rows for the workshop
+    environments with the supplied ids. Nothing is locked where there is only
+    the one replica. Counters of workshop sessions which were loaded before
+    the lock was acquired may be stale and need to be reloaded.
+
+    """
+
+    if settings.PORTAL_REPLICAS <= 1:
+        return
+
+    if (
+        portal.sessions_maximum
+        or portal.sessions_registered
+        or portal.sessions_anonymous
+    ):
+        rows = TrainingPortal.objects.filter(pk=portal.pk)
+    else:
+        rows = Environment.objects.filter(pk__in=environment_ids)
+
+    list(rows.select_for_update().order_by("pk").values_list("pk", flat=True))
@@ -0,0 +1,178 @@
+"""Defines metrics for monitoring the operation of the training portal.
+
+Metrics are held in the default registry for the process. As all requests are
+handled by the one process, across multiple threads, there is no need to use
+the multiprocess mode of the Prometheus client, which is safe to update and
+collect from any thread.
+
+"""
+
+import functools
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+from ..models import Environment, EnvironmentState
+
+
+workshop_session_index_staleness = Gauge(
+    "training_portal_workshop_session_index_staleness_seconds",
+    "Seconds since the index of workshop session resources was last updated.",
+)
+
+analytics_events_queued = Gauge(
+    "training_portal_analytics_events_queued",
+    "Number of analytics events waiting to be delivered to the webhook.",
+)
+
+analytics_events_delivered = Counter(
+    "training_portal_analytics_events_delivered",
+    "Number of analytics events delivered to the webhook.",
+)
+
+analytics_events_spooled = Counter(
+    "training_portal_analytics_events_spooled",
+    "Number of analytics events spooled to file for later delivery.",
+)
+
+analytics_events_dropped = Counter(
+    "training_portal_analytics_events_dropped",
+    "Number of analytics events dropped as they couldn't be delivered.",
+)
+
+cleanup_sessions_deleted = Counter(
+    "training_portal_cleanup_sessions_deleted",
+    "Number of records of old workshop sessions deleted.",
+)
+
+cleanup_users_deleted = Counter(
+    "training_portal_cleanup_users_deleted",
+    "Number of old anonymous users deleted.",
+)
+
+cleanup_last_completed = Gauge(
+    "training_portal_cleanup_last_completed_timestamp_seconds",
+    "Time the purge of old workshop sessions and users last completed.",
+)
+
+background_tasks_pending = Gauge(
+    "training_portal_background_tasks_pending",
+    "Number of background tasks waiting to run.",
+)
+
+background_tasks_coalesced = Counter(
+    "training_portal_background_tasks_coalesced",
+    "Number of background tasks merged with an identical waiting task.",
+    ["task"],
+)
+
+background_task_runs_skipped = Counter(
+    "training_portal_background_task_runs_skipped",
+    "Number of runs of periodic tasks skipped as the previous run was busy.",
+    ["task"],
+)
+
+background_task_duration = Histogram(
+    "training_portal_background_task_duration_seconds",
+    "Time taken to run background tasks.",
+    ["task"],
+)
+
+session_allocation_duration = Histogram(
+    "training_portal_session_allocation_duration_seconds",
+    "Time taken to allocate a workshop session to a user.",
+    ["outcome"],
+)
+
+request_duration = Histogram(
+    "training_portal_request_duration_seconds",
+    "Time taken to handle requests to the REST API.",
+    ["view"],
+)
+
+
+def timed_request(view):
+    """Decorator for view handlers of the REST API which records the time
+    taken to handle the request.
+
+    """
+
+    timer = request_duration.labels(view.__name__)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with timer.time():
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+LOCK_DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+lock_wait_duration = Histogram(
+    "training_portal_lock_wait_duration_seconds",
+    "Time spent waiting to acquire locks for workshop environments and sessions.",
+    ["scope", "holder"],
+    buckets=LOCK_DURATION_BUCKETS,
+)
+
+lock_hold_duration = Histogram(
+    "training_portal_lock_hold_duration_seconds",
+    "Time locks for workshop environments and sessions were held.",
+    ["scope", "holder"],
+    buckets=LOCK_DURATION_BUCKETS,
+)
+
+kubernetes_request_duration = Histogram(
+    "training_portal_kubernetes_request_duration_seconds",
+    "Time taken by requests to the Kubernetes REST API.",
+    ["operation"],
+)
+
+
+class EnvironmentSessionsCollector:
+    """Reports the counts of workshop sessions for each active workshop
+    environment. The counts are read from the database when collected, using
+    the counters of workshop sessions held against each workshop environment.
+
+    """
+
+    COUNTERS = {
+        "sessions_available": "available",
+        "sessions_reserved": "reserved",
+        "sessions_allocated": "allocated",
+        "sessions_active": "active",
+    }
+
+    def family(self):
+        return GaugeMetricFamily(
+            "training_portal_environment_sessions",
+            "Number of workshop sessions for a workshop environment.",
+            labels=["environment", "workshop", "type"],
+        )
+
+    def describe(self):
+        # Describing the metric means the database isn't queried when the
+        # collector is registered.
+
+        yield self.family()
+
+    def collect(self):
+        family = self.family()
+
+        environments = Environment.objects.filter(
+            state__in=(
+                EnvironmentState.STARTING,
+                EnvironmentState.RUNNING,
+                EnvironmentState.STOPPING,
+            )
+        ).values_list("name", "workshop_name", *self.COUNTERS)
+
+        for name, workshop, *counts in environments:
+            for kind, count in zip(self.COUNTERS.values(), counts):
+                family.add_metric([name, workshop, kind], count)
+
+        yield family
+
+
+REGISTRY.register(EnvironmentSessionsCollector())
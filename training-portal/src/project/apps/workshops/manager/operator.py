@@ -9,20 +9,38 @@ import asyncio
 import contextlib
 import functools
 import logging
+import threading
 
 from threading import Thread, Event
-
-from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
 
 import mod_wsgi
 import kopf
 import pykube
 import requests
 
+from aiohttp import web
+
+from django.conf import settings
+
+from .election import LeaderElection
+from .metrics import (
+    background_tasks_pending,
+    background_tasks_coalesced,
+    background_task_runs_skipped,
+    background_task_duration,
+)
+
 
 _event_loop = None  # pylint: disable=invalid-name
 
 
+# Maximum number of background tasks which can be executing at the same time.
+# Further tasks wait for a worker thread to become free.
+
+BACKGROUND_TASK_WORKERS = 8
+
+
 class Task:
     """Encapsulation of an instance of a background task. It binds the
     function implementing the task with the arguments to use when calling it,
@@ -46,6 +64,22 @@ class Task:
         self.args = args
         self.kwargs = kwargs
 
+    def key(self):
+        """Returns the key identifying tasks which do the same thing, being
+        the name of the task and the arguments. Where the arguments can't be
+        hashed the task is only identical to itself.
+
+        """
+
+        key = (self.name, self.args, tuple(sorted(self.kwargs.items())))
+
+        try:
+            hash(key)
+        except TypeError:
+            return self
+
+        return key
+
     def execute(self):
         """Execute the function for the task synchronously."""
 
@@ -60,48 +94,131 @@ class Task:
 
         delay = delay or self.delay
 
-        async def sleep():
-            if delay > 0.0:
-                await asyncio.sleep(delay)
+        # This schedules the task to be run by the asyncio loop. This is
+        # done using threadsafe registration mechanism as can be called by
+        # request handler thread of mod_wsgi and not necessarily a function
+        # executing under asyncio.
+
+        if self.repeat:
+            return schedule_coroutine(task_scheduler.run_periodic(self, delay))
+
+        return schedule_coroutine(task_scheduler.run_once(self, delay))
+
+
+class TaskScheduler:
+    """Runs background tasks using a bounded pool of worker threads. A task
+    which is scheduled while an identical task is still waiting to run is
+    coalesced with it, with the waiting task taking on the latest arguments.
+    Identical tasks never run at the same time, and a round of a periodic
+    task is skipped if an identical task is still running or waiting to run.
+
+    The state of the scheduler is only accessed from the asyncio loop used by
+    kopf, so doesn't need to be protected by a lock, except for the count of
+    tasks waiting on a worker thread, which worker threads also update.
+
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="background-task"
+        )
+        self._pending = {}
+        self._running = {}
+        self._periodic = set()
+        self._lock = threading.Lock()
+        self._queued = 0
+
+    def backlog(self):
+        """Returns the number of tasks waiting to run."""
+
+        with self._lock:
+            return len(self._pending) + self._queued
+
+    async def run_once(self, task, delay):
+        key = task.key()
+
+        if key in self._pending:
+            self._pending[key] = task
+            background_tasks_coalesced.labels(task.name).inc()
+            return None
+
+        self._pending[key] = task
+
+        if delay > 0.0:
+            await asyncio.sleep(delay)
+
+        # If an identical task is still running, wait for it to complete so
+        # this one sees any changes it made.
+
+        while key in self._running:
+            await self._running[key].wait()
+
+        return await self._execute(key, self._pending.pop(key))
+
+    async def run_periodic(self, task, delay):
+        key = task.key()
+
+        if key in self._periodic:
+            logging.warning("Periodic task %s is already scheduled.", task.name)
+            return
+
+        self._periodic.add(key)
+
+        try:
+            while True:
+                if delay > 0.0:
+                    await asyncio.sleep(delay)
+
+                if key in self._running or key in self._pending:
+                    logging.warning(
+                        "Skipping task %s as previous run not complete.", task.name
+                    )
+                    background_task_runs_skipped.labels(task.name).inc()
+                    continue
+
+                await self._execute(key, task)
+
+        finally:
+            self._periodic.discard(key)
+
+    async def _execute(self, key, task):
+        finished = self._running[key] = asyncio.Event()
+
+        with self._lock:
+            self._queued += 1
 
-        @sync_to_async(thread_sensitive=False)
         def execute():
             """Executes the function, capturing details of any exception and
             logging it since nothing will even wait on the results.
 
             """
 
+            with self._lock:
+                self._queued -= 1
+
             try:
                 logging.info(
-                    "Executing task %s %s %s.", self.name, self.args, self.kwargs
+                    "Executing task %s %s %s.", task.name, task.args, task.kwargs
                 )
-                return self.wrapped(*self.args, **self.kwargs)
+                with background_task_duration.labels(task.name).time():
+                    return task.execute()
 
             except Exception:  # pylint: disable=broad-except
-                logging.exception("Exception raised by task %s.", self.name)
-
-        async def task():
-            """The asynchronous task wrapper for the function. Handles once
-            off execution as well as looping forever with delay.
-
-            """
+                logging.exception("Exception raised by task %s.", task.name)
 
-            await sleep()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, execute
+            )
 
-            if self.repeat:
-                while True:
-                    await execute()
-                    await sleep()
+        finally:
+            del self._running[key]
+            finished.set()
 
-            else:
-                return await execute()
 
-        # This schedules the task to be run by the asyncio loop. This is
-        # done using threadsafe registration mechanism as can be called by
-        # request handler thread of mod_wsgi and not necessarily a function
-        # executing under asyncio.
+task_scheduler = TaskScheduler(BACKGROUND_TASK_WORKERS)
 
-        return asyncio.run_coroutine_threadsafe(task(), _event_loop)
+background_tasks_pending.set_function(task_scheduler.backlog)
 
 
 def background_task(wrapped=None, *, name=None, delay=0.0, repeat=False):
@@ -115,7 +232,9 @@ def background_task(wrapped=None, *, name=None, delay=0.0, repeat=False):
     # applyication to the function implementing the task.
 
     if wrapped is None:
-        return functools.partial(background_task, delay=delay, repeat=repeat)
+        return functools.partial(
+            background_task, name=name, delay=delay, repeat=repeat
+        )
 
     name = name or wrapped.__qualname__
 
@@ -130,10 +249,38 @@ def background_task(wrapped=None, *, name=None, delay=0.0, repeat=False):
     return wrapper
 
 
+def schedule_coroutine(coroutine):
+    """Schedule a coroutine to be run by the asyncio loop used by kopf. This
+    can be called from any thread. Returns a future which can be used to
+    wait on the result if required.
+
+    """
+
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop)
+
+
 ready_flag = Event()
 stop_flag = Event()
 
 
+# Handlers run on the asyncio loop of every replica of the training portal
+# at startup and shutdown, whether or not the replica is the leader and
+# running kopf. Handlers registered with kopf only run on the leader.
+
+_replica_startup_handlers = []
+_replica_cleanup_handlers = []
+
+
+def on_replica_startup(handler):
+    _replica_startup_handlers.append(handler)
+    return handler
+
+
+def on_replica_cleanup(handler):
+    _replica_cleanup_handlers.append(handler)
+    return handler
+
+
 @kopf.on.startup()
 def configure(settings: kopf.OperatorSettings, **_):
     settings.posting.level = logging.DEBUG
@@ -195,6 +342,112 @@ async def cleanup_fn(logger, **kwargs):
     stop_flag.set()
 
 
+async def run_replica_handlers(handlers):
+    for handler in handlers:
+        try:
+            await handler()
+
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Error raised by handler %s.", handler.__qualname__)
+
+
+async def serve_health_checks():
+    """Serves the endpoint used for liveness and readiness checks while kopf
+    isn't running, as is the case for a replica which isn't the leader.
+
+    """
+
+    async def healthz(_):
+        return web.json_response({})
+
+    app = web.Application()
+
+    app.router.add_get("/healthz", healthz)
+
+    runner = web.AppRunner(app)
+
+    await runner.setup()
+
+    site = web.TCPSite(runner, port=8081, shutdown_timeout=1.0)
+
+    await site.start()
+
+    return runner
+
+
+async def run_operator():
+    """Runs kopf. Where there are multiple replicas of the training portal,
+    kopf is only run once this replica has been elected as leader, with the
+    replica serving health checks itself until then.
+
+    """
+
+    await run_replica_handlers(_replica_startup_handlers)
+
+    try:
+        if settings.PORTAL_REPLICAS <= 1:
+            await kopf.operator(
+                clusterwide=True,
+                ready_flag=ready_flag,
+                stop_flag=stop_flag,
+                liveness_endpoint="http://0.0.0.0:8081/healthz",
+            )
+
+            return
+
+        election = LeaderElection(
+            f"{settings.TRAINING_PORTAL}-leader",
+            settings.PORTAL_NAMESPACE,
+            settings.PORTAL_REPLICA,
+        )
+
+        runner = await serve_health_checks()
+
+        # The replica can handle requests and run background tasks for them
+        # while waiting to become the leader.
+
+        ready_flag.set()
+
+        try:
+            if not await election.acquire(stop_flag):
+                return
+
+        finally:
+            await runner.cleanup()
+
+        renewal = asyncio.ensure_future(election.renew(stop_flag))
+
+        # If leadership is lost the process is shutdown so that it can't act
+        # as leader at the same time as the replica which took over. As with
+        # kopf shutting down itself, only the process is restarted and not
+        # the whole pod.
+
+        def leadership_lost(_):
+            if not stop_flag.is_set():
+                os.kill(os.getpid(), signal.SIGTERM)
+
+            stop_flag.set()
+
+        renewal.add_done_callback(leadership_lost)
+
+        try:
+            await kopf.operator(
+                clusterwide=True,
+                ready_flag=ready_flag,
+                stop_flag=stop_flag,
+                liveness_endpoint="http://0.0.0.0:8081/healthz",
+            )
+
+        finally:
+            renewal.remove_done_callback(leadership_lost)
+            renewal.cancel()
+
+            await asyncio.get_running_loop().run_in_executor(None, election.release)
+
+    finally:
+        await run_replica_handlers(_replica_cleanup_handlers)
+
+
 def initialize_kopf():
     """Run kopf in a separate thread and register a shutdown handler with
     mod_wsgi to ensure we clean things up properly on process shutdown.
@@ -215,14 +468,7 @@ def initialize_kopf():
         with contextlib.closing(_event_loop):
             # Run event loop until flagged to shutdown.
 
-            _event_loop.run_until_complete(
-                kopf.operator(
-                    clusterwide=True,
-                    ready_flag=ready_flag,
-                    stop_flag=stop_flag,
-                    liveness_endpoint="http://0.0.0.0:8081/healthz",
-                )
-            )
+            _event_loop.run_until_complete(run_operator())
 
             logging.info("Closing asyncio event loop.")
 
@@ -18,10 +18,11 @@ from django.contrib.auth import get_user_model
 from oauth2_provider.models import Application, clear_expired
 
 from ..models import TrainingPortal
+from ..caching import training_portal
 
 from .resources import ResourceBody
-from .operator import background_task, initialize_kopf
-from .locking import resources_lock
+from .operator import background_task, initialize_kopf, on_replica_startup
+from .locking import resources_lock, lock_manager, lock_profiler
 from .environments import (
     update_workshop_environments,
     initiate_workshop_environments,
@@ -36,9 +37,17 @@ from .sessions import (
     initiate_reserved_sessions,
     terminate_reserved_sessions,
     update_session_status,
+    schedule_session_status_updates,
 )
-from .cleanup import cleanup_old_sessions_and_users, purge_expired_workshop_sessions
+from .cleanup import (
+    cleanup_old_sessions_and_users,
+    purge_expired_workshop_sessions,
+    reconcile_session_counters,
+)
+from .informers import workshop_session_index, resync_workshop_session_index
 from .analytics import report_analytics_event
+from .schedules import schedule_broker  # pylint: disable=unused-import
+from .reconciler import reconciler, expire_overdue_workshop_sessions
 
 
 @resources_lock
@@ -295,6 +304,16 @@ def process_training_portal(resource):
 
     portal.save()
 
+    # Where there is a maximum on the number of workshop sessions for the
+    # training portal as a whole, or on the number of workshop sessions a
+    # user can have across all workshop environments, allocating a workshop
+    # session against one workshop environment affects whether any others
+    # can, so operations against workshop environments need to be serialized.
+
+    lock_manager.escalate_environments(
+        sessions_maximum or sessions_registered or sessions_anonymous
+    )
+
     # Calculate the list of workshops, filling in any configuration defaults.
 
     workshops = workshops_configuration(portal, resource)
@@ -324,13 +343,66 @@ def start_hourly_cleanup_task():
 
     clear_expired()
 
+    # Check for drift in the counters of workshop sessions.
 
-@background_task(delay=15.0, repeat=True)
+    reconcile_session_counters().schedule()
+
+    # Delete records of old workshop sessions and anonymous users.
+
+    cleanup_old_sessions_and_users().schedule()
+
+
+# Number of holders of locks included in the periodic summary of lock usage.
+
+LOCK_SUMMARY_ENTRIES = 10
+
+
+@background_task(delay=5*60, repeat=True)
+def start_lock_summary_task():
+    """Periodic task which logs a summary of the time spent waiting for and
+    holding locks since the last summary, for those holding locks longest.
+
+    """
+
+    for entry in lock_profiler.summary()[:LOCK_SUMMARY_ENTRIES]:
+        logging.info(
+            "Lock for %s scope held by %s %d times, waited %.3fs (max %.3fs), "
+            "held %.3fs (max %.3fs).",
+            entry["scope"],
+            entry["holder"],
+            entry["count"],
+            entry["wait"]["total"],
+            entry["wait"]["max"],
+            entry["hold"]["total"],
+            entry["hold"]["max"],
+        )
+
+
+@on_replica_startup
+async def start_replica_tasks():
+    """Starts periodic tasks which are run by every replica of the training
+    portal, and not just the leader.
+
+    """
+
+    start_lock_summary_task().schedule()
+
+
+# Interval at which the periodic reconcilliation task runs where there are
+# multiple replicas of the training portal. Changes made by replicas other
+# than the leader aren't seen by the reconciler, so are only picked up by it.
+
+REPLICATED_RECONCILIATION_INTERVAL = 30.0
+
+
+@background_task(delay=5*60, repeat=True)
 @resources_lock
 @transaction.atomic
 def start_reconciliation_task(name):
     """Periodic reconcilliation task which ensures current deployments of
     workshop environments and workshop sessions matches desired configuration.
+    Changes are normally reconciled as they occur, so this only acts as a
+    backstop for anything which was missed.
 
     """
 
@@ -365,9 +437,29 @@ def start_reconciliation_task(name):
 
     initiate_reserved_sessions(portal).schedule()
 
-    purge_expired_workshop_sessions().schedule()
+    # Queue further tasks to delete any workshop sessions which expired but
+    # which were missed when they did.
 
-    cleanup_old_sessions_and_users().schedule()
+    expire_overdue_workshop_sessions()
+
+
+@background_task(delay=15.0, repeat=True)
+def start_session_checks_task():
+    """Periodic task which checks for workshop sessions which were deleted
+    manually or which have been orphaned. These can only be detected by
+    polling. Workshop sessions which expire are instead deleted by the
+    reconciler, with the periodic reconciliation task as a backstop.
+
+    """
+
+    # Queue further task to perform a full listing of workshop sessions if
+    # the index of deployed workshop sessions hasn't been confirmed recently.
+    # This is needed to detect workshop sessions deleted while not watching.
+
+    if workshop_session_index.requires_resync():
+        resync_workshop_session_index().schedule()
+
+    purge_expired_workshop_sessions().schedule()
 
 
 @kopf.on.event(
@@ -397,9 +489,23 @@ def training_portal_event(event, name, body, **_):
     # for the training portal.
 
     if event["type"] is None:
-        start_reconciliation_task(name).schedule()
+        reconciler.mark_dirty()
+
+        if settings.PORTAL_REPLICAS > 1:
+            start_reconciliation_task(name).schedule(
+                delay=REPLICATED_RECONCILIATION_INTERVAL
+            )
+        else:
+            start_reconciliation_task(name).schedule()
+
+        start_session_checks_task().schedule()
         start_hourly_cleanup_task().schedule()
 
+        # Apply any status updates for workshop sessions which were still
+        # outstanding when the process was last shutdown.
+
+        transaction.on_commit(schedule_session_status_updates)
+
     # Wrap up body of the resource to make it easier to work with later.
 
     resource = ResourceBody(body)
@@ -448,7 +554,7 @@ def workshop_event(event, body, **_):  # pylint: disable=unused-argument
     # so retry the operation after a delay.
 
     try:
-        portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+        portal = training_portal.get()
     except TrainingPortal.DoesNotExist:
         raise kopf.TemporaryError("Training portal is not yet ready.", delay=30)
 
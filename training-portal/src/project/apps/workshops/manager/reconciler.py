@@ -0,0 +1,403 @@
+"""Defines the reconciler which ensures that deployments of workshop
+environments and workshop sessions match the desired configuration.
+
+Rather than checking all workshop environments periodically, changes to the
+training portal, workshop environments and workshop sessions mark the
+workshop environments they affect as dirty, and only those are reconciled.
+The times at which workshop sessions expire, and at which workshop
+environments are due to be refreshed, are held in a heap with a timer armed
+for the earliest, so they are acted on when due. A slow periodic sweep of
+everything remains as a backstop for anything missed.
+
+"""
+
+import heapq
+import logging
+import asyncio
+import threading
+
+from datetime import timedelta
+
+import kopf
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from ..models import (
+    TrainingPortal,
+    Environment,
+    Session,
+    SessionState,
+    session_counters_changed,
+)
+from ..caching import training_portal
+
+from .operator import background_task
+from .locking import session_lock
+from .environments import delete_workshop_environments, refresh_workshop_environments
+from .sessions import terminate_reserved_sessions, initiate_reserved_sessions
+from .cleanup import delete_workshop_session
+from .analytics import report_analytics_event
+
+
+class DeadlineHeap:
+    """Heap of times at which actions identified by a key are due, with a
+    timer on the asyncio loop used by kopf armed for the earliest. Scheduling
+    a key again replaces the time it is due, with the superseded entry being
+    discarded when it reaches the top of the heap. Can be updated from any
+    thread, with the callback being called on the asyncio loop.
+
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._heap = []
+        self._deadlines = {}
+        self._loop = None
+        self._timer = None
+
+    def start(self, loop):
+        with self._lock:
+            self._loop = loop
+
+        loop.call_soon_threadsafe(self._arm)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        with self._lock:
+            self._loop = None
+
+    def schedule(self, key, deadline):
+        """Sets the time at which the action for the key is due. Deadlines
+        are only tracked once started, as is only done by the replica of the
+        training portal elected as leader, with existing deadlines being
+        loaded at that point.
+
+        """
+
+        with self._lock:
+            if self._loop is None or self._deadlines.get(key) == deadline:
+                return
+
+            self._deadlines[key] = deadline
+
+            heapq.heappush(self._heap, (deadline, key))
+
+            loop = self._loop
+
+        if loop is not None:
+            loop.call_soon_threadsafe(self._arm)
+
+    def cancel(self, key):
+        """Cancels any pending action for the key."""
+
+        with self._lock:
+            self._deadlines.pop(key, None)
+
+    def _arm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._loop is None:
+            return
+
+        with self._lock:
+            while self._heap:
+                deadline, key = self._heap[0]
+
+                if self._deadlines.get(key) == deadline:
+                    break
+
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                return
+
+            deadline = self._heap[0][0]
+
+        delay = max(0.0, (deadline - timezone.now()).total_seconds())
+
+        self._timer = self._loop.call_later(delay, self._expire)
+
+    def _expire(self):
+        self._timer = None
+
+        now = timezone.now()
+
+        due = []
+
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, key = heapq.heappop(self._heap)
+
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    due.append(key)
+
+        for key in due:
+            try:
+                self._callback(key)
+
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to action deadline for %s.", key)
+
+        self._arm()
+
+
+class Reconciler:
+    """Tracks the workshop environments which need to be reconciled, by the
+    ids of the workshop environments. Marking a workshop environment as dirty
+    schedules a task to reconcile it. As identical tasks waiting to run are
+    coalesced, changes to many workshop environments in quick succession will
+    be reconciled together.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._everything = False
+        self._active = False
+        self.deadlines = DeadlineHeap(self._deadline_reached)
+
+    def start(self, loop):
+        with self._lock:
+            self._active = True
+
+        self.deadlines.start(loop)
+
+        reconcile_dirty_environments().schedule()
+
+    def stop(self):
+        with self._lock:
+            self._active = False
+
+        self.deadlines.stop()
+
+    def mark_dirty(self, environment_id=None):
+        """Marks the workshop environment as needing to be reconciled. If no
+        workshop environment is supplied, all are marked as dirty.
+
+        """
+
+        with self._lock:
+            if environment_id is None:
+                self._everything = True
+            else:
+                self._dirty.add(environment_id)
+
+            active = self._active
+
+        if active:
+            reconcile_dirty_environments().schedule()
+
+    def take_dirty(self):
+        """Returns the set of ids for workshop environments which are dirty,
+        or None if all are, clearing the set at the same time.
+
+        """
+
+        with self._lock:
+            environment_ids = None if self._everything else frozenset(self._dirty)
+
+            self._dirty = set()
+            self._everything = False
+
+        return environment_ids
+
+    def _deadline_reached(self, key):
+        kind, value = key
+
+        if kind == "session":
+            expire_workshop_session(value).schedule()
+
+        elif kind == "environment":
+            self.mark_dirty(value)
+
+
+reconciler = Reconciler()
+
+
+@background_task
+def reconcile_dirty_environments():
+    """Reconciles those workshop environments marked as dirty."""
+
+    environment_ids = reconciler.take_dirty()
+
+    if environment_ids is not None and not environment_ids:
+        return
+
+    try:
+        portal = training_portal.get()
+    except TrainingPortal.DoesNotExist:
+        return
+
+    # Where the training portal defines a maximum number of workshop sessions,
+    # a change to the workshop sessions for one workshop environment can affect
+    # whether reserved sessions can be created for any other.
+
+    if portal.sessions_maximum:
+        environment_ids = None
+
+    # Otherwise each workshop environment is reconciled separately, holding
+    # only the lock for that workshop environment.
+
+    if environment_ids is None:
+        environment_names = [None]
+    else:
+        environment_names = Environment.objects.filter(
+            pk__in=environment_ids
+        ).values_list("name", flat=True)
+
+    for environment_name in environment_names:
+        delete_workshop_environments(portal, environment_name).schedule()
+
+        terminate_reserved_sessions(portal, environment_name).schedule()
+
+        refresh_workshop_environments(portal, environment_name).schedule()
+
+        initiate_reserved_sessions(portal, environment_name).schedule()
+
+
+@background_task
+@session_lock(lambda name: name)
+@transaction.atomic
+def expire_workshop_session(name):
+    """Deletes the workshop session if it is in use and has expired."""
+
+    try:
+        session = Session.objects.select_related("environment").get(name=name)
+    except Session.DoesNotExist:
+        return
+
+    if not session.is_allocated() and not session.is_stopping():
+        return
+
+    if session.expires and session.expires <= timezone.now():
+        logging.info("Session %s expired. Deleting session.", session.name)
+
+        report_analytics_event(session, "Session/Expired")
+
+        delete_workshop_session(session).schedule()
+
+
+# Workshop sessions are deleted when they expire using the heap of deadlines.
+# Any still in use which expired more than this long ago are assumed to have
+# been missed, and are deleted by the periodic reconciliation task instead.
+
+EXPIRY_BACKSTOP_DELAY = timedelta(minutes=5)
+
+
+def expire_overdue_workshop_sessions():
+    """Schedules deletion of workshop sessions in use which expired a while
+    ago, but which weren't deleted when they expired.
+
+    """
+
+    cutoff = timezone.now() - EXPIRY_BACKSTOP_DELAY
+
+    sessions = Session.objects.filter(
+        Q(owner__isnull=False) | Q(state=SessionState.STOPPING),
+        expires__lte=cutoff,
+    ).exclude(state=SessionState.STOPPED)
+
+    for name in sessions.values_list("name", flat=True):
+        expire_workshop_session(name).schedule()
+
+
+def session_deadline(session):
+    """Updates the time at which the workshop session expires."""
+
+    key = ("session", session.name)
+
+    if session.expires and session.state != SessionState.STOPPED:
+        reconciler.deadlines.schedule(key, session.expires)
+    else:
+        reconciler.deadlines.cancel(key)
+
+
+def environment_deadline(environment):
+    """Updates the time at which the workshop environment is due to be
+    refreshed.
+
+    """
+
+    key = ("environment", environment.pk)
+
+    if environment.is_running() and environment.refresh.total_seconds():
+        reconciler.deadlines.schedule(key, environment.created_at + environment.refresh)
+    else:
+        reconciler.deadlines.cancel(key)
+
+
+@background_task
+def load_deadlines():
+    """Loads the times at which existing workshop sessions expire, and at
+    which workshop environments are due to be refreshed.
+
+    """
+
+    sessions = Session.objects.exclude(state=SessionState.STOPPED).filter(
+        expires__isnull=False
+    )
+
+    for session in sessions.only("name", "expires", "state"):
+        session_deadline(session)
+
+    for environment in Environment.objects.exclude(refresh=timedelta()):
+        environment_deadline(environment)
+
+
+def _portal_saved(**_):
+    transaction.on_commit(reconciler.mark_dirty)
+
+
+def _environment_saved(instance, **_):
+    def changed():
+        environment_deadline(instance)
+        reconciler.mark_dirty(instance.pk)
+
+    transaction.on_commit(changed)
+
+
+def _session_saved(instance, **_):
+    transaction.on_commit(lambda: session_deadline(instance))
+
+
+def _session_counters_changed(changed, **_):
+    # Whether reserved sessions need to be created or deleted only depends on
+    # the counters of workshop sessions, so saving a workshop session where
+    # they don't change, such as when it is extended, doesn't mark the
+    # workshop environment as dirty.
+
+    def mark_dirty():
+        for environment_id in changed:
+            reconciler.mark_dirty(environment_id)
+
+    transaction.on_commit(mark_dirty)
+
+
+post_save.connect(_portal_saved, sender="workshops.TrainingPortal")
+post_save.connect(_environment_saved, sender="workshops.Environment")
+post_save.connect(_session_saved, sender="workshops.Session")
+
+session_counters_changed.connect(_session_counters_changed)
+
+
+@kopf.on.startup()
+async def start_reconciler(**_):
+    reconciler.start(asyncio.get_running_loop())
+
+    load_deadlines().schedule()
+
+
+@kopf.on.cleanup()
+async def stop_reconciler(**_):
+    reconciler.stop()
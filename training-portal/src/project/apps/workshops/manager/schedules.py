@@ -0,0 +1,345 @@
+"""Defines a stream of changes to the schedule of workshop sessions, so that
+workshop dashboards don't need to poll for how long a workshop session has
+remaining. Changes are pushed to clients as server-sent events when a
+workshop session is saved. The stream is served by an HTTP server running
+on the asyncio loop used by kopf, so an idle client only costs a queue and
+a connection, rather than tying up a request thread of the portal.
+
+"""
+
+import json
+import asyncio
+
+from datetime import timedelta
+
+from aiohttp import web
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from oauth2_provider.models import AccessToken
+
+from ..models import SessionState
+from ..caching import training_portal
+
+from .operator import on_replica_startup, on_replica_cleanup
+
+
+# Port the server for the stream listens on, and the interval at which a
+# comment is sent on an otherwise idle stream to keep the connection open.
+
+SCHEDULE_EVENTS_PORT = 8082
+
+SCHEDULE_HEARTBEAT_INTERVAL = 15.0
+
+
+def schedule_details(instance):
+    """Returns details about how long the workshop session is scheduled."""
+
+    details = {}
+
+    details["status"] = SessionState(instance.state).name
+
+    details["started"] = instance.started
+    details["expires"] = instance.expires
+
+    details["expiring"] = instance.is_expiring()
+
+    remaining = instance.time_remaining()
+
+    if remaining is not None:
+        details["countdown"] = remaining
+        details["extendable"] = instance.is_extension_permitted()
+
+    return details
+
+
+def schedule_refresh_time(instance):
+    """Returns when the details of the schedule for the workshop session will
+    next change purely due to time passing, or None if they will not.
+
+    """
+
+    if not instance.expires:
+        return None
+
+    now = timezone.now()
+
+    # The workshop session is flagged as expiring, and then as extendable,
+    # once the time remaining drops below the respective thresholds.
+
+    times = [
+        instance.expires - timedelta(seconds=instance.extension_threshold()),
+        instance.expires - timedelta(seconds=instance.extension_duration()),
+        instance.expires,
+    ]
+
+    times = [value for value in times if value > now]
+
+    return times and min(times) or None
+
+
+class ScheduleBroker:
+    """Tracks the clients subscribed to changes to the schedule of each
+    workshop session and runs the server for the stream. Subscriptions are
+    only changed from the asyncio loop used by kopf, but changes can be
+    published from any thread.
+
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._runner = None
+        self._subscribers = {}
+
+    def subscribed(self, name):
+        """Returns whether any clients are subscribed to the workshop
+        session.
+
+        """
+
+        return name in self._subscribers
+
+    def subscribe(self, name):
+        # Only the latest schedule matters, so a queue holds at most one
+        # update which hasn't yet been sent to the client.
+
+        queue = asyncio.Queue(maxsize=1)
+
+        self._subscribers.setdefault(name, set()).add(queue)
+
+        return queue
+
+    def unsubscribe(self, name, queue):
+        queues = self._subscribers.get(name, set())
+
+        queues.discard(queue)
+
+        if not queues:
+            self._subscribers.pop(name, None)
+
+    def publish(self, instance):
+        """Sends the current schedule for the workshop session to any clients
+        subscribed to it. Can be called from any thread.
+
+        """
+
+        loop = self._loop
+
+        if loop is None or not self.subscribed(instance.name):
+            return
+
+        update = (schedule_details(instance), schedule_refresh_time(instance))
+
+        loop.call_soon_threadsafe(self._dispatch, instance.name, update)
+
+    def _dispatch(self, name, update):
+        for queue in self._subscribers.get(name, ()):
+            if queue.full():
+                queue.get_nowait()
+
+            queue.put_nowait(update)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+
+        app = web.Application()
+
+        app.router.add_get(
+            "/workshops/session/{name}/schedule/events/", session_schedule_events
+        )
+
+        self._runner = web.AppRunner(app)
+
+        await self._runner.setup()
+
+        site = web.TCPSite(
+            self._runner, port=SCHEDULE_EVENTS_PORT, shutdown_timeout=2.0
+        )
+
+        await site.start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+        self._loop = None
+
+
+schedule_broker = ScheduleBroker()
+
+
+def _session_saved(instance, **_):
+    if schedule_broker.subscribed(instance.name):
+        transaction.on_commit(lambda: schedule_broker.publish(instance))
+
+
+post_save.connect(_session_saved, sender="workshops.Session")
+
+
+def _allocated_session(name):
+    portal = training_portal.get()
+
+    return portal.allocated_session(name)
+
+
+@sync_to_async(thread_sensitive=False)
+def _authorize_client(name, token):
+    """Validates the access token and checks that the user is permitted to
+    access the workshop session, as done by the view for the schedule of a
+    workshop session. Returns the current schedule for the workshop session
+    and when the access token expires.
+
+    """
+
+    access_token = AccessToken.objects.select_related("user").filter(token=token)
+    access_token = access_token.first()
+
+    if access_token is None or not access_token.is_valid():
+        raise web.HTTPForbidden(text="Access token is not valid")
+
+    instance = _allocated_session(name)
+
+    if not instance:
+        raise web.HTTPNotFound(text="Session does not exist")
+
+    # Check that are owner of session, a robot account, or a staff member.
+
+    user = access_token.user
+
+    if not user.is_staff and not user.groups.filter(name="robots").exists():
+        if instance.owner != user:
+            raise web.HTTPForbidden(text="Access to session not permitted")
+
+    update = (schedule_details(instance), schedule_refresh_time(instance))
+
+    return update, access_token.expires
+
+
+@sync_to_async(thread_sensitive=False)
+def _refresh_schedule(name):
+    instance = _allocated_session(name)
+
+    if not instance:
+        return None
+
+    return schedule_details(instance), schedule_refresh_time(instance)
+
+
+def _schedule_unchanged(previous, current):
+    """Returns whether the schedule is unchanged, ignoring the countdown
+    which is always changing.
+
+    """
+
+    def ignore_countdown(details):
+        return {key: value for key, value in details.items() if key != "countdown"}
+
+    return ignore_countdown(previous) == ignore_countdown(current)
+
+
+async def session_schedule_events(request):
+    """Streams the schedule of the workshop session as server-sent events,
+    sending the current schedule and then any changes to it. The stream is
+    closed once the workshop session is stopping, or when the access token
+    used expires, in which case the client would reconnect with a new token.
+
+    """
+
+    name = request.match_info["name"]
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+
+    if scheme.lower() != "bearer" or not token:
+        raise web.HTTPForbidden(text="Access token is required")
+
+    # Subscribe before reading the current schedule so no change made in
+    # between can be missed.
+
+    queue = schedule_broker.subscribe(name)
+
+    try:
+        update, token_expires = await _authorize_client(name, token)
+
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            }
+        )
+
+        await response.prepare(request)
+
+        while update:
+            details, refresh = update
+
+            data = json.dumps(details, cls=DjangoJSONEncoder)
+
+            await response.write(f"data: {data}\n\n".encode("utf-8"))
+
+            if details["status"] in ("STOPPING", "STOPPED"):
+                break
+
+            update = None
+
+            while update is None:
+                now = timezone.now()
+
+                if now >= token_expires:
+                    return response
+
+                timeout = min(
+                    SCHEDULE_HEARTBEAT_INTERVAL, (token_expires - now).total_seconds()
+                )
+
+                if refresh:
+                    timeout = min(timeout, max(0.0, (refresh - now).total_seconds()))
+
+                try:
+                    update = await asyncio.wait_for(queue.get(), timeout)
+
+                except asyncio.TimeoutError:
+                    if refresh and timezone.now() >= refresh:
+                        update = await _refresh_schedule(name)
+
+                        if update is None:
+                            return response
+
+                    elif settings.PORTAL_REPLICAS > 1:
+                        # Changes saved by another replica of the training
+                        # portal aren't published to this one, so check for
+                        # any on each heartbeat instead.
+
+                        update = await _refresh_schedule(name)
+
+                        if update is None:
+                            return response
+
+                        if _schedule_unchanged(details, update[0]):
+                            update = None
+
+                            await response.write(b": keepalive\n\n")
+
+                    else:
+                        await response.write(b": keepalive\n\n")
+
+        return response
+
+    finally:
+        schedule_broker.unsubscribe(name, queue)
+
+
+@on_replica_startup
+async def start_schedule_server():
+    await schedule_broker.start()
+
+
+@on_replica_cleanup
+async def stop_schedule_server():
+    await schedule_broker.stop()
@@ -5,26 +5,34 @@
 import string
 import random
 import logging
-import traceback
+import threading
 import base64
+import time
 
+from datetime import timedelta
 from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pykube
 import rstr
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
 
 from oauth2_provider.models import Application
 
-from ..models import Session
+from ..models import Environment, Session, SessionStatusUpdate
 
 from .operator import background_task
-from .locking import resources_lock
+from .locking import environment_or_resources_lock, allocation_lock
 from .analytics import report_analytics_event
+from .informers import workshop_session_index
+from .schedules import SCHEDULE_EVENTS_PORT
+from .metrics import session_allocation_duration, kubernetes_request_duration
 
 api = pykube.HTTPClient(pykube.KubeConfig.from_env())
 
@@ -131,17 +139,18 @@ def create_request_resources(session):
     resource.create()
 
 
-def update_session_status(name, phase):
+def apply_session_status(name, phase):
     """Update the status of the Kubernetes resource object for the workshop
-    session.
+    session. Errors are raised to the caller so that the update can be
+    retried.
 
     """
 
-    try:
-        K8SWorkshopSession = pykube.object_factory(
-            api, f"training.{settings.OPERATOR_API_GROUP}/v1beta1", "WorkshopSession"
-        )
+    K8SWorkshopSession = pykube.object_factory(
+        api, f"training.{settings.OPERATOR_API_GROUP}/v1beta1", "WorkshopSession"
+    )
 
+    with kubernetes_request_duration.labels("update_session_status").time():
         resource = K8SWorkshopSession.objects(api).get(name=name)
 
         # The status may not exist as yet if not processed by the operator.
@@ -153,17 +162,153 @@ def update_session_status(name, phase):
         )["phase"] = phase
         resource.update()
 
-    except pykube.exceptions.ObjectDoesNotExist:
-        pass
 
-    except pykube.exceptions.PyKubeError:
-        logging.error("Failed to update status of workshop session %s.", name)
+def update_session_status(name, phase):
+    """Record the desired status of the Kubernetes resource object for the
+    workshop session. The record is written in the current transaction and
+    is only applied to the Kubernetes resource after the transaction has been
+    committed, so the caller doesn't wait on the Kubernetes REST API.
 
-        traceback.print_exc()
+    """
 
+    SessionStatusUpdate.objects.create(name=name, phase=phase)
 
-def create_workshop_session(session, secret):
-    """Triggers the deployment of a new workshop session to the cluster."""
+    transaction.on_commit(schedule_session_status_updates)
+
+
+STATUS_UPDATES_BATCH_SIZE = 50
+STATUS_UPDATES_MAX_ATTEMPTS = 5
+STATUS_UPDATES_MAX_DELAY = 60
+
+# Where the Kubernetes resource for the workshop session doesn't exist it may
+# not have been created as yet, which can take a while when many workshop
+# sessions are being created at once, so these are retried for longer. With
+# the delay between attempts capped, this is about ten minutes.
+
+STATUS_UPDATES_MAX_ATTEMPTS_NOT_FOUND = 15
+
+_status_updates_lock = threading.Lock()
+_status_updates_scheduled = False
+
+
+def schedule_session_status_updates(delay=0.0):
+    """Schedule a task to apply any outstanding status updates for workshop
+    sessions. Only one such task is queued at any time.
+
+    """
+
+    global _status_updates_scheduled  # pylint: disable=global-statement
+
+    with _status_updates_lock:
+        if _status_updates_scheduled:
+            return
+
+        _status_updates_scheduled = True
+
+    apply_session_status_updates().schedule(delay=delay)
+
+
+def retry_session_status_update(update, now, max_attempts):
+    """Record a failed attempt to apply a status update for a workshop
+    session, along with any earlier updates it replaced, so it is retried
+    after a delay. The status update is discarded if the maximum number of
+    attempts has been reached. Must be called while handling the exception.
+
+    """
+
+    updates = SessionStatusUpdate.objects.filter(name=update.name, id__lte=update.id)
+
+    attempts = update.attempts + 1
+
+    if attempts >= max_attempts:
+        logging.exception(
+            "Failed to update status of workshop session %s.", update.name
+        )
+
+        updates.delete()
+
+    else:
+        delay = min(2**attempts, STATUS_UPDATES_MAX_DELAY)
+
+        updates.update(attempts=attempts, not_before=now + timedelta(seconds=delay))
+
+
+_status_updates_worker_lock = threading.Lock()
+
+
+@background_task
+def apply_session_status_updates():
+    """Apply outstanding status updates for workshop sessions to the
+    Kubernetes resources in batches. Where multiple updates are outstanding
+    for the same workshop session only the most recent is applied. Updates
+    which fail are retried with an increasing delay.
+
+    """
+
+    global _status_updates_scheduled  # pylint: disable=global-statement
+
+    with _status_updates_lock:
+        _status_updates_scheduled = False
+
+    with _status_updates_worker_lock:
+        try:
+            while True:
+                now = timezone.now()
+
+                updates = list(
+                    SessionStatusUpdate.objects.filter(not_before__lte=now).order_by(
+                        "id"
+                    )[:STATUS_UPDATES_BATCH_SIZE]
+                )
+
+                if not updates:
+                    break
+
+                latest = {}
+
+                for update in updates:
+                    latest[update.name] = update
+
+                for name, update in latest.items():
+                    try:
+                        apply_session_status(name, update.phase)
+
+                    except pykube.exceptions.ObjectDoesNotExist:
+                        retry_session_status_update(
+                            update, now, STATUS_UPDATES_MAX_ATTEMPTS_NOT_FOUND
+                        )
+
+                    except Exception:  # pylint: disable=broad-except
+                        # This includes errors from pykube, and where the
+                        # Kubernetes REST API couldn't be contacted at all.
+
+                        retry_session_status_update(
+                            update, now, STATUS_UPDATES_MAX_ATTEMPTS
+                        )
+
+                    else:
+                        SessionStatusUpdate.objects.filter(
+                            name=name, id__lte=update.id
+                        ).delete()
+
+        finally:
+            # Schedule a further run for when the next of any updates which
+            # are being retried is due. This is done even if an unexpected
+            # error occurred, so that outstanding updates aren't stranded.
+
+            pending = SessionStatusUpdate.objects.order_by("not_before").first()
+
+            if pending:
+                delay = (pending.not_before - timezone.now()).total_seconds()
+                schedule_session_status_updates(delay=max(0.1, delay))
+
+
+def workshop_session_resource(session, secret):
+    """Returns the Kubernetes resource for a new workshop session, along with
+    the config password for the workshop session. The resource still needs
+    to be created in the cluster.
+
+    """
 
     # Calculate the additional set of environment variables to configure the
     # workshop session for use with the training portal. These are on top of
@@ -178,9 +323,11 @@ def create_workshop_session(session, secret):
 
     portal_url = f"{settings.INGRESS_PROTOCOL}://{settings.PORTAL_HOSTNAME}"
     portal_api_url = f"http://training-portal.{settings.PORTAL_NAME}-ui"
+    portal_events_url = f"{portal_api_url}:{SCHEDULE_EVENTS_PORT}"
 
     session_env.append({"name": "PORTAL_URL", "value": portal_url})
     session_env.append({"name": "PORTAL_API_URL", "value": portal_api_url})
+    session_env.append({"name": "PORTAL_EVENTS_URL", "value": portal_events_url})
     session_env.append({"name": "SESSION_NAME", "value": session.name})
     session_env.append({"name": "TRAINING_PORTAL", "value": settings.PORTAL_NAME})
     session_env.append({"name": "FRAME_ANCESTORS", "value": settings.FRAME_ANCESTORS})
@@ -269,8 +416,16 @@ def create_workshop_session(session, secret):
         api, f"training.{settings.OPERATOR_API_GROUP}/v1beta1", "WorkshopSession"
     )
 
-    resource = K8SWorkshopSession(api, session_body)
-    resource.create()
+    return K8SWorkshopSession(api, session_body), config_password
+
+
+def workshop_session_created(session, resource, config_password):
+    """Updates the database record for a workshop session once the Kubernetes
+    resource for it has been created in the cluster.
+
+    """
+
+    workshop_session_index.observe(session.name)
 
     session.uid = resource.obj["metadata"]["uid"]
     session.password = config_password
@@ -301,25 +456,81 @@ def create_workshop_session(session, secret):
         session.mark_as_waiting()
 
 
-def setup_workshop_session(environment, **session_kwargs):
-    """Setup database objects pertaining to a new workshop session."""
+def create_workshop_session(session, secret):
+    """Triggers the deployment of a new workshop session to the cluster."""
 
-    # Increase tally for number of workshop sessions created for the workshop
-    # environment and calculate session name. Ensure changed value for tally
-    # is saved.
+    resource, config_password = workshop_session_resource(session, secret)
+
+    resource.create()
 
-    tally = environment.tally = environment.tally + 1
+    workshop_session_created(session, resource, config_password)
+
+
+# Maximum number of concurrent requests made to the Kubernetes REST API, or
+# concurrent threads hashing client secrets, when creating a batch of workshop
+# sessions. This is kept below the size of the connection pool used by the
+# Kubernetes REST API client.
+
+SESSION_CREATION_CONCURRENCY = 8
+
+
+def create_workshop_session_resource(resource):
+    """Creates the Kubernetes resource for a workshop session, recording the
+    time taken by the request.
+
+    """
+
+    with kubernetes_request_duration.labels("create_workshop_session").time():
+        resource.create()
 
-    session_id = f"s{tally:03}"
-    session_name = f"{environment.name}-{session_id}"
 
-    environment.save()
+def create_workshop_sessions(sessions):
+    """Triggers the deployment of a batch of new workshop sessions to the
+    cluster. Requests to create the Kubernetes resources are pipelined, with
+    the database record for each workshop session being updated as each
+    completes. A failure for one workshop session doesn't prevent the rest
+    being created.
 
-    # Calculate the set of redirect URIs that the OAuth provider application
-    # needs to trust. Needs to be enumerated as can't use a wildcard, As such,
-    # need a redirect URI for the main workshop URL, one for each embedded
-    # application such as the console, plus one for each ingress as they are
-    # proxied via the workshop gateway and so are also covered by OAuth.
+    """
+
+    if not sessions:
+        return
+
+    with ThreadPoolExecutor(max_workers=SESSION_CREATION_CONCURRENCY) as executor:
+        pending = {}
+
+        for session, secret in sessions:
+            resource, config_password = workshop_session_resource(session, secret)
+            future = executor.submit(create_workshop_session_resource, resource)
+            pending[future] = (session, resource, config_password)
+
+        # Database updates are only made from this thread, so the threads of
+        # the pool only ever make requests against the Kubernetes REST API.
+
+        for future in as_completed(pending):
+            session, resource, config_password = pending[future]
+
+            try:
+                future.result()
+
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to create workshop session %s.", session.name)
+
+                continue
+
+            workshop_session_created(session, resource, config_password)
+
+
+def oauth_redirect_uris(environment, session_name):
+    """Calculate the set of redirect URIs that the OAuth provider application
+    for a workshop session needs to trust.
+
+    """
+
+    # Needs to be enumerated as can't use a wildcard, As such, need a redirect
+    # URI for the main workshop URL, one for each embedded application such as
+    # the console, plus one for each ingress as they are proxied via the
+    # workshop gateway and so are also covered by OAuth.
 
     def redirect_uri_for_oauth_callback(name=None):
         def build_url(host):
@@ -352,6 +563,22 @@ def setup_workshop_session(environment, **session_kwargs):
     for ingress in ingresses:
         redirect_uris.extend(redirect_uri_for_oauth_callback(ingress["name"]))
 
+    return redirect_uris
+
+
+def setup_workshop_session(environment, **session_kwargs):
+    """Setup database objects pertaining to a new workshop session."""
+
+    # Increase tally for number of workshop sessions created for the workshop
+    # environment and calculate session name. The tally is incremented in the
+    # database, rather than saving the workshop environment, so that this
+    # isn't seen as a change to the workshop environment itself.
+
+    session_id = reserve_session_ids(environment, 1)[0]
+    session_name = f"{environment.name}-{session_id}"
+
+    redirect_uris = oauth_redirect_uris(environment, session_name)
+
     # Create the OAuth provider application record. Each workshop session
     # has a unique application record tied to the URLs for that specific
     # workshop session.
@@ -389,6 +616,97 @@ def setup_workshop_session(environment, **session_kwargs):
     return session, secret
 
 
+def reserve_session_ids(environment, count):
+    """Reserves a range of the tally of workshop sessions created for the
+    workshop environment with a single update, returning the ids for the
+    workshop sessions.
+
+    """
+
+    Environment.objects.filter(pk=environment.pk).update(tally=F("tally") + count)
+
+    environment.refresh_from_db(fields=["tally"])
+
+    first = environment.tally - count + 1
+
+    return [f"s{tally:03}" for tally in range(first, environment.tally + 1)]
+
+
+def setup_workshop_sessions(environment, count, **session_kwargs):
+    """Setup database objects pertaining to a batch of new workshop sessions.
+    Equivalent to calling setup_workshop_session() the number of times given
+    by count, but using a fixed number of queries.
+
+    """
+
+    if count <= 0:
+        return []
+
+    session_ids = reserve_session_ids(environment, count)
+
+    User = get_user_model()  # pylint: disable=invalid-name
+
+    admin_user = User.objects.get(username=settings.ADMIN_USERNAME)
+
+    characters = string.ascii_letters + string.digits
+    secrets = ["".join(random.sample(characters, 32)) for _ in session_ids]
+
+    # The client secret of the OAuth provider application record is hashed
+    # when saved. Since this is expensive and the hashing function releases
+    # the GIL, hash them in parallel up front rather than leaving it to be
+    # done one at a time when the records are inserted.
+
+    with ThreadPoolExecutor(max_workers=SESSION_CREATION_CONCURRENCY) as executor:
+        hashed_secrets = list(executor.map(make_password, secrets))
+
+    applications = []
+
+    for session_id, hashed_secret in zip(session_ids, hashed_secrets):
+        session_name = f"{environment.name}-{session_id}"
+
+        applications.append(
+            Application(
+                name=session_name,
+                client_id=session_name,
+                user=admin_user,
+                redirect_uris=" ".join(oauth_redirect_uris(environment, session_name)),
+                client_type="public",
+                authorization_grant_type="authorization-code",
+                client_secret=hashed_secret,
+                skip_authorization=True,
+            )
+        )
+
+    applications = Application.objects.bulk_create(applications)
+
+    # Not all database backends return the primary keys of inserted records,
+    # in which case need to look them up again.
+
+    if any(application.pk is None for application in applications):
+        inserted = Application.objects.in_bulk(
+            [application.client_id for application in applications],
+            field_name="client_id",
+        )
+
+        applications = [inserted[application.client_id] for application in applications]
+
+    created = session_kwargs.get("started", timezone.now())
+
+    sessions = Session.bulk_create_sessions(
+        Session(
+            name=application.name,
+            id=session_id,
+            application=application,
+            created=created,
+            environment=environment,
+            **session_kwargs,
+        )
+        for session_id, application in zip(session_ids, applications)
+    )
+
+    return list(zip(sessions, secrets))
+
+
 def create_new_session(environment):
     """Setup a record for the workshop session in the database and schedule
     a task to deploy the workshop session in the cluster.
@@ -420,6 +738,15 @@ def replace_reserved_session(environment):
     if not environment.reserved:
         return
 
+    # Ensure we are working with the current counts of workshop sessions, as
+    # the workshop environment may have been loaded separately to any workshop
+    # session which was just changed, or before another replica of the
+    # training portal changed them.
+
+    allocation_lock(environment.portal, [environment.pk])
+
+    environment.refresh_session_counters()
+
     # Check that haven't already reached limit on number of reserved sessions.
 
     if environment.available_sessions_count() >= environment.reserved:
@@ -446,19 +773,31 @@ def replace_reserved_session(environment):
 
 
 @background_task
-@resources_lock
+@environment_or_resources_lock(lambda portal, environment_name=None: environment_name)
 @transaction.atomic
-def terminate_reserved_sessions(portal):
+def terminate_reserved_sessions(portal, environment_name=None):
     """Terminate any reserved workshop sessions which put a workshop
     environment over the count for how many reserved sessions they are
-    allowed.
+    allowed. If the name of a workshop environment is supplied only that one
+    is checked.
 
     """
 
+    environments = portal.running_environments()
+
+    if environment_name is not None:
+        environments = environments.filter(name=environment_name)
+
+    # Workshop sessions can be allocated by other replicas of the training
+    # portal, so lock them out before looking at the counts of workshop
+    # sessions. The workshop environments are only loaded after this.
+
+    allocation_lock(portal, environments.values_list("pk", flat=True))
+
     # First kill of reserved sessions for each workshop environment where
     # they are over what is allowed for that workshop environment.
 
-    for environment in portal.running_environments():
+    for environment in environments:
         # If initial number of sessions is greater than reserved sessions then
         # don't reconcile until after number of sessions would fall below the
         # required reserved number. Note that this doesn't really deal properly
@@ -496,16 +835,28 @@ def terminate_reserved_sessions(portal):
 
 
 @background_task
-@resources_lock
+@environment_or_resources_lock(lambda portal, environment_name=None: environment_name)
 @transaction.atomic
-def initiate_reserved_sessions(portal):
+def initiate_reserved_sessions(portal, environment_name=None):
     """Create additional reserved sessions if necessary to satisfy stated
     reserved count for a workshop environment. Don't create a reserved session
     if this would put the workshop environment of the training portal over any
-    maximum capacity.
+    maximum capacity. If the name of a workshop environment is supplied only
+    that one is checked.
 
     """
 
+    environments = portal.running_environments()
+
+    if environment_name is not None:
+        environments = environments.filter(name=environment_name)
+
+    # Workshop sessions can be allocated by other replicas of the training
+    # portal, so lock them out before looking at the counts of workshop
+    # sessions. The workshop environments are only loaded after this.
+
+    allocation_lock(portal, environments.values_list("pk", flat=True))
+
     sessions = []
 
     # Need a different approach when maximum number of sessions defined for
@@ -516,7 +867,7 @@ def initiate_reserved_sessions(portal):
         # No global maximum on number of sessions for training portal. In
         # this case can check easch workshop environment independently.
 
-        for environment in portal.running_environments():
+        for environment in environments:
             # If reserved sessions not required, skip to next one.
 
             if environment.reserved == 0:
@@ -553,8 +904,7 @@ def initiate_reserved_sessions(portal):
 
             spare_sessions = min(spare_reserved, spare_capacity)
 
-            for _ in range(spare_sessions):
-                sessions.append(setup_workshop_session(environment))
+            sessions.extend(setup_workshop_sessions(environment, spare_sessions))
 
     else:
         # Maximum number of sessions for training portal in force, so work out
@@ -568,7 +918,7 @@ def initiate_reserved_sessions(portal):
 
         # Now check each separate workshop environment.
 
-        for environment in portal.running_environments():
+        for environment in environments:
             # If reserved sessions not required, skip to next one.
 
             if environment.reserved == 0:
@@ -603,13 +953,13 @@ def initiate_reserved_sessions(portal):
                 spare_capacity,
             )
 
-            for _ in range(spare_sessions):
-                sessions.append(setup_workshop_session(environment))
+            if spare_sessions > 0:
+                sessions.extend(setup_workshop_sessions(environment, spare_sessions))
 
                 # Reduce count of how much capacity still have for the
                 # training portal as a whole.
 
-                spare_capacity -= 1
+                spare_capacity -= spare_sessions
 
             # Bail out if reached capacity for the whole training portal.
 
@@ -619,8 +969,7 @@ def initiate_reserved_sessions(portal):
     # Schedule the actual creation of the reserved sessions.
 
     def _schedule_session_creation():
-        for session, secret in sessions:
-            create_workshop_session(session, secret)
+        create_workshop_sessions(sessions)
 
     transaction.on_commit(_schedule_session_creation)
 
@@ -673,6 +1022,12 @@ def create_session_for_user(environment, user, token, timeout=None, params={}):
 
     """
 
+    # Ensure we are working with the current counts of workshop sessions, as
+    # they may have been changed by another replica of the training portal
+    # before the lock on allocations was acquired.
+
+    environment.refresh_session_counters()
+
     # Check first if not exceeding the capacity of the workshop environment.
     # Using the active session count here, which includes workshop sessions
     # which are in reserve, but we would only usually be called in situation
@@ -781,6 +1136,19 @@ def retrieve_session_for_user(environment, user, token=None, timeout=None, param
 
     """
 
+    started = time.monotonic()
+
+    # Where there are multiple replicas of the training portal, the locks
+    # held by the caller don't exclude requests handled by other replicas,
+    # so checks against capacity and the maximum number of workshop sessions
+    # also need to be serialized in the database.
+
+    allocation_lock(environment.portal, [environment.pk])
+
+    def allocated(outcome, session):
+        session_allocation_duration.labels(outcome).observe(time.monotonic() - started)
+        return session
+
     # Note that we assume that if the session is marked as stopping we
     # should not use it since it should be in the process of being deleted.
     # In that case we will create a new one even though it means user will
@@ -791,14 +1159,14 @@ def retrieve_session_for_user(environment, user, token=None, timeout=None, param
     if session and not session.is_stopping():
         if token and session.is_pending():
             session.mark_as_pending(user, token, timeout)
-        return session
+        return allocated("existing", session)
 
     # Determine if the user is permitted to create a workshop session.
 
     portal = environment.portal
 
     if not portal.session_permitted_for_user(user):
-        return
+        return allocated("denied", None)
 
     # Attempt to allocate a session to the user for the workshop environment
     # from any set of reserved sessions.
@@ -806,10 +1174,12 @@ def retrieve_session_for_user(environment, user, token=None, timeout=None, param
     session = allocate_session_for_user(environment, user, token, timeout, params)
 
     if session:
-        return session
+        return allocated("reserved", session)
 
     # There are no reserved sessions, so we need to trigger the creation
     # of a new session if there is available capacity. If there is no
     # available capacity, no session will be returned.
 
-    return create_session_for_user(environment, user, token, timeout, params)
+    session = create_session_for_user(environment, user, token, timeout, params)
+
+    return allocated(session and "created" or "unavailable", session)
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.10 on 2026-10-17 04:39
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("workshops", "0012_environment_labels_trainingportal_default_labels"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SessionStatusUpdate",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=256, verbose_name="session name")),
+                ("phase", models.CharField(max_length=64, verbose_name="status phase")),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "attempts",
+                    models.IntegerField(default=0, verbose_name="delivery attempts"),
+                ),
+                (
+                    "not_before",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="next attempt"
+                    ),
+                ),
+            ],
+        ),
+    ]
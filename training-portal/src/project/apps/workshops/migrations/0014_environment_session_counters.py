@@ -0,0 +1,69 @@
+# Generated by Django 4.2.10 on 2026-10-17 04:44
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def calculate_session_counters(apps, schema_editor):
+    Environment = apps.get_model("workshops", "Environment")
+
+    # Session states are STARTING=1, WAITING=2, RUNNING=3, STOPPING=4 and
+    # STOPPED=5.
+
+    counters = Environment.objects.annotate(
+        counted_available=Count(
+            "session", filter=Q(session__owner__isnull=True, session__state=2)
+        ),
+        counted_reserved=Count(
+            "session", filter=Q(session__owner__isnull=True, session__state__in=(1, 2))
+        ),
+        counted_allocated=Count(
+            "session", filter=Q(session__owner__isnull=False) & ~Q(session__state=5)
+        ),
+        counted_active=Count("session", filter=~Q(session__state=5)),
+        counted_total=Count("session"),
+    )
+
+    for environment in counters:
+        Environment.objects.filter(pk=environment.pk).update(
+            sessions_available=environment.counted_available,
+            sessions_reserved=environment.counted_reserved,
+            sessions_allocated=environment.counted_allocated,
+            sessions_active=environment.counted_active,
+            sessions_total=environment.counted_total,
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("workshops", "0013_sessionstatusupdate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="environment",
+            name="sessions_active",
+            field=models.IntegerField(default=0, verbose_name="active sessions"),
+        ),
+        migrations.AddField(
+            model_name="environment",
+            name="sessions_allocated",
+            field=models.IntegerField(default=0, verbose_name="allocated sessions"),
+        ),
+        migrations.AddField(
+            model_name="environment",
+            name="sessions_available",
+            field=models.IntegerField(default=0, verbose_name="available sessions"),
+        ),
+        migrations.AddField(
+            model_name="environment",
+            name="sessions_reserved",
+            field=models.IntegerField(default=0, verbose_name="reserved sessions"),
+        ),
+        migrations.AddField(
+            model_name="environment",
+            name="sessions_total",
+            field=models.IntegerField(default=0, verbose_name="total sessions"),
+        ),
+        migrations.RunPython(calculate_session_counters, migrations.RunPython.noop),
+    ]
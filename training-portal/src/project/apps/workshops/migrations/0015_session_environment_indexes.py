@@ -0,0 +1,35 @@
+# Generated by Django 4.2.10 on 2026-10-17 04:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("workshops", "0014_environment_session_counters"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="environment",
+            index=models.Index(
+                fields=["portal", "state", "position"], name="environment_portal_state"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="session",
+            index=models.Index(
+                fields=["environment", "owner", "state"],
+                name="session_environment_owner",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="session",
+            index=models.Index(fields=["owner", "state"], name="session_owner_state"),
+        ),
+        migrations.AddIndex(
+            model_name="session",
+            index=models.Index(
+                fields=["state", "expires"], name="session_state_expires"
+            ),
+        ),
+    ]
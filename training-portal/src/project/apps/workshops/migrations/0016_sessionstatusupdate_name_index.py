@@ -0,0 +1,19 @@
+# Generated by Django 4.2.10 on 2026-10-17 05:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("workshops", "0015_session_environment_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="sessionstatusupdate",
+            name="name",
+            field=models.CharField(
+                db_index=True, max_length=256, verbose_name="session name"
+            ),
+        ),
+    ]
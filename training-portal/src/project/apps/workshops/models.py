@@ -7,15 +7,19 @@ import enum
 
 from datetime import timedelta
 
-from django.db import models
+from django.db import models, transaction, connections
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.utils.html import format_html
 from django.urls import reverse
-from django.db.models import Sum
+from django.db.models import Sum, Count, Q, F
+from django.db.models.signals import post_save
+from django.dispatch import Signal
 
 from oauth2_provider.models import Application
 
+from .caching import catalog_changed
+
 
 User = get_user_model()
 
@@ -225,7 +229,7 @@ class TrainingPortal(models.Model):
 
         """
 
-        return self.available_sessions().count()
+        return self.session_counter_total("sessions_reserved")
 
     available_sessions_count.short_description = "Available"
 
@@ -250,7 +254,7 @@ class TrainingPortal(models.Model):
 
         """
 
-        return self.allocated_sessions().count()
+        return self.session_counter_total("sessions_allocated")
 
     allocated_sessions_count.short_description = "Allocated"
 
@@ -274,7 +278,7 @@ class TrainingPortal(models.Model):
 
         """
 
-        return self.active_sessions().count()
+        return self.session_counter_total("sessions_active")
 
     active_sessions_count.short_description = "Active"
 
@@ -298,10 +302,18 @@ class TrainingPortal(models.Model):
 
         """
 
-        return self.total_sessions().count()
+        return self.session_counter_total("sessions_total")
 
     all_sessions_count.short_description = "Total"
 
+    def session_counter_total(self, field):
+        """Returns the total across all workshop environments of the named
+        counter of workshop sessions.
+
+        """
+
+        return self.environment_set.aggregate(total=Sum(field))["total"] or 0
+
     def capacity_available(self):
         """Returns whether there is capacity to have another workshop session.
         This will always return True if no sessions maximum was specified for
@@ -445,6 +457,42 @@ class Environment(models.Model):
     env = JSONField(verbose_name="environment overrides", default=[])
     labels = JSONField(verbose_name="label overrides", default={})
     tally = models.IntegerField(verbose_name="workshop tally", default=0)
+    sessions_available = models.IntegerField(
+        verbose_name="available sessions", default=0
+    )
+    sessions_reserved = models.IntegerField(
+        verbose_name="reserved sessions", default=0
+    )
+    sessions_allocated = models.IntegerField(
+        verbose_name="allocated sessions", default=0
+    )
+    sessions_active = models.IntegerField(verbose_name="active sessions", default=0)
+    sessions_total = models.IntegerField(verbose_name="total sessions", default=0)
+
+    class Meta:
+        indexes = [
+            # Workshop environments for the training portal in a given state,
+            # ordered by their position in the training portal definition.
+            models.Index(
+                fields=["portal", "state", "position"],
+                name="environment_portal_state",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        # The counters of workshop sessions are only ever updated relative to
+        # the value in the database when a workshop session is saved, so
+        # exclude them when saving changes to an existing record. Otherwise
+        # we could overwrite the counters with stale values.
+
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in SESSION_COUNTERS
+            ]
+
+        super().save(*args, **kwargs)
 
     def portal_name(self):
         return self.portal.name
@@ -507,8 +555,25 @@ class Environment(models.Model):
         return self
 
     def available_session(self):
+        """Returns a reserved session which can be allocated to a user. Where
+        the database supports it, the row for the workshop session is locked
+        until the end of the transaction, skipping any workshop session which
+        is already locked, so concurrent requests can't be allocated the same
+        workshop session.
+
+        """
+
         sessions = self.available_sessions()
-        return sessions and sessions[0] or None
+
+        connection = connections[sessions.db]
+
+        if (
+            connection.features.has_select_for_update_skip_locked
+            and connection.in_atomic_block
+        ):
+            sessions = sessions.select_for_update(skip_locked=True)
+
+        return sessions.first()
 
     def available_sessions(self):
         """Returns the set of available sessions that can be allocated to a
@@ -520,7 +585,7 @@ class Environment(models.Model):
         return self.session_set.filter(owner__isnull=True, state=SessionState.WAITING)
 
     def available_sessions_count(self):
-        return self.available_sessions().count()
+        return self.sessions_available
 
     available_sessions_count.short_description = "Available"
 
@@ -530,7 +595,7 @@ class Environment(models.Model):
         )
 
     def allocated_sessions_count(self):
-        return self.allocated_sessions().count()
+        return self.sessions_allocated
 
     allocated_sessions_count.short_description = "Allocated"
 
@@ -551,7 +616,7 @@ class Environment(models.Model):
 
         """
 
-        return self.active_sessions().count()
+        return self.sessions_active
 
     active_sessions_count.short_description = "Active"
 
@@ -573,10 +638,69 @@ class Environment(models.Model):
 
         """
 
-        return self.all_sessions().count()
+        return self.sessions_total
 
     all_sessions_count.short_description = "Total"
 
+    def refresh_session_counters(self):
+        """Reloads the counters of workshop sessions from the database."""
+
+        self.refresh_from_db(fields=SESSION_COUNTERS)
+
+    def calculate_session_counters(self):
+        """Returns the counters of workshop sessions as calculated from the
+        workshop session records in the database.
+
+        """
+
+        return self.session_set.aggregate(
+            sessions_available=Count(
+                "pk", filter=Q(owner__isnull=True, state=SessionState.WAITING)
+            ),
+            sessions_reserved=Count(
+                "pk",
+                filter=Q(
+                    owner__isnull=True,
+                    state__in=(SessionState.STARTING, SessionState.WAITING),
+                ),
+            ),
+            sessions_allocated=Count(
+                "pk",
+                filter=Q(owner__isnull=False) & ~Q(state=SessionState.STOPPED),
+            ),
+            sessions_active=Count("pk", filter=~Q(state=SessionState.STOPPED)),
+            sessions_total=Count("pk"),
+        )
+
+    def recalculate_session_counters(self):
+        """Recalculates the counters of workshop sessions and corrects them if
+        they have drifted. Returns a dictionary of any counters which were
+        corrected, mapping to the previous and corrected values.
+
+        """
+
+        expected = self.calculate_session_counters()
+
+        current = Environment.objects.filter(pk=self.pk).values(*SESSION_COUNTERS)[0]
+
+        drift = {
+            field: (current[field], expected[field])
+            for field in SESSION_COUNTERS
+            if current[field] != expected[field]
+        }
+
+        if drift:
+            Environment.objects.filter(pk=self.pk).update(
+                **{field: expected[field] for field in drift}
+            )
+
+            catalog_changed()
+
+        for field in SESSION_COUNTERS:
+            setattr(self, field, expected[field])
+
+        return drift
+
     def allocated_session_for_user(self, user):
         """Returns any allocated workshop session for the defined user. There
         should only be at most one, so only need to return the first if one
@@ -605,6 +729,160 @@ class SessionState(enum.IntEnum):
         return [(key.value, key.name) for key in cls]
 
 
+# Counters of workshop sessions maintained against each workshop environment
+# so that capacity checks don't need to count the workshop sessions each time.
+
+SESSION_COUNTERS = (
+    "sessions_available",
+    "sessions_reserved",
+    "sessions_allocated",
+    "sessions_active",
+    "sessions_total",
+)
+
+
+def session_counters(state, owner_id):
+    """Returns the contribution of a workshop session in the specified state
+    to each of the counters of workshop sessions.
+
+    """
+
+    return {
+        "sessions_available": int(owner_id is None and state == SessionState.WAITING),
+        "sessions_reserved": int(
+            owner_id is None and state in (SessionState.STARTING, SessionState.WAITING)
+        ),
+        "sessions_allocated": int(
+            owner_id is not None and state != SessionState.STOPPED
+        ),
+        "sessions_active": int(state != SessionState.STOPPED),
+        "sessions_total": 1,
+    }
+
+
+# Signal sent when the counters of workshop sessions are changed, with the
+# changes made to the counters for each workshop environment.
+
+session_counters_changed = Signal()
+
+# Fields of a workshop session which determine what it counts towards.
+
+COUNTED_FIELDS = frozenset(
+    ["environment", "environment_id", "state", "owner", "owner_id"]
+)
+
+
+def adjust_session_counters(before, after):
+    """Adjusts the counters of workshop sessions for each workshop environment
+    for a change in the workshop sessions. The workshop sessions before and
+    after the change are given as lists of tuples of the workshop environment,
+    state and owner of each workshop session. Returns the changes made to the
+    counters for each workshop environment.
+
+    """
+
+    totals = {}
+
+    for sign, sessions in ((-1, before), (1, after)):
+        for environment_id, state, owner_id in sessions:
+            deltas = totals.setdefault(
+                environment_id, dict.fromkeys(SESSION_COUNTERS, 0)
+            )
+
+            for field, value in session_counters(state, owner_id).items():
+                deltas[field] += sign * value
+
+    changed = {}
+
+    for environment_id, deltas in totals.items():
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+
+        if deltas:
+            Environment.objects.filter(pk=environment_id).update(
+                **{field: F(field) + delta for field, delta in deltas.items()}
+            )
+
+            changed[environment_id] = deltas
+
+    if changed:
+        catalog_changed()
+
+        session_counters_changed.send(sender=Environment, changed=changed)
+
+    return changed
+
+
+class SessionQuerySet(models.QuerySet):
+    """Query set for workshop sessions which adjusts the counters of workshop
+    sessions for each workshop environment when workshop sessions are
+    created, updated or deleted in bulk. The counters are adjusted in the
+    same transaction, using the states of the workshop sessions as read
+    from the database while holding a lock on their rows.
+
+    """
+
+    COUNTED_COLUMNS = ("pk", "environment_id", "state", "owner_id")
+
+    def _counted_rows(self, locked=True):
+        queryset = self.order_by()
+
+        if locked:
+            queryset = queryset.select_for_update(of=("self",))
+
+        return {
+            pk: (environment_id, state, owner_id)
+            for pk, environment_id, state, owner_id in queryset.values_list(
+                *self.COUNTED_COLUMNS
+            )
+        }
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+
+            adjust_session_counters(
+                [], [(obj.environment_id, obj.state, obj.owner_id) for obj in objs]
+            )
+
+        return objs
+
+    def update(self, **kwargs):
+        if not COUNTED_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+
+        with transaction.atomic(using=self.db):
+            before = self._counted_rows()
+
+            # Only the rows which were locked are updated, so that any which
+            # came to match the query in the meantime aren't missed from the
+            # counters.
+
+            rows = self.model.objects.using(self.db).filter(pk__in=list(before))
+
+            updated = super(SessionQuerySet, rows).update(**kwargs)
+
+            after = rows._counted_rows(locked=False)
+
+            adjust_session_counters(before.values(), after.values())
+
+        return updated
+
+    update.alters_data = True
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            before = self._counted_rows()
+
+            result = super().delete()
+
+            adjust_session_counters(before.values(), [])
+
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 class Session(models.Model):
     name = models.CharField(
         verbose_name="session name", max_length=256, primary_key=True
@@ -627,6 +905,175 @@ class Session(models.Model):
     params = JSONField(verbose_name="session params", default={})
     password = models.CharField(verbose_name="config password", max_length=256, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Reserved and allocated workshop sessions for a workshop
+            # environment, found by whether there is an owner and the state.
+            models.Index(
+                fields=["environment", "owner", "state"],
+                name="session_environment_owner",
+            ),
+            # Workshop sessions allocated to a user, across all workshop
+            # environments, as returned for the user sessions REST API.
+            models.Index(fields=["owner", "state"], name="session_owner_state"),
+            # Stopped workshop sessions which have expired and can be purged.
+            models.Index(fields=["state", "expires"], name="session_state_expires"),
+        ]
+
+    objects = SessionQuerySet.as_manager()
+
+    def _counted_row(self):
+        # Reads the workshop environment, state and owner of the workshop
+        # session from the database, locking the row until the transaction
+        # is committed so it can't be changed in the meantime.
+
+        return (
+            Session.objects.select_for_update()
+            .filter(pk=self.pk)
+            .values_list(*SessionQuerySet.COUNTED_COLUMNS[1:])
+            .first()
+        )
+
+    def _update_cached_environment(self, changed):
+        # Updates any workshop environment instance we hold so the counters
+        # it holds remain consistent with the database.
+
+        if Session.environment.is_cached(self):
+            environment = self.environment
+
+            for field, delta in changed.get(environment.pk, {}).items():
+                setattr(environment, field, getattr(environment, field) + delta)
+
+    def save(self, *args, **kwargs):
+        """Saves the workshop session, adjusting the counters of workshop
+        sessions for the workshop environment in the same transaction. The
+        counters are adjusted relative to the state of the workshop session
+        as read from the database while holding a lock on the row.
+
+        """
+
+        update_fields = kwargs.get("update_fields")
+
+        if update_fields is not None and not COUNTED_FIELDS.intersection(update_fields):
+            return super().save(*args, **kwargs)
+
+        columns = SessionQuerySet.COUNTED_COLUMNS[1:]
+
+        with transaction.atomic():
+            previous = None
+
+            if not kwargs.get("force_insert"):
+                previous = self._counted_row()
+
+            super().save(*args, **kwargs)
+
+            # Where only some fields were saved, any others which determine
+            # what the workshop session counts towards are as they were.
+
+            if previous is not None and update_fields is not None:
+                saved = {self._meta.get_field(name).attname for name in update_fields}
+
+                current = tuple(
+                    getattr(self, column) if column in saved else value
+                    for column, value in zip(columns, previous)
+                )
+
+            else:
+                current = tuple(getattr(self, column) for column in columns)
+
+            changed = adjust_session_counters(
+                [previous] if previous is not None else [], [current]
+            )
+
+        self._update_cached_environment(changed)
+
+    def delete(self, *args, **kwargs):
+        """Deletes the workshop session, adjusting the counters of workshop
+        sessions for the workshop environment in the same transaction.
+
+        """
+
+        with transaction.atomic():
+            previous = self._counted_row()
+
+            result = super().delete(*args, **kwargs)
+
+            changed = adjust_session_counters(
+                [previous] if previous is not None else [], []
+            )
+
+        self._update_cached_environment(changed)
+
+        return result
+
+    @classmethod
+    def bulk_create_sessions(cls, sessions, batch_size=None):
+        """Creates new workshop sessions using bulk inserts. The counters of
+        workshop sessions for each workshop environment are adjusted by the
+        query set with a single update in the same transaction.
+
+        """
+
+        with transaction.atomic():
+            sessions = cls.objects.bulk_create(sessions, batch_size=batch_size)
+
+            # Also reload the counters of any workshop environment instances
+            # we hold so they remain consistent with the database.
+
+            environments = {
+                session.environment_id: session.environment
+                for session in sessions
+                if Session.environment.is_cached(session)
+            }
+
+            for environment in environments.values():
+                environment.refresh_session_counters()
+
+        return sessions
+
+    @classmethod
+    def bulk_delete_sessions(cls, names):
+        """Deletes the named workshop sessions using a single delete. The
+        counters of workshop sessions for each workshop environment are
+        adjusted by the query set in the same transaction. Returns the number
+        of workshop sessions deleted.
+
+        """
+
+        _, deleted = cls.objects.filter(name__in=list(names)).delete()
+
+        return deleted.get(cls._meta.label, 0)
+
+    @classmethod
+    def bulk_update_sessions(cls, sessions, fields, batch_size=None):
+        """Saves changes to the specified fields of the workshop sessions
+        using bulk updates. The counters of workshop sessions for each
+        workshop environment are adjusted by the query set in the same
+        transaction. As save() would, signals that each workshop session was
+        saved, so that handlers tracking changes see them.
+
+        """
+
+        sessions = list(sessions)
+
+        if not sessions:
+            return sessions
+
+        with transaction.atomic():
+            cls.objects.bulk_update(sessions, fields, batch_size=batch_size)
+
+            for session in sessions:
+                post_save.send(
+                    sender=cls,
+                    instance=session,
+                    created=False,
+                    update_fields=frozenset(fields),
+                    raw=False,
+                    using=session._state.db,
+                )
+
+        return sessions
+
     def environment_name(self):
         return self.environment.name
 
@@ -817,3 +1264,18 @@ class Session(models.Model):
             self.save()
             return True
         return False
+
+
+class SessionStatusUpdate(models.Model):
+    """Outbox record of a change to the status of the Kubernetes resource for
+    a workshop session. Records are written in the same transaction as the
+    change to the workshop session and are applied to the Kubernetes resource
+    after the transaction has been committed.
+
+    """
+
+    name = models.CharField(verbose_name="session name", max_length=256, db_index=True)
+    phase = models.CharField(verbose_name="status phase", max_length=64)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(verbose_name="delivery attempts", default=0)
+    not_before = models.DateTimeField(verbose_name="next attempt", default=timezone.now)
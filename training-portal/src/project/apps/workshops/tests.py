@@ -1,3 +1,1677 @@
-from django.test import TestCase
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
 
-# Create your tests here.
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.urls import reverse
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.auth.hashers import check_password
+from django.conf import settings
+
+import pykube
+import requests
+
+from aiohttp import web
+
+from oauth2_provider.models import Application, AccessToken
+
+from .manager import activity, cleanup, sessions, reconciler
+from .manager.analytics import AnalyticsDelivery
+from .manager.operator import Task, TaskScheduler
+from .manager.informers import WorkshopSessionIndex
+from .manager.reconciler import DeadlineHeap
+from .manager.locking import (
+    resources_lock,
+    allocation_lock,
+    lock_profiler,
+    LockManager,
+)
+from .caching import training_portal
+from .authorization import access_tokens
+from .models import (
+    TrainingPortal,
+    Workshop,
+    Environment,
+    EnvironmentState,
+    Session,
+    SessionState,
+    SessionStatusUpdate,
+)
+
+
+class PortalTestCase(TestCase):
+    """Base class for tests against a training portal, with helpers for
+    creating workshop environments and workshop sessions for it.
+
+    """
+
+    def setUp(self):
+        self.portal = TrainingPortal.objects.create(name="portal")
+
+        # Discard any cached copies of the training portal and access tokens
+        # from an earlier test.
+
+        training_portal.invalidate()
+        access_tokens.invalidate()
+
+    def create_environment(self, name, workshop_name, **kwargs):
+        workshop = Workshop.objects.create(
+            name=workshop_name,
+            uid=workshop_name,
+            generation=1,
+            title="Workshop",
+            description="Workshop",
+            vendor="",
+            difficulty="",
+            duration="",
+            logo="",
+            url="",
+        )
+
+        return Environment.objects.create(
+            portal=self.portal,
+            workshop_name=workshop.name,
+            workshop=workshop,
+            name=name,
+            state=EnvironmentState.RUNNING,
+            **kwargs,
+        )
+
+    def create_session(self, environment, name, state, owner=None, **kwargs):
+        return Session.objects.create(
+            name=name,
+            id=name,
+            environment=environment,
+            state=state,
+            owner=owner,
+            **kwargs,
+        )
+
+    def create_user(self, username):
+        return get_user_model().objects.create_user(username=username)
+
+
+class RobotTestCase(PortalTestCase):
+    """Base class for tests of REST API endpoints, accessed as a robot
+    account using an access token.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.robot = self.create_user("robot")
+        self.robot.groups.add(Group.objects.create(name="robots"))
+
+        application = Application.objects.create(
+            name="robot",
+            user=self.robot,
+            client_type="confidential",
+            authorization_grant_type="password",
+        )
+
+        AccessToken.objects.create(
+            user=self.robot,
+            application=application,
+            token="robot-token",
+            scope="read write",
+            expires=timezone.now() + timedelta(hours=1),
+        )
+
+
+class CatalogTestCase(RobotTestCase):
+    """Base class for tests of the catalog REST API endpoints, with a catalog
+    of workshop environments, each with workshop sessions allocated to users.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.count = 0
+
+    def add_environments(self, number):
+        for _ in range(number):
+            self.count += 1
+
+            environment = self.create_environment(
+                f"environment-{self.count}",
+                f"workshop-{self.count}",
+                capacity=10,
+                expires=timedelta(minutes=30),
+                deadline=timedelta(minutes=60),
+            )
+
+            for index in range(3):
+                self.create_session(
+                    environment,
+                    f"session-{self.count}-{index}",
+                    SessionState.RUNNING,
+                    owner=self.create_user(f"user-{self.count}-{index}"),
+                    started=timezone.now(),
+                    expires=timezone.now() + timedelta(minutes=30),
+                )
+
+
+@override_settings(TRAINING_PORTAL="portal")
+class CatalogQueryCountTests(CatalogTestCase):
+    """Checks that the number of database queries made by the catalog REST
+    API endpoints doesn't grow with the number of workshop environments or
+    workshop sessions.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        # Load the cached copies of the training portal and access token so
+        # the number of queries doesn't depend on whether an earlier request
+        # already loaded them.
+
+        training_portal.get()
+
+        access_tokens.put(
+            AccessToken.objects.select_related("application", "user").get(
+                token="robot-token"
+            )
+        )
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_AUTHORIZATION="Bearer robot-token")
+
+        self.assertEqual(response.status_code, 200)
+
+        return len(context.captured_queries), response.json()
+
+    def assert_constant_queries(self, url, key):
+        # Changes must be seen as committed so that any cached response for
+        # the catalog is invalidated.
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_environments(1)
+
+        queries, result = self.count_queries(url)
+
+        self.assertEqual(len(result[key]), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_environments(4)
+
+        self.assertEqual(self.count_queries(url)[0], queries)
+
+        return result
+
+    def test_catalog_environments(self):
+        self.assert_constant_queries(
+            reverse("workshops_catalog_environments"), "environments"
+        )
+
+    def test_catalog_environments_with_sessions(self):
+        result = self.assert_constant_queries(
+            reverse("workshops_catalog_environments") + "?sessions=true",
+            "environments",
+        )
+
+        self.assertEqual(len(result["environments"][0]["sessions"]), 3)
+
+    def test_catalog_workshops(self):
+        self.assert_constant_queries(
+            reverse("workshops_catalog_workshops"), "workshops"
+        )
+
+    def test_user_sessions(self):
+        url = reverse("workshops_user_sessions", args=["user-1-0"])
+
+        self.add_environments(1)
+
+        queries, result = self.count_queries(url)
+
+        self.assertEqual(len(result["sessions"]), 1)
+        self.assertEqual(result["sessions"][0]["environment"], "environment-1")
+
+        self.add_environments(4)
+
+        self.assertEqual(self.count_queries(url)[0], queries)
+
+
+@override_settings(TRAINING_PORTAL="portal")
+class CatalogCacheTests(CatalogTestCase):
+    """Checks that responses for the catalog REST API endpoints are cached
+    until the catalog changes, and honour conditional requests.
+
+    """
+
+    def assert_cached(self, url):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_environments(1)
+
+        response = self.client.get(url, HTTP_AUTHORIZATION="Bearer robot-token")
+
+        etag = response["ETag"]
+
+        # Repeat requests shouldn't query the catalog, only authenticate the
+        # client, and a conditional request should return not modified.
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                url, HTTP_AUTHORIZATION="Bearer robot-token", HTTP_IF_NONE_MATCH=etag
+            )
+
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(
+            [
+                query
+                for query in context.captured_queries
+                if "workshops_" in query["sql"]
+            ]
+        )
+
+        # Once the catalog changes a new response should be generated.
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_environments(1)
+
+        response = self.client.get(
+            url, HTTP_AUTHORIZATION="Bearer robot-token", HTTP_IF_NONE_MATCH=etag
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_catalog_environments_cached(self):
+        self.assert_cached(reverse("workshops_catalog_environments"))
+
+    def test_catalog_workshops_cached(self):
+        self.assert_cached(reverse("workshops_catalog_workshops"))
+
+    @override_settings(PORTAL_REPLICAS=2)
+    def test_catalog_not_cached_with_replicas(self):
+        # Changes made by other replicas aren't seen, so responses must not
+        # be cached, but conditional requests should still be honoured.
+
+        url = reverse("workshops_catalog_environments")
+
+        self.add_environments(1)
+
+        response = self.client.get(url, HTTP_AUTHORIZATION="Bearer robot-token")
+
+        etag = response["ETag"]
+
+        response = self.client.get(
+            url, HTTP_AUTHORIZATION="Bearer robot-token", HTTP_IF_NONE_MATCH=etag
+        )
+
+        self.assertEqual(response.status_code, 304)
+
+        self.add_environments(1)
+
+        response = self.client.get(
+            url, HTTP_AUTHORIZATION="Bearer robot-token", HTTP_IF_NONE_MATCH=etag
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["environments"]), 2)
+
+    @override_settings(PORTAL_INDEX="")
+    def test_catalog_page_cached(self):
+        url = reverse("workshops_catalog")
+
+        self.client.force_login(get_user_model().objects.create_user("user"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_environments(1)
+
+        self.assertContains(self.client.get(url), "environment-1")
+
+        # The list of workshops shown to a user without a workshop session
+        # should be rendered without querying the workshop environments until
+        # the catalog changes.
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertContains(self.client.get(url), "environment-1")
+
+        self.assertFalse(
+            [
+                query
+                for query in context.captured_queries
+                if "workshops_workshop" in query["sql"]
+            ]
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_environments(1)
+
+        self.assertContains(self.client.get(url), "environment-2")
+
+
+@override_settings(TRAINING_PORTAL="portal")
+class TrainingPortalCacheTests(PortalTestCase):
+    """Checks that the training portal is cached until it is saved."""
+
+    def test_training_portal_cached(self):
+        training_portal.get()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(training_portal.get().sessions_maximum, 0)
+
+        self.portal.sessions_maximum = 10
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.portal.save()
+
+        self.assertEqual(training_portal.get().sessions_maximum, 10)
+
+
+@override_settings(TRAINING_PORTAL="portal")
+class AccessTokenCacheTests(RobotTestCase):
+    """Checks that access tokens, and whether the user is a robot account,
+    are cached until the access token is revoked or the user's groups are
+    changed.
+
+    """
+
+    def request(self):
+        url = reverse("workshops_user_sessions", args=["user"])
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_AUTHORIZATION="Bearer robot-token")
+
+        queries = [
+            query["sql"]
+            for query in context.captured_queries
+            if "oauth2_provider_accesstoken" in query["sql"]
+            or "auth_user_groups" in query["sql"]
+        ]
+
+        return response.status_code, queries
+
+    def test_access_token_cached(self):
+        self.assertEqual(self.request()[0], 200)
+        self.assertEqual(self.request(), (200, []))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.robot.groups.clear()
+
+        self.assertEqual(self.request()[0], 403)
+
+    def test_access_token_revoked(self):
+        self.assertEqual(self.request()[0], 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AccessToken.objects.get(token="robot-token").revoke()
+
+        self.assertEqual(self.request()[0], 403)
+
+    def test_access_token_without_user(self):
+        # Access tokens issued using client credentials have no user.
+
+        AccessToken.objects.create(
+            user=None,
+            application=Application.objects.get(name="robot"),
+            token="client-token",
+            scope="read write",
+            expires=timezone.now() + timedelta(hours=1),
+        )
+
+        url = reverse("workshops_user_sessions", args=["user"])
+
+        for _ in range(2):
+            response = self.client.get(url, HTTP_AUTHORIZATION="Bearer client-token")
+
+            self.assertEqual(response.status_code, 403)
+
+
+class MetricsTests(RobotTestCase):
+    """Checks that metrics can be collected by a robot account, including
+    the counts of workshop sessions in each state for workshop environments.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        environment = self.create_environment(
+            "environment-1", "workshop-1", capacity=5, reserved=1
+        )
+
+        self.create_session(
+            environment, "allocated", SessionState.RUNNING, self.create_user("user-1")
+        )
+        self.create_session(environment, "reserved", SessionState.WAITING)
+        self.create_session(
+            environment, "stopped", SessionState.STOPPED, self.create_user("user-2")
+        )
+
+    def test_metrics(self):
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer robot-token"
+        )
+
+        for kind, count in (("allocated", 1), ("available", 1), ("active", 2)):
+            self.assertContains(
+                response,
+                'training_portal_environment_sessions{environment="environment-1",'
+                f'type="{kind}",workshop="workshop-1"}} {count}.0',
+            )
+
+    def test_metrics_forbidden(self):
+        self.robot.groups.clear()
+
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer robot-token"
+        )
+
+        self.assertEqual(response.status_code, 403)
+
+
+class LockProfilerTests(TestCase):
+    """Checks that acquisitions of locks are profiled by the function which
+    is holding the lock.
+
+    """
+
+    def test_lock_holders(self):
+        @resources_lock
+        def decorated():
+            pass
+
+        def managed():
+            with resources_lock():
+                pass
+
+        decorated()
+        managed()
+
+        holders = {
+            entry["holder"]: entry
+            for entry in lock_profiler.statistics()
+            if entry["scope"] == "portal"
+        }
+
+        self.assertIn(decorated.__qualname__, holders)
+        self.assertIn(managed.__qualname__, holders)
+
+    def test_debug_locks_staff_only(self):
+        User = get_user_model()  # pylint: disable=invalid-name
+
+        url = reverse("workshops_debug_locks")
+
+        self.client.force_login(User.objects.create_user(username="user"))
+
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(
+            User.objects.create_user(username="staff", is_staff=True)
+        )
+
+        self.assertIn("locks", self.client.get(url).json())
+
+
+class LockManagerTests(TestCase):
+    """Checks which operations the locks for each scope exclude, and that
+    locks are escalated to the portal lock where operations against
+    different workshop environments or workshop sessions can interfere.
+
+    """
+
+    def setUp(self):
+        self.manager = LockManager()
+        self.manager.escalate_environments(False)
+
+    def blocks(self, first, second):
+        """Returns whether acquiring the second lock in another thread is
+        blocked while the first lock is held.
+
+        """
+
+        acquired = threading.Event()
+
+        def acquire():
+            with second():
+                acquired.set()
+
+        with first():
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            blocked = not acquired.wait(0.2)
+
+        thread.join()
+
+        return blocked
+
+    def test_lock_order(self):
+        with mock.patch.object(LockManager, "_serialized", return_value=False):
+            with self.manager.session("session"):
+                with self.assertRaises(RuntimeError):
+                    with self.manager.environment("environment"):
+                        pass
+
+    def test_scoped_locks(self):
+        manager = self.manager
+
+        with mock.patch.object(LockManager, "_serialized", return_value=False):
+            self.assertFalse(
+                self.blocks(
+                    lambda: manager.environment("one"),
+                    lambda: manager.environment("two"),
+                )
+            )
+            self.assertTrue(
+                self.blocks(
+                    lambda: manager.environment("one"),
+                    lambda: manager.environment("one"),
+                )
+            )
+            self.assertFalse(
+                self.blocks(
+                    lambda: manager.session("one"), lambda: manager.session("two")
+                )
+            )
+            self.assertTrue(self.blocks(manager.portal, lambda: manager.session("one")))
+            self.assertTrue(
+                self.blocks(lambda: manager.environment("one"), manager.portal)
+            )
+
+    def test_escalated_environments(self):
+        manager = self.manager
+
+        manager.escalate_environments(True)
+
+        with mock.patch.object(LockManager, "_serialized", return_value=False):
+            self.assertTrue(
+                self.blocks(
+                    lambda: manager.environment("one"),
+                    lambda: manager.environment("two"),
+                )
+            )
+            self.assertFalse(
+                self.blocks(
+                    lambda: manager.session("one"), lambda: manager.session("two")
+                )
+            )
+
+    @skipUnless(connection.vendor == "sqlite", "requires SQLite")
+    def test_serialized_for_sqlite(self):
+        manager = self.manager
+
+        self.assertTrue(
+            self.blocks(
+                lambda: manager.environment("one"),
+                lambda: manager.environment("two"),
+            )
+        )
+        self.assertTrue(
+            self.blocks(lambda: manager.session("one"), lambda: manager.session("two"))
+        )
+
+
+class TaskSchedulerTests(TestCase):
+    """Checks that identical background tasks are coalesced and never run at
+    the same time, and that rounds of a periodic task are skipped while an
+    identical task is waiting to run.
+
+    """
+
+    def setUp(self):
+        self.scheduler = TaskScheduler(4)
+        self.calls = []
+
+    def tearDown(self):
+        self.scheduler._executor.shutdown()
+
+    def task(self, *args, delay=0.0, repeat=False, function=None):
+        return Task(function or self.calls.append, "task", delay, repeat, args, {})
+
+    def test_coalesced(self):
+        async def run():
+            first = asyncio.ensure_future(
+                self.scheduler.run_once(self.task("first"), 0.1)
+            )
+
+            await asyncio.sleep(0)
+
+            self.assertEqual(self.scheduler.backlog(), 1)
+
+            # An identical task which is scheduled while the first is still
+            # waiting to run is merged into it, with nothing run for it.
+
+            self.assertIsNone(await self.scheduler.run_once(self.task("first"), 0.0))
+
+            await first
+
+        asyncio.run(run())
+
+        self.assertEqual(self.calls, ["first"])
+        self.assertEqual(self.scheduler.backlog(), 0)
+
+    def test_waits_for_running(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def block(value):
+            self.calls.append(("start", value))
+            started.set()
+            release.wait(5)
+            self.calls.append(("end", value))
+
+        async def run():
+            loop = asyncio.get_running_loop()
+
+            first = asyncio.ensure_future(
+                self.scheduler.run_once(self.task(1, function=block), 0.0)
+            )
+
+            await loop.run_in_executor(None, started.wait, 5)
+
+            second = asyncio.ensure_future(
+                self.scheduler.run_once(self.task(1, function=block), 0.0)
+            )
+
+            await asyncio.sleep(0.1)
+
+            # The second task mustn't start until the first has completed.
+
+            self.assertEqual(self.calls, [("start", 1)])
+
+            release.set()
+
+            await asyncio.gather(first, second)
+
+        asyncio.run(run())
+
+        self.assertEqual(
+            self.calls, [("start", 1), ("end", 1), ("start", 1), ("end", 1)]
+        )
+
+    def test_periodic_skipped_while_pending(self):
+        async def run():
+            pending = asyncio.ensure_future(
+                self.scheduler.run_once(self.task("value"), 0.3)
+            )
+
+            periodic = asyncio.ensure_future(
+                self.scheduler.run_periodic(self.task("value", repeat=True), 0.05)
+            )
+
+            await asyncio.sleep(0.2)
+
+            self.assertEqual(self.calls, [])
+
+            await pending
+
+            periodic.cancel()
+
+        with self.assertLogs(level="WARNING") as logs:
+            asyncio.run(run())
+
+        self.assertIn("Skipping task task", logs.output[0])
+        self.assertEqual(self.calls, ["value"])
+
+    def test_unhashable_arguments(self):
+        task = self.task(["value"])
+
+        self.assertIs(task.key(), task)
+
+        async def run():
+            await asyncio.gather(
+                self.scheduler.run_once(task, 0.05),
+                self.scheduler.run_once(self.task(["value"]), 0.0),
+            )
+
+        asyncio.run(run())
+
+        # Tasks with arguments which can't be hashed are never coalesced.
+
+        self.assertEqual(self.calls, [["value"], ["value"]])
+
+
+class WorkshopSessionIndexTests(TestCase):
+    """Checks that a full listing of the workshop session resources is merged
+    with events received while the listing was being done.
+
+    """
+
+    def setUp(self):
+        self.index = WorkshopSessionIndex()
+
+    def test_events_during_listing(self):
+        self.index.observe("deleted", "Running")
+
+        started = time.monotonic()
+
+        # Events received after the listing was started take precedence
+        # over what the listing returned.
+
+        self.index.observe("created", "Starting")
+        self.index.forget("deleted")
+
+        self.index.replace({"deleted": "Running"}, started)
+
+        self.assertEqual(self.index.names(), {"created"})
+        self.assertEqual(self.index.phase("created"), "Starting")
+        self.assertIsNone(self.index.phase("deleted"))
+
+    def test_stale_entries_dropped(self):
+        self.index.observe("stale", "Running")
+        self.index.observe("listed", "Starting")
+        self.index.forget("tombstone")
+
+        self.assertFalse(self.index.is_synced())
+
+        self.index.replace({"listed": "Running"}, time.monotonic())
+
+        self.assertTrue(self.index.is_synced())
+        self.assertEqual(self.index.names(), {"listed"})
+        self.assertEqual(self.index.phase("listed"), "Running")
+
+        # The tombstone is discarded, so a later listing which includes the
+        # workshop session restores it.
+
+        self.index.replace({"tombstone": "Running"}, time.monotonic())
+
+        self.assertEqual(self.index.names(), {"tombstone"})
+
+    def test_names_exclude_tombstones(self):
+        self.index.observe("running", "Running")
+        self.index.observe("deleted", "Running")
+        self.index.forget("deleted")
+
+        self.assertEqual(self.index.names(), {"running"})
+        self.assertIsNone(self.index.phase("deleted"))
+
+
+class SessionCounterTests(PortalTestCase):
+    """Checks that the counters of workshop sessions held against a workshop
+    environment are maintained when workshop sessions are created, updated
+    or deleted, including in bulk.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.environment = self.create_environment(
+            "environment", "workshop", capacity=10
+        )
+
+    def test_bulk_create_sessions(self):
+        environment = self.environment
+
+        Session.bulk_create_sessions(
+            Session(
+                name=f"reserved-{index}",
+                id=f"r{index}",
+                environment=environment,
+                state=SessionState.WAITING,
+            )
+            for index in range(5)
+        )
+
+        self.assertEqual(environment.sessions_available, 5)
+        self.assertEqual(environment.sessions_total, 5)
+
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+        environment.refresh_session_counters()
+
+        self.assertEqual(environment.available_sessions_count(), 5)
+        self.assertEqual(environment.active_sessions_count(), 5)
+
+    def test_bulk_delete_sessions(self):
+        environment = self.environment
+
+        self.create_session(
+            environment, "stopped", SessionState.STOPPED, self.create_user("user-1")
+        )
+        self.create_session(
+            environment, "allocated", SessionState.RUNNING, self.create_user("user-2")
+        )
+        self.create_session(environment, "reserved", SessionState.WAITING)
+
+        deleted = Session.bulk_delete_sessions(["stopped", "reserved"])
+
+        self.assertEqual(deleted, 2)
+
+        environment.refresh_session_counters()
+
+        self.assertEqual(environment.sessions_available, 0)
+        self.assertEqual(environment.sessions_allocated, 1)
+        self.assertEqual(environment.sessions_total, 1)
+
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+    def test_bulk_update_sessions(self):
+        environment = self.environment
+
+        self.create_session(
+            environment, "allocated", SessionState.RUNNING, self.create_user("user")
+        )
+        self.create_session(environment, "reserved", SessionState.WAITING)
+
+        # The previous states must be taken from the database, including for
+        # instances where the state wasn't loaded.
+
+        sessions = list(Session.objects.only("name", "environment", "owner"))
+
+        for session in sessions:
+            session.state = SessionState.STOPPING
+
+        Session.bulk_update_sessions(sessions, ["state"])
+
+        environment.refresh_session_counters()
+
+        self.assertEqual(environment.sessions_available, 0)
+        self.assertEqual(environment.sessions_reserved, 0)
+        self.assertEqual(environment.sessions_allocated, 1)
+
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+    def test_queryset_update_and_delete(self):
+        environment = self.environment
+
+        self.create_session(
+            environment, "allocated", SessionState.RUNNING, self.create_user("user")
+        )
+        self.create_session(environment, "reserved", SessionState.WAITING)
+
+        Session.objects.filter(name="reserved").update(state=SessionState.STOPPED)
+
+        environment.refresh_session_counters()
+
+        self.assertEqual(environment.sessions_available, 0)
+        self.assertEqual(environment.sessions_active, 1)
+
+        Session.objects.filter(state=SessionState.STOPPED).delete()
+
+        environment.refresh_session_counters()
+
+        self.assertEqual(environment.sessions_total, 1)
+
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+    def test_save_stale_instance(self):
+        environment = self.environment
+
+        self.create_session(
+            environment, "allocated", SessionState.RUNNING, self.create_user("user")
+        )
+
+        # The counters are adjusted relative to the state in the database, so
+        # saving the same change from a stale instance doesn't count twice.
+
+        for session in list(Session.objects.all()) + list(Session.objects.all()):
+            session.state = SessionState.STOPPED
+            session.save()
+
+        environment.refresh_session_counters()
+
+        self.assertEqual(environment.sessions_allocated, 0)
+        self.assertEqual(environment.sessions_active, 0)
+
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+
+class AllocationLockTests(PortalTestCase):
+    """Checks that where there are multiple replicas of the training portal,
+    decisions to allocate workshop sessions lock the row for the training
+    portal or the workshop environment in the database.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.environment = self.create_environment(
+            "environment", "workshop", capacity=1
+        )
+
+    def locked_tables(self):
+        with CaptureQueriesContext(connection) as queries:
+            allocation_lock(self.portal, [self.environment.pk])
+
+        return [query["sql"].split(" FROM ")[1].split()[0] for query in queries]
+
+    def test_single_replica(self):
+        self.assertEqual(self.locked_tables(), [])
+
+    @override_settings(PORTAL_REPLICAS=2)
+    def test_environment_locked(self):
+        self.assertEqual(self.locked_tables(), ['"workshops_environment"'])
+
+    @override_settings(PORTAL_REPLICAS=2)
+    def test_portal_locked_with_maximum(self):
+        self.portal.sessions_maximum = 1
+
+        self.assertEqual(self.locked_tables(), ['"workshops_trainingportal"'])
+
+        self.portal.sessions_maximum = 0
+        self.portal.sessions_registered = 1
+
+        self.assertEqual(self.locked_tables(), ['"workshops_trainingportal"'])
+
+    def test_capacity_checked_against_current_counters(self):
+        stale = Environment.objects.get()
+
+        # The workshop session is allocated as if by another replica after
+        # the workshop environment was loaded.
+
+        self.create_session(
+            self.environment,
+            "environment-s001",
+            SessionState.RUNNING,
+            owner=self.create_user("owner"),
+        )
+
+        self.assertEqual(stale.active_sessions_count(), 0)
+
+        self.assertIsNone(
+            sessions.create_session_for_user(stale, self.create_user("user"), None)
+        )
+
+
+class SessionCreationTests(PortalTestCase):
+    """Checks that reserved workshop sessions created in bulk are given
+    distinct ids, and that a failure to create the Kubernetes resource for
+    one workshop session doesn't stop the rest being created.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.environment = self.create_environment(
+            "environment", "workshop", capacity=10
+        )
+
+        self.create_user(settings.ADMIN_USERNAME)
+
+    def test_reserve_session_ids(self):
+        stale = Environment.objects.get()
+
+        self.assertEqual(
+            sessions.reserve_session_ids(self.environment, 3),
+            ["s001", "s002", "s003"],
+        )
+
+        # The tally is incremented in the database, so reserving ids using
+        # a stale instance doesn't give out the same ids again.
+
+        self.assertEqual(sessions.reserve_session_ids(stale, 2), ["s004", "s005"])
+
+        self.assertEqual(self.environment.tally, 3)
+        self.assertEqual(stale.tally, 5)
+
+    def test_setup_workshop_sessions(self):
+        created = sessions.setup_workshop_sessions(self.environment, 3)
+
+        self.assertEqual(
+            [session.name for session, _ in created],
+            ["environment-s001", "environment-s002", "environment-s003"],
+        )
+
+        for session, secret in created:
+            application = Application.objects.get(pk=session.application_id)
+
+            self.assertEqual(application.client_id, session.name)
+            self.assertTrue(check_password(secret, application.client_secret))
+
+        self.assertEqual(self.environment.sessions_reserved, 3)
+        self.assertEqual(self.environment.recalculate_session_counters(), {})
+
+    def test_create_workshop_sessions_partial_failure(self):
+        created = sessions.setup_workshop_sessions(self.environment, 3)
+
+        failed = created[1][0].name
+
+        class Resource:
+            def __init__(self, name):
+                self.name = name
+                self.obj = {"metadata": {"uid": f"uid-{name}"}}
+
+            def create(self):
+                if self.name == failed:
+                    raise RuntimeError("Failed to create resource.")
+
+        def workshop_session_resource(session, secret):
+            return Resource(session.name), "password"
+
+        with mock.patch.object(
+            sessions, "workshop_session_resource", workshop_session_resource
+        ), mock.patch.object(sessions, "report_analytics_event"), self.assertLogs(
+            level="ERROR"
+        ):
+            sessions.create_workshop_sessions(created)
+
+        states = dict(Session.objects.values_list("name", "state"))
+
+        self.assertEqual(
+            states,
+            {
+                "environment-s001": SessionState.WAITING,
+                "environment-s002": SessionState.STARTING,
+                "environment-s003": SessionState.WAITING,
+            },
+        )
+
+        self.assertEqual(self.environment.recalculate_session_counters(), {})
+
+
+class SessionDeletionTests(PortalTestCase):
+    """Checks that a workshop session is only deleted once, where deletion of
+    it is requested more than once.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        environment = self.create_environment("environment", "workshop")
+
+        application = Application.objects.create(
+            name="session",
+            client_type="public",
+            authorization_grant_type="implicit",
+        )
+
+        self.session = self.create_session(
+            environment,
+            "session",
+            SessionState.STOPPING,
+            self.create_user("user"),
+            application=application,
+        )
+
+    def test_delete_workshop_session_once(self):
+        with mock.patch.object(cleanup.pykube, "object_factory"), mock.patch.object(
+            cleanup, "report_analytics_event"
+        ) as report:
+            cleanup.delete_workshop_session(self.session).execute()
+            cleanup.delete_workshop_session(self.session).execute()
+
+        self.assertEqual(report.call_count, 1)
+
+        environment = Environment.objects.get()
+
+        self.assertEqual(environment.sessions_allocated, 0)
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+
+class SessionExpiryTests(PortalTestCase):
+    """Checks that expired workshop sessions are only picked up by the
+    periodic tasks where they were missed when they expired.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        environment = self.create_environment("environment", "workshop")
+
+        now = timezone.now()
+
+        user = self.create_user("user")
+
+        for name, state, owner, expires in (
+            ("overdue", SessionState.RUNNING, user, now - timedelta(minutes=10)),
+            ("expired", SessionState.RUNNING, user, now - timedelta(seconds=30)),
+            ("stopping", SessionState.STOPPING, None, now - timedelta(minutes=10)),
+            ("reserved", SessionState.WAITING, None, now - timedelta(minutes=10)),
+            ("stopped", SessionState.STOPPED, user, now - timedelta(minutes=10)),
+        ):
+            self.create_session(environment, name, state, owner, expires=expires)
+
+    def test_expire_overdue_workshop_sessions(self):
+        with mock.patch.object(reconciler, "expire_workshop_session") as expire:
+            reconciler.expire_overdue_workshop_sessions()
+
+        self.assertEqual(
+            sorted(call.args[0] for call in expire.call_args_list),
+            ["overdue", "stopping"],
+        )
+
+    def test_session_checks_ignore_expired(self):
+        with mock.patch.object(
+            cleanup, "delete_workshop_session"
+        ) as delete, mock.patch.object(
+            cleanup, "report_analytics_event"
+        ) as report, mock.patch.object(
+            cleanup, "activity_prober"
+        ):
+            cleanup.purge_expired_workshop_sessions().execute()
+
+        delete.assert_not_called()
+        report.assert_not_called()
+
+
+@override_settings(TRAINING_PORTAL="portal")
+class ReconcilerTests(PortalTestCase):
+    """Checks that only changes to workshop sessions which affect reserved
+    sessions mark the workshop environment as dirty, and that dirty workshop
+    environments are reconciled separately.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.environment = self.create_environment("environment", "workshop")
+
+        self.session = self.create_session(
+            self.environment, "session", SessionState.WAITING
+        )
+
+    def test_counted_changes_mark_dirty(self):
+        with mock.patch.object(
+            reconciler.reconciler, "mark_dirty"
+        ) as mark_dirty, self.captureOnCommitCallbacks(execute=True):
+            self.session.expires = timezone.now()
+            self.session.save()
+
+        mark_dirty.assert_not_called()
+
+        with mock.patch.object(
+            reconciler.reconciler, "mark_dirty"
+        ) as mark_dirty, self.captureOnCommitCallbacks(execute=True):
+            self.session.mark_as_running(self.create_user("user"))
+
+        mark_dirty.assert_called_once_with(self.environment.pk)
+
+    def test_reconcile_dirty_environments(self):
+        other = self.create_environment("other", "other")
+
+        tasks = [
+            "delete_workshop_environments",
+            "terminate_reserved_sessions",
+            "refresh_workshop_environments",
+            "initiate_reserved_sessions",
+        ]
+
+        with mock.patch.object(
+            reconciler.reconciler,
+            "take_dirty",
+            return_value=frozenset([self.environment.pk, other.pk]),
+        ), mock.patch.multiple(
+            reconciler, **{task: mock.DEFAULT for task in tasks}
+        ) as mocks:
+            reconciler.reconcile_dirty_environments().execute()
+
+        for task in tasks:
+            self.assertEqual(
+                sorted(call.args[1] for call in mocks[task].call_args_list),
+                ["environment", "other"],
+            )
+
+        # Where there is a maximum number of workshop sessions, all workshop
+        # environments are reconciled together.
+
+        self.portal.sessions_maximum = 1
+        self.portal.save()
+
+        training_portal.invalidate()
+
+        with mock.patch.object(
+            reconciler.reconciler,
+            "take_dirty",
+            return_value=frozenset([self.environment.pk]),
+        ), mock.patch.multiple(
+            reconciler, **{task: mock.DEFAULT for task in tasks}
+        ) as mocks:
+            reconciler.reconcile_dirty_environments().execute()
+
+        for task in tasks:
+            mocks[task].assert_called_once_with(self.portal, None)
+
+
+class DeadlineHeapTests(TestCase):
+    """Checks that actions are run when due, once only for the latest time
+    a key was scheduled, and not at all if cancelled.
+
+    """
+
+    def test_deadlines(self):
+        reached = []
+
+        async def run():
+            loop = asyncio.get_running_loop()
+
+            heap = DeadlineHeap(lambda key: reached.append((key, loop.time())))
+
+            heap.start(loop)
+
+            now = timezone.now()
+
+            started = loop.time()
+
+            heap.schedule("earlier", now + timedelta(seconds=0.5))
+            heap.schedule("earlier", now + timedelta(seconds=0.1))
+
+            heap.schedule("later", now + timedelta(seconds=0.1))
+            heap.schedule("later", now + timedelta(seconds=0.3))
+
+            heap.schedule("cancelled", now + timedelta(seconds=0.1))
+            heap.cancel("cancelled")
+
+            await asyncio.sleep(0.7)
+
+            heap.stop()
+
+            # Superseded and cancelled entries are discarded from the heap
+            # rather than being acted on.
+
+            self.assertEqual(heap._heap, [])
+
+            return started
+
+        started = asyncio.run(run())
+
+        self.assertEqual([key for key, _ in reached], ["earlier", "later"])
+
+        self.assertLess(reached[0][1] - started, 0.3)
+        self.assertGreaterEqual(reached[1][1] - started, 0.25)
+
+
+class ActivityProberTests(TestCase):
+    """Checks the idle times of workshop sessions are queried and cached,
+    with requests which hang timing out rather than holding up others.
+
+    """
+
+    def test_probe_idle_times(self):
+        prober = activity.ActivityProber()
+
+        coroutines = []
+
+        async def run():
+            released = asyncio.Event()
+
+            async def idle(request):
+                return web.json_response({"idle-time": 12.5})
+
+            async def hung(request):
+                await released.wait()
+                return web.json_response({"idle-time": 0})
+
+            app = web.Application()
+            app.router.add_get("/idle", idle)
+            app.router.add_get("/hung", hung)
+
+            runner = web.AppRunner(app)
+            await runner.setup()
+
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+
+            port = runner.addresses[0][1]
+
+            targets = {
+                "idle": f"http://127.0.0.1:{port}/idle",
+                "hung": f"http://127.0.0.1:{port}/hung",
+            }
+
+            try:
+                prober.refresh(targets)
+
+                # Refreshing while probes are still pending doesn't repeat
+                # them.
+
+                prober.refresh(targets)
+
+                self.assertEqual(len(coroutines), 1)
+
+                await asyncio.gather(*coroutines)
+
+            finally:
+                released.set()
+
+                await prober.close()
+                await runner.cleanup()
+
+        with mock.patch.object(
+            activity, "schedule_coroutine", coroutines.append
+        ), mock.patch.object(activity, "PROBE_TOTAL_TIMEOUT", 0.5), self.assertLogs(
+            level="WARNING"
+        ) as logs:
+            asyncio.run(run())
+
+        self.assertIn("Cannot connect to workshop session hung", logs.output[0])
+
+        self.assertEqual(prober.idle_time("idle"), 12.5)
+        self.assertIsNone(prober.idle_time("hung"))
+
+        # Cached results aren't used once they are too old, and are discarded
+        # where the workshop session is no longer a target.
+
+        with mock.patch.object(
+            activity.time,
+            "monotonic",
+            return_value=time.monotonic() + activity.PROBE_RESULT_MAX_AGE + 1,
+        ):
+            self.assertIsNone(prober.idle_time("idle"))
+
+        with mock.patch.object(activity, "schedule_coroutine"):
+            prober.refresh({})
+
+        self.assertIsNone(prober.idle_time("idle"))
+
+
+class SessionScheduleTests(TestCase):
+    """Checks when the schedule of a workshop session next needs to be sent
+    to clients streaming changes to it, where nothing else changes.
+
+    """
+
+    def test_schedule_refresh_time(self):
+        # pylint: disable=import-outside-toplevel
+
+        from .manager.schedules import schedule_refresh_time
+
+        session = Session(
+            environment=Environment(expires=timedelta(minutes=30)),
+            state=SessionState.RUNNING,
+        )
+
+        # With an expiry of 30 minutes, the workshop session is flagged as
+        # expiring, and can be extended, in the last quarter of that time.
+
+        session.expires = timezone.now() + timedelta(minutes=20)
+
+        self.assertEqual(
+            schedule_refresh_time(session), session.expires - timedelta(minutes=7.5)
+        )
+
+        session.expires = timezone.now() + timedelta(minutes=5)
+
+        self.assertEqual(schedule_refresh_time(session), session.expires)
+
+        session.expires = None
+
+        self.assertIsNone(schedule_refresh_time(session))
+
+    def test_schedule_refresh_time_overtime(self):
+        # pylint: disable=import-outside-toplevel
+
+        from .manager.schedules import schedule_refresh_time
+
+        # With an overtime period longer than the threshold for expiring, the
+        # workshop session can be extended before being flagged as expiring.
+
+        session = Session(
+            environment=Environment(
+                expires=timedelta(minutes=30), overtime=timedelta(minutes=10)
+            ),
+            state=SessionState.RUNNING,
+            expires=timezone.now() + timedelta(minutes=20),
+        )
+
+        self.assertEqual(
+            schedule_refresh_time(session), session.expires - timedelta(minutes=10)
+        )
+
+
+class SessionAdminTests(PortalTestCase):
+    """Checks that the admin pages for workshop sessions don't make queries
+    for each workshop session listed, and that actions applied to workshop
+    sessions keep the counters of workshop sessions consistent.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        User = get_user_model()  # pylint: disable=invalid-name
+
+        self.client.force_login(
+            User.objects.create_superuser(username="admin", password="admin")
+        )
+
+        self.count = 0
+
+    def add_environment(self):
+        """Adds a workshop environment with a workshop session in each of
+        the states shown differently in the list of workshop sessions.
+
+        """
+
+        self.count += 1
+
+        environment = self.create_environment(
+            f"environment-{self.count}",
+            f"workshop-{self.count}",
+            capacity=10,
+            reserved=1,
+            expires=timedelta(minutes=30),
+            deadline=timedelta(minutes=60),
+        )
+
+        now = timezone.now()
+
+        for index in range(2):
+            self.create_session(
+                environment,
+                f"allocated-{self.count}-{index}",
+                SessionState.RUNNING,
+                self.create_user(f"user-{self.count}-{index}"),
+                started=now,
+                expires=now + timedelta(minutes=30),
+            )
+
+        self.create_session(environment, f"reserved-{self.count}", SessionState.WAITING)
+
+        self.create_session(
+            environment,
+            f"stopped-{self.count}",
+            SessionState.STOPPED,
+            self.create_user(f"user-{self.count}-stopped"),
+            started=now - timedelta(minutes=60),
+            expires=now - timedelta(minutes=30),
+        )
+
+        return environment
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("admin:workshops_session_changelist"))
+
+        self.assertEqual(response.status_code, 200)
+
+        return len(context.captured_queries)
+
+    def apply_action(self, action, names):
+        response = self.client.post(
+            reverse("admin:workshops_session_changelist"),
+            {"action": action, "_selected_action": names},
+        )
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_changelist_queries(self):
+        self.add_environment()
+
+        queries = self.count_queries()
+
+        for _ in range(4):
+            self.add_environment()
+
+        self.assertEqual(self.count_queries(), queries)
+
+    def test_session_actions(self):
+        environment = self.add_environment()
+
+        self.apply_action("expire_sessions", ["allocated-1-0", "reserved-1"])
+
+        self.assertEqual(
+            set(
+                Session.objects.filter(state=SessionState.STOPPING).values_list(
+                    "name", flat=True
+                )
+            ),
+            {"allocated-1-0", "reserved-1"},
+        )
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+        self.apply_action("extend_sessions_10m", ["allocated-1-0"])
+
+        self.assertEqual(
+            Session.objects.get(name="allocated-1-0").state, SessionState.RUNNING
+        )
+
+        self.apply_action("purge_sessions", ["allocated-1-1", "stopped-1"])
+
+        self.assertEqual(
+            set(Session.objects.values_list("name", flat=True)),
+            {"allocated-1-0", "allocated-1-1", "reserved-1"},
+        )
+        self.assertEqual(environment.recalculate_session_counters(), {})
+
+
+class SessionStatusUpdateTests(TestCase):
+    """Checks that outstanding status updates for a workshop session are
+    coalesced, and that failed updates are retried.
+
+    """
+
+    def apply_updates(self, side_effect=None):
+        with mock.patch.object(
+            sessions, "apply_session_status", side_effect=side_effect
+        ) as apply, mock.patch.object(
+            sessions, "schedule_session_status_updates"
+        ) as schedule:
+            sessions.apply_session_status_updates().execute()
+
+        return apply, schedule
+
+    def test_updates_coalesced(self):
+        SessionStatusUpdate.objects.create(name="session-1", phase="Allocated")
+        SessionStatusUpdate.objects.create(name="session-2", phase="Allocated")
+        SessionStatusUpdate.objects.create(name="session-1", phase="Stopping")
+
+        apply, schedule = self.apply_updates()
+
+        self.assertEqual(
+            apply.call_args_list,
+            [mock.call("session-1", "Stopping"), mock.call("session-2", "Allocated")],
+        )
+
+        self.assertFalse(SessionStatusUpdate.objects.exists())
+        self.assertFalse(schedule.called)
+
+    def test_updates_retried(self):
+        SessionStatusUpdate.objects.create(name="session-1", phase="Allocated")
+        SessionStatusUpdate.objects.create(name="session-1", phase="Stopping")
+
+        # Where the Kubernetes REST API can't be contacted the update is
+        # retried after a delay, along with the update it replaced.
+
+        _, schedule = self.apply_updates(requests.ConnectionError())
+
+        self.assertEqual(
+            list(SessionStatusUpdate.objects.values_list("attempts", flat=True)),
+            [1, 1],
+        )
+
+        self.assertEqual(schedule.call_count, 1)
+        self.assertGreater(schedule.call_args.kwargs["delay"], 1)
+
+    def test_updates_retried_until_resource_exists(self):
+        update = SessionStatusUpdate.objects.create(
+            name="session-1",
+            phase="Allocated",
+            attempts=sessions.STATUS_UPDATES_MAX_ATTEMPTS,
+        )
+
+        # A resource which doesn't exist may not have been created as yet,
+        # so the update is retried for longer than for other errors.
+
+        self.apply_updates(pykube.exceptions.ObjectDoesNotExist())
+
+        update.refresh_from_db()
+
+        self.assertEqual(update.attempts, sessions.STATUS_UPDATES_MAX_ATTEMPTS + 1)
+
+        SessionStatusUpdate.objects.update(
+            attempts=sessions.STATUS_UPDATES_MAX_ATTEMPTS_NOT_FOUND - 1,
+            not_before=timezone.now(),
+        )
+
+        with self.assertLogs(level="ERROR"):
+            self.apply_updates(pykube.exceptions.ObjectDoesNotExist())
+
+        self.assertFalse(SessionStatusUpdate.objects.exists())
+
+
+class AnalyticsDeliveryTests(TestCase):
+    """Checks that the worker delivering analytics events survives an
+    unexpected error, spooling the events it was delivering.
+
+    """
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    @override_settings(ANALYTICS_WEBHOOK_BATCH=False)
+    def test_unexpected_error(self):
+        delivery = AnalyticsDelivery()
+
+        delivery._spooled = False  # pylint: disable=protected-access
+
+        with mock.patch.object(
+            delivery, "_deliver", side_effect=[RuntimeError(), True]
+        ) as deliver, mock.patch.object(delivery, "_spool") as spool, mock.patch.object(
+            delivery, "_replay"
+        ) as replay, self.assertLogs(
+            level="ERROR"
+        ):
+            delivery.submit({"event": 1})
+
+            self.wait_for(lambda: spool.called)
+
+            delivery.submit({"event": 2})
+
+            self.wait_for(lambda: deliver.call_count == 2)
+
+        spool.assert_called_once_with([{"event": 1}])
+        deliver.assert_called_with([{"event": 2}])
+
+        self.assertFalse(replay.called)
+
+    def test_replay_unexpected_error(self):
+        delivery = AnalyticsDelivery()
+
+        spool_file = os.path.join(tempfile.mkdtemp(), "analytics.spool")
+
+        self.addCleanup(shutil.rmtree, os.path.dirname(spool_file))
+
+        with override_settings(ANALYTICS_SPOOL_FILE=spool_file):
+            delivery._spool([{"event": 1}, {"event": 2}])
+
+            with mock.patch.object(
+                delivery, "_deliver", side_effect=RuntimeError()
+            ), self.assertRaises(RuntimeError):
+                delivery._replay()
+
+            # The events which weren't delivered are spooled again, and the
+            # replay file removed, so they are delivered next time.
+
+            self.assertFalse(os.path.exists(f"{spool_file}.replay"))
+
+            with mock.patch.object(delivery, "_deliver", return_value=True) as deliver:
+                delivery._replay()
+
+            deliver.assert_called_once_with([{"event": 1}, {"event": 2}])
+
+            self.assertFalse(os.path.exists(spool_file))
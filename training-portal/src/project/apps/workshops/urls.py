@@ -78,4 +78,5 @@ urlpatterns = [
         views.user_sessions,
         name="workshops_user_sessions",
     ),
+    path("debug/locks/", views.debug_locks, name="workshops_debug_locks"),
 ]
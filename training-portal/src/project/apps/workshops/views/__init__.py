@@ -7,3 +7,4 @@ from .environment import *
 from .catalog import *
 from .session import *
 from .user import *
+from .monitoring import *
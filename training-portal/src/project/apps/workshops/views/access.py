@@ -13,6 +13,7 @@ from django.http import HttpResponseBadRequest
 from django.conf import settings
 
 from ..forms import AccessTokenForm
+from ..caching import portal_head_html
 
 
 @require_http_methods(["GET", "POST"])
@@ -47,10 +48,6 @@ def access(request):
 
     context = {"form": form}
 
-    try:
-        with open("/opt/app-root/static/theme/training-portal.html") as fp:
-            context["portal_head_html"] = fp.read()
-    except Exception:
-        context["portal_head_html"] = ""
+    context["portal_head_html"] = portal_head_html.content()
 
     return render(request, "workshops/access.html", context)
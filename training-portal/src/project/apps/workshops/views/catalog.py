@@ -6,19 +6,32 @@ interface and REST API.
 __all__ = ["catalog", "catalog_environments", "catalog_workshops"]
 
 import copy
+import json
 from urllib.parse import unquote
 import re
 
 from django.shortcuts import render, redirect, reverse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.db.models import Prefetch
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_http_methods
 from django.utils.http import urlencode
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.cache import parse_etags
 
-from oauth2_provider.decorators import protected_resource
-
-from ..models import TrainingPortal, EnvironmentState, SessionState
+from ..models import EnvironmentState, Session, SessionState
+from ..caching import (
+    catalog_version,
+    catalog_responses,
+    catalog_fragments,
+    portal_head_html,
+    training_portal,
+)
+from ..manager.metrics import timed_request
+from ..authorization import protected_resource, is_robot_account
 
 
 @require_http_methods(["GET"])
@@ -33,38 +46,79 @@ def catalog(request):
     if not request.user.is_staff and settings.PORTAL_INDEX:
         return redirect(settings.PORTAL_INDEX)
 
-    entries = []
-
     notification = request.GET.get("notification", "")
 
     # XXX What if the portal configuration doesn't exist as process
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = None
 
-    for environment in portal.running_environments():
-        details = {}
-        details["environment"] = environment.name
-        details["workshop"] = environment.workshop
+    # Look up any workshop sessions allocated to the user across all workshop
+    # environments at the same time, rather than for each in turn. We don't
+    # include sessions which are in the process of stopping as once stopping
+    # we would never return it to the user again.
 
-        capacity = max(0, environment.capacity - environment.allocated_sessions_count())
-        details["capacity"] = capacity
+    user_sessions = {}
 
-        details["session"] = None
+    if notification != "session-deleted" and request.user.is_authenticated:
+        portal = training_portal.get()
 
-        if notification != "session-deleted" and request.user.is_authenticated:
-            details["session"] = environment.allocated_session_for_user(request.user)
+        sessions = portal.allocated_sessions_for_user(request.user).exclude(
+            state=SessionState.STOPPING
+        )
 
-        entries.append(details)
+        for session in sessions:
+            user_sessions.setdefault(session.environment_id, session)
+
+    # Unless the user has a workshop session, the list of workshops is the
+    # same for all users of the same class, so the rendered list can be
+    # cached against the catalog version.
+
+    cache_key = None
+    catalog_html = None
+
+    if not user_sessions:
+        user_class = "registered" if request.user.is_authenticated else "anonymous"
+
+        cache_key = ("catalog", user_class)
+
+        entry = catalog_fragments.get(cache_key)
+
+        if entry:
+            catalog_html = mark_safe(entry.content)
+
+    if catalog_html is None:
+        version = catalog_version.version
+
+        portal = portal or training_portal.get()
 
-    context = {"catalog": entries, "notification": request.GET.get("notification", "")}
+        entries = []
 
-    try:
-        with open("/opt/app-root/static/theme/training-portal.html") as fp:
-            context["portal_head_html"] = fp.read()
-    except Exception:
-        context["portal_head_html"] = ""
+        for environment in portal.running_environments().select_related("workshop"):
+            details = {}
+            details["environment"] = environment.name
+            details["workshop"] = environment.workshop
+
+            capacity = max(
+                0, environment.capacity - environment.allocated_sessions_count()
+            )
+            details["capacity"] = capacity
+
+            details["session"] = user_sessions.get(environment.id)
+
+            entries.append(details)
+
+        catalog_html = render_to_string(
+            "workshops/catalog-entries.html", {"catalog": entries}
+        )
+
+        if cache_key:
+            catalog_fragments.put(cache_key, version, catalog_html)
+
+    context = {"catalog_html": catalog_html, "notification": notification}
+
+    context["portal_head_html"] = portal_head_html.content()
 
     return render(request, "workshops/catalog.html", context)
 
@@ -95,6 +149,41 @@ if settings.PORTAL_PASSWORD:
     catalog = permit_access_to_event(catalog)
 
 
+def cached_catalog_response(request, entry):
+    """Returns the cached response for the catalog, or a not modified
+    response if the client already holds the current version of it.
+
+    """
+
+    etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+
+    if entry.etag in etags or "*" in etags:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(entry.content, content_type="application/json")
+
+    response["ETag"] = entry.etag
+
+    return response
+
+
+def catalog_response(request, result, key, version):
+    """Returns the response for the catalog, caching the serialized form of
+    it against the catalog version if a key is supplied.
+
+    """
+
+    content = json.dumps(result, cls=DjangoJSONEncoder)
+
+    if key is None:
+        return HttpResponse(content, content_type="application/json")
+
+    entry = catalog_responses.put(key, version, content)
+
+    return cached_catalog_response(request, entry)
+
+
+@timed_request
 @require_http_methods(["GET"])
 def catalog_environments(request):
     """Returns details of workshop environments for REST API."""
@@ -109,7 +198,7 @@ def catalog_environments(request):
     include_sessions = False
 
     if request.user.is_authenticated:
-        if request.user.groups.filter(name="robots").exists():
+        if is_robot_account(request.user):
             include_sessions = request.GET.get("sessions", "").lower() in (
                 "true",
                 "1",
@@ -126,11 +215,31 @@ def catalog_environments(request):
             if "stopped" in include_states:
                 environment_states.append(EnvironmentState.STOPPED)
 
+    # Unless details of workshop sessions are being included, which can
+    # change over time even where nothing else does, we can return any
+    # response cached for the current catalog version.
+
+    cache_key = None
+
+    if not include_sessions:
+        cache_key = (
+            "environments",
+            tuple(environment_states),
+            request.META["QUERY_STRING"],
+        )
+
+        entry = catalog_responses.get(cache_key)
+
+        if entry:
+            return cached_catalog_response(request, entry)
+
+    version = catalog_version.version
+
     # XXX What if the portal configuration doesn't exist as process
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     if not environment_states:
         environment_states.append(EnvironmentState.RUNNING)
@@ -173,7 +282,26 @@ def catalog_environments(request):
     query_params_labels = query_params.get('labels', {})
     query_params_labels = {k: v[-1] for k, v in query_params_labels.items()}
 
-    for environment in portal.environments_in_state(environment_states):
+    # Fetch the workshop environments along with their workshops, and if
+    # required the allocated workshop sessions and their owners, in a fixed
+    # number of queries regardless of how many there are.
+
+    environments = portal.environments_in_state(environment_states).select_related(
+        "workshop"
+    )
+
+    if include_sessions:
+        environments = environments.prefetch_related(
+            Prefetch(
+                "session_set",
+                queryset=Session.objects.exclude(owner__isnull=True)
+                .exclude(state=SessionState.STOPPED)
+                .select_related("owner"),
+                to_attr="allocated_sessions_list",
+            )
+        )
+
+    for environment in environments:
         if query_params_name and environment.workshop.name not in query_params_name:
             continue
 
@@ -215,7 +343,7 @@ def catalog_environments(request):
         if include_sessions:
             sessions_data = []
 
-            for session in environment.allocated_sessions():
+            for session in environment.allocated_sessions_list:
                 session_data = {
                     "name": session.name,
                     "state": SessionState(session.state).name,
@@ -239,8 +367,6 @@ def catalog_environments(request):
 
         entries.append(details)
 
-    allocated_sessions = portal.allocated_sessions()
-
     result = {
         "portal": {
             "name": settings.TRAINING_PORTAL,
@@ -252,32 +378,42 @@ def catalog_environments(request):
                 "maximum": portal.sessions_maximum,
                 "registered": portal.sessions_registered,
                 "anonymous": portal.sessions_anonymous,
-                "allocated": allocated_sessions.count(),
+                "allocated": portal.allocated_sessions_count(),
             },
         },
         "environments": entries,
     }
 
-    return JsonResponse(result)
+    return catalog_response(request, result, cache_key, version)
 
 
 if settings.CATALOG_VISIBILITY != "public":
     catalog_environments = protected_resource()(catalog_environments)
 
+@timed_request
 @require_http_methods(["GET"])
 def catalog_workshops(request):
     """Returns details of available workshops for REST API. Only returns
        workshops with environments in the running state."""
 
+    cache_key = ("workshops",)
+
+    entry = catalog_responses.get(cache_key)
+
+    if entry:
+        return cached_catalog_response(request, entry)
+
+    version = catalog_version.version
+
     entries = []
 
     # XXX What if the portal configuration doesn't exist as process
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
-    for environment in portal.running_environments():
+    for environment in portal.running_environments().select_related("workshop"):
         labels = copy.deepcopy(portal.default_labels)
         labels.update(environment.workshop.labels)
         labels.update(environment.labels)
@@ -307,8 +443,6 @@ def catalog_workshops(request):
 
         entries.append(details)
 
-    allocated_sessions = portal.allocated_sessions()
-
     result = {
         "portal": {
             "name": settings.TRAINING_PORTAL,
@@ -320,13 +454,13 @@ def catalog_workshops(request):
                 "maximum": portal.sessions_maximum,
                 "registered": portal.sessions_registered,
                 "anonymous": portal.sessions_anonymous,
-                "allocated": allocated_sessions.count(),
+                "allocated": portal.allocated_sessions_count(),
             },
         },
         "workshops": entries,
     }
 
-    return JsonResponse(result)
+    return catalog_response(request, result, cache_key, version)
 
 
 if settings.CATALOG_VISIBILITY != "public":
@@ -16,6 +16,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.models import Group
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.http import HttpResponseForbidden, HttpResponseBadRequest
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
@@ -25,16 +26,17 @@ from django.db import transaction
 from django.contrib.auth import login
 from django.conf import settings
 
-from oauth2_provider.decorators import protected_resource
-
 from ..manager.analytics import report_analytics_event
 from ..manager.sessions import retrieve_session_for_user
-from ..manager.locking import resources_lock
-from ..models import TrainingPortal, Environment, EnvironmentState, SessionState
+from ..manager.locking import environment_lock
+from ..manager.metrics import timed_request
+from ..models import Environment, EnvironmentState, SessionState
+from ..caching import training_portal
+from ..authorization import protected_resource, is_robot_account
 
 @login_required
 @require_http_methods(["GET"])
-@resources_lock
+@environment_lock(lambda request, name: name)
 @transaction.atomic
 def environment(request, name):
     """Initiate creation of a workshop session against the specific workshop
@@ -74,7 +76,7 @@ def environment(request, name):
 
 
 @require_http_methods(["GET"])
-@resources_lock
+@environment_lock(lambda request, name: name)
 @transaction.atomic
 def environment_create(request, name):
     """Direct URL that can be used to create workshop sessions. Will redirect
@@ -128,10 +130,11 @@ def environment_create(request, name):
     return redirect(reverse("workshops_environment", args=(name,)))
 
 
+@timed_request
 @csrf_exempt
 @protected_resource()
 @require_http_methods(["GET"])
-@resources_lock
+@environment_lock(lambda request, name: name)
 @transaction.atomic
 def environment_status(request, name):
     """Return the status of the workshop environment, including the number of
@@ -141,14 +144,14 @@ def environment_status(request, name):
 
     # Only allow user who is in the robots group to request session.
 
-    if not request.user.groups.filter(name="robots").exists():
+    if not is_robot_account(request.user):
         return HttpResponseForbidden("Status requests not permitted")
 
     # XXX What if the portal configuration doesn't exist as process
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure there is an environment which the specified name in existance.
 
@@ -163,7 +166,7 @@ def environment_status(request, name):
     include_sessions = False
 
     if request.user.is_authenticated:
-        if request.user.groups.filter(name="robots").exists():
+        if is_robot_account(request.user):
             include_sessions = request.GET.get("sessions", "").lower() in (
                 "true",
                 "1",
@@ -230,10 +233,11 @@ def environment_status(request, name):
     return JsonResponse(details)
 
 
+@timed_request
 @csrf_exempt
 @protected_resource()
 @require_http_methods(["GET", "POST"])
-@resources_lock
+@environment_lock(lambda request, name: name)
 @transaction.atomic
 def environment_request(request, name):
     """URL for requesting creation of a workshop session against a specific
@@ -243,7 +247,7 @@ def environment_request(request, name):
 
     # Only allow user who is in the robots group to request session.
 
-    if not request.user.groups.filter(name="robots").exists():
+    if not is_robot_account(request.user):
         return HttpResponseForbidden("Session requests not permitted")
 
     # Ensure there is an environment which the specified name in existance.
@@ -358,13 +362,25 @@ def environment_request(request, name):
 
     User = get_user_model()  # pylint: disable=invalid-name
 
-    try:
-        user = User.objects.get(username=username)
-    except User.DoesNotExist:
-        user = User.objects.create_user(username, **user_details)
+    # Requests for different workshop environments can be handled at the
+    # same time, so the same user could be created by two requests at once.
+    # Where creating the user fails because another request created it in
+    # the meantime, get_or_create() returns the existing user instead. The
+    # user is given the same details as create_user() would give it,
+    # including not having a usable password.
+
+    defaults = dict(user_details, password=make_password(None))
+
+    if email:
+        defaults["email"] = User.objects.normalize_email(email)
+
+    user, created = User.objects.get_or_create(
+        username=User.normalize_username(str(username)), defaults=defaults
+    )
+
+    if created:
         group, _ = Group.objects.get_or_create(name="anonymous")
         user.groups.add(group)
-        user.save()
 
         report_analytics_event(user, "User/Create", {"group": "anonymous"})
 
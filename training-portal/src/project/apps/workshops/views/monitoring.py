@@ -0,0 +1,37 @@
+"""Defines view handlers for monitoring the training portal."""
+
+__all__ = ["metrics", "debug_locks"]
+
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.views.decorators.http import require_http_methods
+from django.contrib.admin.views.decorators import staff_member_required
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from ..manager.locking import lock_profiler
+from ..authorization import protected_resource, is_robot_account
+
+
+@protected_resource()
+@require_http_methods(["GET"])
+def metrics(request):
+    """Returns metrics for the training portal in Prometheus format."""
+
+    # Only allow a user who is in the robots group, or a staff member, to
+    # request metrics.
+
+    if not request.user.is_staff and not is_robot_account(request.user):
+        return HttpResponseForbidden("Access to metrics not permitted")
+
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def debug_locks(request):
+    """Returns the times spent waiting for and holding locks, aggregated by
+    the function holding the lock, since the process started.
+
+    """
+
+    return JsonResponse({"locks": lock_profiler.statistics()})
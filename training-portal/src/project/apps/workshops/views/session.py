@@ -33,20 +33,22 @@ from django.contrib.auth import login
 from django.http import JsonResponse
 from django.conf import settings
 
-from oauth2_provider.decorators import protected_resource
-
 from csp.decorators import csp_update
 
-from ..manager.locking import resources_lock
+from ..manager.locking import session_lock
 from ..manager.cleanup import delete_workshop_session
 from ..manager.sessions import update_session_status, create_request_resources
 from ..manager.analytics import report_analytics_event
-from ..models import TrainingPortal, SessionState
+from ..manager.schedules import schedule_details
+from ..manager.metrics import timed_request
+from ..models import SessionState
+from ..caching import portal_head_html, training_portal
+from ..authorization import protected_resource, is_robot_account
 
 
 @login_required(login_url="/")
 @require_http_methods(["GET"])
-@resources_lock
+@session_lock(lambda request, name: name)
 @transaction.atomic
 def session(request, name):
     """Renders the framed workshop session."""
@@ -59,7 +61,7 @@ def session(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure there is allocated session for the user.
 
@@ -88,11 +90,7 @@ def session(request, name):
     ] = f"{portal_url}/workshops/session/{instance.name}/delete/?notification=startup-timeout"
     context["startup_timeout"] = instance.environment.overdue.total_seconds()
 
-    try:
-        with open("/opt/app-root/static/theme/training-portal.html") as fp:
-            context["portal_head_html"] = fp.read()
-    except Exception:
-        context["portal_head_html"] = ""
+    context["portal_head_html"] = portal_head_html.content()
 
     response = render(request, "workshops/session.html", context)
 
@@ -123,7 +121,7 @@ def session_activate(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     instance = portal.allocated_session(name)
 
@@ -156,12 +154,13 @@ def session_activate(request, name):
     return redirect("workshops_session", name=instance.name)
 
 
+@timed_request
 @protected_resource()
 @require_http_methods(["GET"])
 def session_terminate(request, name):
     """Triggers termination of a workshop session."""
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure that the session exists.
 
@@ -175,10 +174,7 @@ def session_terminate(request, name):
     if not instance.is_allocated():
         return HttpResponseBadRequest("Session is not currently in use")
 
-    if (
-        not request.user.is_staff
-        and not request.user.groups.filter(name="robots").exists()
-    ):
+    if not request.user.is_staff and not is_robot_account(request.user):
         if instance.owner != request.user:
             return HttpResponseForbidden("Access to session not permitted")
 
@@ -198,7 +194,7 @@ def session_terminate(request, name):
 
 @login_required(login_url="/")
 @require_http_methods(["GET"])
-@resources_lock
+@session_lock(lambda request, name: name)
 def session_delete(request, name):
     """Triggers deletion of a workshop session."""
 
@@ -210,7 +206,7 @@ def session_delete(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     instance = portal.allocated_session(name, request.user)
 
@@ -246,6 +242,7 @@ def session_delete(request, name):
     return redirect(reverse("workshops_catalog") + f"?notification={notification}")
 
 
+@timed_request
 @protected_resource()
 @require_http_methods(["GET"])
 def session_authorize(request, name):
@@ -255,7 +252,7 @@ def session_authorize(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure that the session exists.
 
@@ -271,10 +268,7 @@ def session_authorize(request, name):
 
     # Check that are owner of session, a robot account, or a staff member.
 
-    if (
-        not request.user.is_staff
-        and not request.user.groups.filter(name="robots").exists()
-    ):
+    if not request.user.is_staff and not is_robot_account(request.user):
         if instance.owner != request.user:
             return HttpResponseForbidden("Access to session not permitted")
 
@@ -287,6 +281,7 @@ def session_authorize(request, name):
     )
 
 
+@timed_request
 @protected_resource()
 @require_http_methods(["GET"])
 def session_config(request, name):
@@ -296,7 +291,7 @@ def session_config(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure that the session exists.
 
@@ -307,10 +302,7 @@ def session_config(request, name):
 
     # Check that are owner of session, a robot account, or a staff member.
 
-    if (
-        not request.user.is_staff
-        and not request.user.groups.filter(name="robots").exists()
-    ):
+    if not request.user.is_staff and not is_robot_account(request.user):
         if instance.owner != request.user:
             return HttpResponseForbidden("Access to session not permitted")
 
@@ -322,6 +314,7 @@ def session_config(request, name):
     return JsonResponse(details)
 
 
+@timed_request
 @protected_resource()
 @require_http_methods(["GET"])
 def session_schedule(request, name):
@@ -331,7 +324,7 @@ def session_schedule(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure that the session exists.
 
@@ -342,31 +335,14 @@ def session_schedule(request, name):
 
     # Check that are owner of session, a robot account, or a staff member.
 
-    if (
-        not request.user.is_staff
-        and not request.user.groups.filter(name="robots").exists()
-    ):
+    if not request.user.is_staff and not is_robot_account(request.user):
         if instance.owner != request.user:
             return HttpResponseForbidden("Access to session not permitted")
 
-    details = {}
-
-    details["status"] = SessionState(instance.state).name
-
-    details["started"] = instance.started
-    details["expires"] = instance.expires
-
-    details["expiring"] = instance.is_expiring()
-
-    remaining = instance.time_remaining()
-
-    if remaining is not None:
-        details["countdown"] = remaining
-        details["extendable"] = instance.is_extension_permitted()
-
-    return JsonResponse(details)
+    return JsonResponse(schedule_details(instance))
 
 
+@timed_request
 @protected_resource()
 @require_http_methods(["GET"])
 def session_extend(request, name):
@@ -379,7 +355,7 @@ def session_extend(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure that the session exists.
 
@@ -395,10 +371,7 @@ def session_extend(request, name):
 
     # Check that are owner of session, a robot account, or a staff member.
 
-    if (
-        not request.user.is_staff
-        and not request.user.groups.filter(name="robots").exists()
-    ):
+    if not request.user.is_staff and not is_robot_account(request.user):
         if instance.owner != request.user:
             return HttpResponseForbidden("Access to session not permitted")
 
@@ -434,6 +407,7 @@ def session_extend(request, name):
     return JsonResponse(details)
 
 
+@timed_request
 @csrf_exempt
 @protected_resource()
 @require_http_methods(["POST"])
@@ -447,7 +421,7 @@ def session_event(request, name):
     # hasn't been initialized yet. Should return error indicating the
     # service is not available.
 
-    portal = TrainingPortal.objects.get(name=settings.TRAINING_PORTAL)
+    portal = training_portal.get()
 
     # Ensure that the session exists.
 
@@ -463,10 +437,7 @@ def session_event(request, name):
 
     # Check that are owner of session, a robot account, or a staff member.
 
-    if (
-        not request.user.is_staff
-        and not request.user.groups.filter(name="robots").exists()
-    ):
+    if not request.user.is_staff and not is_robot_account(request.user):
         if instance.owner != request.user:
             return HttpResponseForbidden("Access to session not permitted")
 
@@ -6,15 +6,15 @@ REST API.
 __all__ = ["user_sessions"]
 
 from django.http import HttpResponseForbidden
-from django.contrib.auth import get_user_model
 from django.views.decorators.http import require_http_methods
 from django.http import JsonResponse
 
-from oauth2_provider.decorators import protected_resource
-
-from ..models import Environment
+from ..models import Session, SessionState
+from ..manager.metrics import timed_request
+from ..authorization import protected_resource, is_robot_account
 
 
+@timed_request
 @protected_resource()
 @require_http_methods(["GET"])
 def user_sessions(request, name):
@@ -22,49 +22,57 @@ def user_sessions(request, name):
 
     # Only allow user who is in the robots group to request details.
 
-    if not request.user.groups.filter(name="robots").exists():
+    if not is_robot_account(request.user):
         return HttpResponseForbidden("Session requests not permitted")
 
-    # Check that user asking about exists.
+    # Look up the workshop sessions allocated to the user across all workshop
+    # environments in one query, joining the user on the username rather
+    # than looking up the user first. If the user doesn't exist there will
+    # be no workshop sessions. We don't include sessions which are in the
+    # process of stopping as once stopping we would never return it to the
+    # user again. There should only be at most one workshop session for the
+    # user per workshop environment, but only the first is returned if not.
 
-    User = get_user_model()  # pylint: disable=invalid-name
+    active_sessions = (
+        Session.objects.filter(owner__username=name)
+        .exclude(state__in=(SessionState.STOPPING, SessionState.STOPPED))
+        .select_related("environment__workshop")
+        .order_by("environment_id", "id")
+    )
 
-    try:
-        user = User.objects.get(username=name)
-    except User.DoesNotExist:
-        return JsonResponse({"user": name, "sessions": []})
+    environment_sessions = {}
 
-    sessions = []
+    for session in active_sessions:
+        environment_sessions.setdefault(session.environment_id, session)
 
-    for environment in Environment.objects.all():
-        session = environment.allocated_session_for_user(user)
+    sessions = []
 
-        if session:
-            details = {}
+    for session in environment_sessions.values():
+        details = {}
 
-            details["name"] = session.name
+        details["name"] = session.name
 
-            # The session namespace currently has the same name as the
-            # session. Return it as a separate value in case it could be
-            # different in the future.
+        # The session namespace currently has the same name as the
+        # session. Return it as a separate value in case it could be
+        # different in the future.
 
-            details["namespace"] = session.name
+        details["namespace"] = session.name
 
-            details["workshop"] = session.workshop_name()
-            details["environment"] = session.environment_name()
+        details["workshop"] = session.workshop_name()
+        details["environment"] = session.environment_name()
 
-            details["started"] = session.started
+        details["started"] = session.started
 
-            if session.expires:
-                details["expires"] = session.expires
+        if session.expires:
+            details["expires"] = session.expires
 
-            remaining = session.time_remaining()
+        remaining = session.time_remaining()
 
-            if remaining is not None:
-                details["countdown"] = remaining
-                details["extendable"] = session.is_extension_permitted()
+        if remaining is not None:
+            details["countdown"] = remaining
+            details["extendable"] = session.is_extension_permitted()
 
-            sessions.append(details)
+        sessions.append(details)
 
     result = {"user": name, "sessions": sessions}
 
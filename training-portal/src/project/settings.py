@@ -1,4 +1,5 @@
 import os
+import socket
 
 from django.core.management.utils import get_random_secret_key
 
@@ -8,7 +9,12 @@ DATA_DIR = os.path.normpath(os.path.join(BASE_DIR, "../data"))
 
 secret_key_file = os.path.join(DATA_DIR, "secret-key.txt")
 
-if os.path.exists(secret_key_file):
+# Where there are multiple replicas of the training portal, the secret key
+# is supplied so it is the same for all replicas.
+
+if os.environ.get("PORTAL_SECRET_KEY"):
+    SECRET_KEY = os.environ["PORTAL_SECRET_KEY"]
+elif os.path.exists(secret_key_file):
     with open(secret_key_file) as fp:
         SECRET_KEY = fp.read().strip()
 else:
@@ -75,12 +81,49 @@ WSGI_APPLICATION = "project.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": os.path.join(DATA_DIR, "db.sqlite3"),
+# By default a SQLite database held in the data directory is used. This is
+# sufficient for small installs, but as SQLite only allows one writer at a
+# time a PostgreSQL database can be used instead for larger installs.
+
+DATABASE_ENGINE = os.environ.get("PORTAL_DATABASE_ENGINE", "sqlite") or "sqlite"
+
+if DATABASE_ENGINE in ("postgresql", "postgres"):
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "HOST": os.environ.get("PORTAL_DATABASE_HOST", "localhost"),
+            "PORT": os.environ.get("PORTAL_DATABASE_PORT", "5432"),
+            "NAME": os.environ.get("PORTAL_DATABASE_NAME", "training-portal"),
+            "USER": os.environ.get("PORTAL_DATABASE_USER", ""),
+            "PASSWORD": os.environ.get("PORTAL_DATABASE_PASSWORD", ""),
+            "CONN_MAX_AGE": 60,
+            "CONN_HEALTH_CHECKS": True,
+        }
     }
-}
+
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(DATA_DIR, "db.sqlite3"),
+        }
+    }
+
+# When using SQLite, connections can optionally be tuned to use write ahead
+# logging so that readers don't block behind a writer, along with a busy
+# timeout and memory mapped I/O. See the workshops database module.
+
+DATABASE_TUNED = os.environ.get("PORTAL_DATABASE_TUNED", "false").lower() in (
+    "true",
+    "1",
+)
+
+# Number of replicas of the training portal sharing the database, which where
+# more than one requires a PostgreSQL database. All replicas handle requests,
+# but only the replica elected as leader using a Kubernetes lease in the
+# namespace of the training portal runs the kopf operator and periodic tasks.
+
+PORTAL_REPLICAS = int(os.environ.get("PORTAL_REPLICAS", "1") or "1")
 
 
 # Password validation
@@ -182,6 +225,24 @@ AMPLITUDE_TRACKING_ID = os.environ.get("AMPLITUDE_TRACKING_ID", "")
 
 ANALYTICS_WEBHOOK_URL = os.environ.get("ANALYTICS_WEBHOOK_URL", "")
 
+# Analytics events are delivered to the webhook by a background worker. When
+# batching is enabled, multiple events are posted in a single request. Events
+# which can't be delivered are spooled to a file in the data directory and
+# delivery retried later.
+
+ANALYTICS_WEBHOOK_BATCH = os.environ.get(
+    "ANALYTICS_WEBHOOK_BATCH", "false"
+).lower() in ("true", "1")
+
+ANALYTICS_SPOOL_FILE = os.path.join(DATA_DIR, "analytics-events.jsonl")
+
+# Time in milliseconds for which a lock can be held before a warning is
+# logged with the stack of the holder. A value of 0 disables the warning.
+
+LOCK_HOLD_WARNING_THRESHOLD = int(
+    os.environ.get("LOCK_HOLD_WARNING_THRESHOLD", "5000") or "0"
+)
+
 OPERATOR_API_GROUP = os.environ.get("OPERATOR_API_GROUP", "educates.dev")
 
 OPERATOR_STATUS_KEY = os.environ.get("OPERATOR_STATUS_KEY", "educates")
@@ -195,6 +256,12 @@ INGRESS_SECRET = os.environ.get("INGRESS_SECRET", "")
 PORTAL_NAME = os.environ.get("TRAINING_PORTAL", "")
 PORTAL_UID = os.environ.get("PORTAL_UID", "")
 
+PORTAL_NAMESPACE = os.environ.get("PORTAL_NAMESPACE", f"{TRAINING_PORTAL}-ui")
+
+# Identity of the replica of the training portal used in leader election.
+
+PORTAL_REPLICA = os.environ.get("PORTAL_REPLICA", socket.gethostname())
+
 PORTAL_HOSTNAME = os.environ.get(
     "PORTAL_HOSTNAME", f"{TRAINING_PORTAL}-ui.{INGRESS_DOMAIN}"
 )
@@ -270,6 +337,8 @@ OAUTH2_PROVIDER = {
     "REFRESH_TOKEN_EXPIRE_SECONDS": 30*24*60*60, # 30 Days.
 
     "PKCE_REQUIRED": False,
+
+    "OAUTH2_VALIDATOR_CLASS": "project.apps.workshops.authorization.CachedOAuth2Validator",
 }
 
 AUTHENTICATION_BACKENDS = [
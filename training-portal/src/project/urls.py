@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.urls import include, path
 
 from . import views
+from .apps.workshops import views as workshops_views
 
 import oauth2_provider.views as oauth2_views
 
@@ -18,5 +19,6 @@ urlpatterns = [
     path("accounts/", include("django.contrib.auth.urls")),
     path("workshops/", include("project.apps.workshops.urls")),
     path("oauth2/", include(oauth2_endpoint_views)),
+    path("metrics", workshops_views.metrics, name="metrics"),
     path("", views.index, name="index"),
 ]
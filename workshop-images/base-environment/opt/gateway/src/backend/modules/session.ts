@@ -9,6 +9,8 @@ import { logger } from "./logger"
 
 const PORTAL_API_URL = process.env.PORTAL_API_URL
 
+const PORTAL_EVENTS_URL = process.env.PORTAL_EVENTS_URL
+
 const SESSION_NAME = process.env.SESSION_NAME
 
 async function get_session_schedule(session, oauth2_client) {
@@ -98,6 +100,50 @@ export function setup_session(app: express.Application, oauth2_client: any) {
         res.json({})
     })
 
+    // Relays the stream of changes to the session schedule from the portal
+    // so the dashboard doesn't need to poll for them. The dashboard falls
+    // back to polling if the stream is not available.
+
+    app.get("/session/schedule/events", async (req, res) => {
+        if (!req.session.token || !PORTAL_EVENTS_URL)
+            return res.status(404).send("Session schedule events not available")
+
+        const controller = new AbortController()
+
+        req.on("close", () => controller.abort())
+
+        try {
+            await check_for_access_token_expiry(req.session, oauth2_client)
+
+            let access_token = oauth2_client.createToken(JSON.parse(req.session.token))
+
+            const options = {
+                baseURL: PORTAL_EVENTS_URL,
+                headers: { "Authorization": "Bearer " + access_token["token"]["access_token"] },
+                responseType: "stream",
+                signal: controller.signal
+            }
+
+            const url = "/workshops/session/" + SESSION_NAME + "/schedule/events/"
+
+            let upstream = await axios.get(url, options)
+
+            res.writeHead(200, {
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no"
+            })
+
+            upstream.data.pipe(res)
+        } catch (error) {
+            if (!controller.signal.aborted) {
+                logger.error("Error streaming session schedule", { message: error.message })
+
+                res.status(502).send("Error streaming session schedule")
+            }
+        }
+    })
+
     app.get("/session/extend", async (req, res) => {
         if (req.session.token) {
             try {
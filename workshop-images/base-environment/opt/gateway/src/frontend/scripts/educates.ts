@@ -1170,6 +1170,7 @@ class Dashboard {
     private expiration: number
     private extendable: boolean
     private expiring: boolean
+    private schedule_streaming: boolean
     private messages: MessagesChannel
 
     constructor() {
@@ -1608,7 +1609,7 @@ class Dashboard {
                 update = true
             }
 
-            if (update) {
+            if (update && !self.schedule_streaming) {
                 $.ajax({
                     type: 'GET',
                     url: "/session/schedule",
@@ -1635,6 +1636,34 @@ class Dashboard {
         }
 
         if ($("#countdown-button").length) {
+            // Changes to the session schedule are pushed to the dashboard when
+            // the browser supports it. While the stream is connected there is
+            // no need to poll for the session schedule.
+
+            if (window.EventSource) {
+                let events = new EventSource("/session/schedule/events")
+
+                events.onopen = () => {
+                    self.schedule_streaming = true
+                }
+
+                events.onmessage = (event) => {
+                    let data = JSON.parse(event.data)
+
+                    if (data.expires) {
+                        let now = Math.floor(new Date().getTime() / 1000)
+                        let countdown = Math.max(0, Math.floor(data.countdown))
+                        self.expiration = now + countdown
+                        self.extendable = data.extendable
+                        self.expiring = data.expiring
+                    }
+                }
+
+                events.onerror = () => {
+                    self.schedule_streaming = false
+                }
+            }
+
             setTimeout(check_countdown, 500)
 
             $("#countdown-button").on("click", () => {